@@ -18,50 +18,139 @@ logger.setLevel(logging.INFO)
 
 
 class BagitData:
+    """
+    BagIt info, manifest and file-metadata.csv rows for building a DRI SIP.
+
+    Rows are held by column (one list of values per CSV column) rather than
+    as a list of dicts; checksums are looked up in a path to checksum index
+    built once from the manifest, and each row's DRI identifier is computed
+    once per identifier prefix.
+    """
+
+    METADATA_FIELDNAMES = ['identifier', 'file_name', 'folder', 'date_last_modified', 'checksum',
+                           'rights_copyright', 'legal_status', 'held_by', 'language', 'TDR_consignment_ref']
+    CLOSURE_FIELDNAMES = ['identifier', 'folder', 'closure_start_date', 'closure_period', 'foi_exemption_code',
+                          'foi_exemption_asserted', 'title_public', 'title_alternate', 'closure_type']
 
     def __init__(self, config_dict, info_dict, manifest_dict, csv_data):
         self.bagit = config_dict
         self.info_dict = info_dict
         self.manifest_dict = manifest_dict
-        self.csv_data = list(csv_data)
+        self.columns = {}
+        self.row_count = 0
+        self.load_rows(csv_data)
+        self.checksum_index = self.build_checksum_index(manifest_dict)
+        self.identifier_cache = {}
         self.consignment_series = self.info_dict.get('Consignment-Series')
         self.tdr_bagit_export_time = self.info_dict.get('Consignment-Export-Datetime')
         self.consignment_reference = self.info_dict.get('Internal-Sender-Identifier')
 
+    def load_rows(self, csv_data):
+        # a column first seen part way through is back-filled with None, as
+        # csv.DictReader does for short rows
+        for row in csv_data:
+            for fieldname, value in row.items():
+                column = self.columns.get(fieldname)
+                if column is None:
+                    column = self.columns[fieldname] = [None] * self.row_count
+                column.append(value)
+            self.row_count += 1
+            for column in self.columns.values():
+                if len(column) < self.row_count:
+                    column.append(None)
+
+    @staticmethod
+    def build_checksum_index(manifest_dict):
+        # a file listed more than once has no single checksum, so gets ''
+        checksum_index = {}
+        for item in manifest_dict:
+            file = item.get('file')
+            checksum_index[file] = '' if file in checksum_index else item.get('checksum')
+        return checksum_index
+
+    @property
+    def csv_data(self):
+        return [self.row(index) for index in range(self.row_count)]
+
+    def column(self, fieldname):
+        return self.columns.get(fieldname) or [None] * self.row_count
+
+    def row(self, index):
+        return {fieldname: column[index] for fieldname, column in self.columns.items()}
+
+    def identifiers(self, dc):
+        """
+        Return the DRI identifier of every row for config `dc`; computed on
+        first use and reused by later calls with the same prefix.
+        """
+        prefix = dc["IDENTIFIER_PREFIX"]
+        identifiers = self.identifier_cache.get(prefix)
+        if identifiers is None:
+            identifiers = [
+                self.to_dri_identifier(filepath, file_type, prefix)
+                for filepath, file_type in zip(self.column('Filepath'), self.column('FileType'))
+            ]
+            self.identifier_cache[prefix] = identifiers
+        return identifiers
+
     def to_metadata(self, dc):
-        metadata_fieldnames = ['identifier', 'file_name', 'folder', 'date_last_modified', 'checksum',
-                               'rights_copyright', 'legal_status', 'held_by', 'language', 'TDR_consignment_ref']
         metadata_output = io.StringIO()
-        metadata_writer = csv.DictWriter(metadata_output, fieldnames=metadata_fieldnames, lineterminator="\n")
-        metadata_writer.writeheader()
-        for row in self.csv_data:
-            dri_metadata = tre_bagit_transforms.simple_dri_metadata(row)
-            result = self.dri_identifier(row, dc)
-            dri_metadata['identifier'] = result
-            dri_metadata['date_last_modified'] = self.dri_last_modified(row)
-            dri_metadata['checksum'] = self.dri_checksum(row)
-            dri_metadata['TDR_consignment_ref'] = self.consignment_reference
-            metadata_writer.writerow(dri_metadata)
+        self.write_dri_csvs(dc, metadata_file=metadata_output)
         return metadata_output.getvalue()
 
     def to_closure(self, dc):
-        closure_fieldnames = ['identifier', 'folder', 'closure_start_date', 'closure_period', 'foi_exemption_code',
-                              'foi_exemption_asserted', 'title_public', 'title_alternate', 'closure_type']
         closure_output = io.StringIO()
-        closure_writer = csv.DictWriter(closure_output, fieldnames=closure_fieldnames, lineterminator="\n")
-        closure_writer.writeheader()
-        for row in self.csv_data:
-            dri_closure = tre_bagit_transforms.simple_dri_closure(row)
-            dri_closure['identifier'] = self.dri_identifier(row, dc)
-            dri_closure['closure_start_date'] = ''
-            dri_closure['closure_period'] = 0
-            dri_closure['foi_exemption_asserted'] = ''
-            dri_closure['title_public'] = 'TRUE'
-            dri_closure['title_alternate'] = ''
-            dri_closure['closure_type'] = 'open_on_transfer'
-            closure_writer.writerow(dri_closure)
+        self.write_dri_csvs(dc, closure_file=closure_output)
         return closure_output.getvalue()
 
+    def write_dri_csvs(self, dc, metadata_file=None, closure_file=None):
+        """
+        Write DRI metadata.csv to `metadata_file` and closure.csv to
+        `closure_file` (either may be omitted) in a single pass of the rows.
+
+        The TDR columns are validated and converted a whole column at a time
+        first (see `tre_bagit_transforms.compile_row_transformer`), so a
+        `ValueError` listing every unexpected value is raised before anything
+        is written.
+        """
+        transformer = tre_bagit_transforms.compile_row_transformer(tuple(self.columns))
+        metadata_columns, closure_columns = transformer.transform(self.columns)
+        identifiers = self.identifiers(dc)
+        writers = []
+
+        if metadata_file is not None:
+            metadata_columns['identifier'] = identifiers
+            metadata_columns['date_last_modified'] = [
+                self.to_dri_last_modified(file_type, last_modified)
+                for file_type, last_modified in zip(self.column('FileType'), self.column('LastModified'))
+            ]
+            metadata_columns['checksum'] = self.checksums()
+            metadata_columns['TDR_consignment_ref'] = [self.consignment_reference] * self.row_count
+            writers.append((metadata_file, self.METADATA_FIELDNAMES, metadata_columns))
+
+        if closure_file is not None:
+            closure_columns['identifier'] = identifiers
+            closure_columns['closure_start_date'] = [''] * self.row_count
+            closure_columns['closure_period'] = [0] * self.row_count
+            closure_columns['foi_exemption_asserted'] = [''] * self.row_count
+            closure_columns['title_public'] = ['TRUE'] * self.row_count
+            closure_columns['title_alternate'] = [''] * self.row_count
+            closure_columns['closure_type'] = ['open_on_transfer'] * self.row_count
+            writers.append((closure_file, self.CLOSURE_FIELDNAMES, closure_columns))
+
+        csv_writers = []
+        csv_rows = []
+        for file, fieldnames, columns in writers:
+            csv_writer = csv.writer(file, lineterminator="\n")
+            csv_writer.writerow(fieldnames)
+            csv_writers.append(csv_writer)
+            # a field with no TDR column (e.g. an older bagit) is left empty
+            csv_rows.append(zip(*[columns.get(fieldname) or [''] * self.row_count for fieldname in fieldnames]))
+
+        for rows in zip(*csv_rows):
+            for csv_writer, row in zip(csv_writers, rows):
+                csv_writer.writerow(row)
+
     # ==== specific transformations for individual field values ====
     @staticmethod
     def dri_folder(row):
@@ -70,19 +159,28 @@ class BagitData:
 
     @staticmethod
     def dri_identifier(row, dc):
+        return BagitData.to_dri_identifier(row.get('Filepath'), row.get('FileType'), dc["IDENTIFIER_PREFIX"])
+
+    @staticmethod
+    def to_dri_identifier(filepath, file_type, identifier_prefix):
         # set dri batch/series/ prefix, escape the uri + append a `/` if folder
-        dri_identifier = row.get('Filepath').replace('data/', dc["IDENTIFIER_PREFIX"], 1)
-        final_slash_if_folder = "/" if(BagitData.dri_folder(row) == 'folder') else ""
+        dri_identifier = filepath.replace('data/', identifier_prefix, 1)
+        final_slash_if_folder = "/" if(file_type.lower() == 'folder') else ""
         return urllib.parse.quote(dri_identifier).replace('%3A', ':') + final_slash_if_folder
 
     def dri_checksum(self, row):
         # comes from the manifest and only exists for files
-        bagit_manifest_for_row = list(filter(lambda d: d.get('file') == row.get('Filepath'), self.manifest_dict))
-        return bagit_manifest_for_row[0].get('checksum') if(len(bagit_manifest_for_row) == 1) else ''
+        return self.checksum_index.get(row.get('Filepath'), '')
+
+    def checksums(self):
+        return [self.checksum_index.get(filepath, '') for filepath in self.column('Filepath')]
 
     def dri_last_modified(self, row):
-        if self.dri_folder(row) == 'file':
-            return row.get('LastModified')
+        return self.to_dri_last_modified(row.get('FileType'), row.get('LastModified'))
+
+    def to_dri_last_modified(self, file_type, last_modified):
+        if file_type.lower() == 'file':
+            return last_modified
         else:
             # use bagit export time for folders as they have no dlm from tdr
             return self.tdr_bagit_export_time.replace('Z', '', 1)
@@ -1,9 +1,15 @@
 #!/usr/bin/env python3
 import logging
+import functools
+import concurrent.futures
 from s3_lib import common_lib
 from s3_lib import checksum_lib
 from s3_lib import object_lib
 from s3_lib import tar_lib
+from s3_lib import tar_copy_lib
+from s3_lib import summary_lib
+from s3_lib import volume_lib
+from tre_lib import timing
 from tre_event_lib import tre_event_api
 from tre_bagit_transforms import dri_config_dict
 from tre_bagit import BagitData
@@ -18,28 +24,52 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+SIP_FORMAT_TAR = 'tar'
+SIP_FORMAT_TAR_GZ = 'tar.gz'
+
 # Get environment variable values
 env_out_bucket = common_lib.get_env_var('S3_DRI_OUT_BUCKET', must_exist=True, must_have_value=True)
 env_tre_presigned_url_expiry = common_lib.get_env_var('TRE_PRESIGNED_URL_EXPIRY', must_exist=True, must_have_value=True)
 env_process = common_lib.get_env_var('TRE_PROCESS_NAME', must_exist=True, must_have_value=True)
 env_producer = common_lib.get_env_var('TRE_SYSTEM_NAME', must_exist=True, must_have_value=True)
 env_environment = common_lib.get_env_var('TRE_ENVIRONMENT', must_exist=True, must_have_value=True)
+# SIP archive format: `tar.gz` (default) or `tar`; an uncompressed tar is
+# assembled server-side from the extracted objects without downloading them
+env_sip_format = (common_lib.get_env_var('TRE_SIP_FORMAT', must_exist=False, must_have_value=False)
+                  or SIP_FORMAT_TAR_GZ).lower()
+if env_sip_format not in (SIP_FORMAT_TAR, SIP_FORMAT_TAR_GZ):
+    raise ValueError(f'Invalid TRE_SIP_FORMAT "{env_sip_format}"')
+# Largest SIP volume (bytes); if unset the SIP is a single archive
+env_sip_volume_max_bytes = volume_lib.get_volume_max_bytes()
 
 KEY_S3_OBJECT_ROOT = 's3-object-root'
 KEY_S3_FOLDER_URL = 's3-folder-url'
 KEY_S3_SHA256_URL = 's3-sha256-url'
+KEY_S3_MEMBER_SHA256_URL = 's3-member-sha256-url'
 KEY_FILE_TYPE = 'file-type'
+KEY_VOLUMES = 'volumes'
+KEY_VOLUME_NAME = 'name'
+KEY_EVENTS = 'events'
 
 EVENT_NAME_INPUT = 'bagit-validated'
 EVENT_NAME_OUTPUT_OK = 'dri-preingest-sip-available'
 EVENT_NAME_OUTPUT_ERROR = 'dri-preingest-sip-error'
 
 
-def handler(event, context):
+def handler(event, context, batch_item=False):
     """
     Given a bagit unzip sitting at event's "s3_object_root" then a dri-sip is provided in env var S3_DRI_OUT_BUCKET
+
+    If `batch_item` (one of several events processed concurrently by
+    `batch_handler`), the hop is timed independently of the others without
+    counting S3 requests, and the SIP's volumes are built one at a time.
     """
     logger.info(f'handler start: event="{event}"')
+    # Remove the input's timing ledger (if any) before validation; this
+    # hop's record is appended and the ledger is carried over to the output
+    # event if TRE_TIMING_IN_BAND is set (otherwise it is logged)
+    timing_ledger, hop_timer = timing.start_hop(
+        event, stage=env_process, instrument_boto3=not batch_item, standalone=batch_item)
 
     tre_event_api.validate_event(event=event, schema_name=EVENT_NAME_INPUT)
 
@@ -59,61 +89,79 @@ def handler(event, context):
         # set-up config_dicts x 3 & make bagit data
         s3c = s3_config_dict(s3_object_root)
         bc = bagit_config_dict()
-        info_dict = object_lib.s3_object_to_dictionary(s3_data_bucket, s3c["PREFIX_TO_BAGIT"] + bc["BAG_INFO_TEXT"])
-        manifest_dict = checksum_lib.get_manifest_s3(s3_data_bucket, s3c["PREFIX_TO_BAGIT"] + bc["BAGIT_MANIFEST"])
-        csv_data = object_lib.s3_object_to_csv(s3_data_bucket, s3c["PREFIX_TO_BAGIT"] + bc["BAGIT_METADATA"])
+        # Use validation step's consignment summary if present (1 GET for all)
+        summary = summary_lib.read_consignment_summary(s3_data_bucket, s3_object_root)
+        if summary is not None:
+            info_dict = summary[summary_lib.KEY_BAG_INFO]
+            manifest_dict = summary_lib.get_manifest_items(summary)
+            csv_data = summary[summary_lib.KEY_METADATA]
+        else:
+            info_dict = object_lib.s3_object_to_dictionary(s3_data_bucket, s3c["PREFIX_TO_BAGIT"] + bc["BAG_INFO_TEXT"])
+            manifest_dict = checksum_lib.get_manifest_s3(s3_data_bucket, s3c["PREFIX_TO_BAGIT"] + bc["BAGIT_MANIFEST"])
+            csv_data = object_lib.s3_object_to_csv(s3_data_bucket, s3c["PREFIX_TO_BAGIT"] + bc["BAGIT_METADATA"])
         bagit_data = BagitData(bc, info_dict, manifest_dict, csv_data)
         dc = dri_config_dict(consignment_reference, bagit_data.consignment_series)
-        # csv files
-        closure_csv = bagit_data.to_closure(dc)
-        object_lib.string_to_s3_object(closure_csv, s3_data_bucket, s3c["PREFIX_TO_SIP"] + dc["CLOSURE_IN_SIP"])
-        metadata_csv = bagit_data.to_metadata(dc)
-        object_lib.string_to_s3_object(metadata_csv, s3_data_bucket, s3c["PREFIX_TO_SIP"] + dc["METADATA_IN_SIP"])
+        # csv files; both are written in one pass of the rows and hashed as
+        # they are streamed to s3, so they don't need to be read back
+        with object_lib.HashingS3Writer(s3_data_bucket, s3c["PREFIX_TO_SIP"] + dc["METADATA_IN_SIP"]) as metadata_file, \
+                object_lib.HashingS3Writer(s3_data_bucket, s3c["PREFIX_TO_SIP"] + dc["CLOSURE_IN_SIP"]) as closure_file:
+            bagit_data.write_dri_csvs(dc, metadata_file=metadata_file, closure_file=closure_file)
         # checksums for csv files
-        metadata_checksum = checksum_lib.get_s3_object_checksum(s3_data_bucket, s3c["PREFIX_TO_SIP"] + dc["METADATA_IN_SIP"])
-        object_lib.string_to_s3_object(f'{metadata_checksum}  {dc["METADATA"]}\n',
+        object_lib.string_to_s3_object(f'{metadata_file.hex_digest}  {dc["METADATA"]}\n',
                                        s3_data_bucket, s3c["PREFIX_TO_SIP"] + dc["METADATA_CHECKSUM_IN_SIP"])
-        closure_checksum = checksum_lib.get_s3_object_checksum(s3_data_bucket, s3c["PREFIX_TO_SIP"] + dc["CLOSURE_IN_SIP"])
-        object_lib.string_to_s3_object(f'{closure_checksum}  {dc["CLOSURE"]}\n',
+        object_lib.string_to_s3_object(f'{closure_file.hex_digest}  {dc["CLOSURE"]}\n',
                                        s3_data_bucket, s3c["PREFIX_TO_SIP"] + dc["CLOSURE_CHECKSUM_IN_SIP"])
         # write schemas
-        with open('metadata-schema.txt') as file:
-            object_lib.string_to_s3_object(file.read(), s3_data_bucket, s3c["PREFIX_TO_SIP"] + dc["METADATA_SCHEMA_IN_SIP"])
-        with open('closure-schema.txt') as file:
-            object_lib.string_to_s3_object(file.read(), s3_data_bucket, s3c["PREFIX_TO_SIP"] + dc["CLOSURE_SCHEMA_IN_SIP"])
-        # zip it all up
-        data_objects = object_lib.s3_ls(s3_data_bucket, s3c["PREFIX_TO_BAGIT"] + bc["PREFIX_FOR_DATA"])
-        data_objects_to_zip = tar_lib.S3objectsToZip(data_objects, s3c["PREFIX_TO_BAGIT"] + bc["PREFIX_FOR_DATA"], dc["INTERNAL_PREFIX"])
-        metadata_objects = object_lib.s3_ls(s3_data_bucket, s3c["PREFIX_TO_SIP"] + dc["INTERNAL_PREFIX"])
-        metadata_objects_to_zip = tar_lib.S3objectsToZip(metadata_objects, s3c["PREFIX_TO_SIP"] + dc["INTERNAL_PREFIX"], dc["INTERNAL_PREFIX"])
-        sip_zip_object = dc["BATCH"] + ".tar.gz"
-        sip_zip_key= s3c["PREFIX_TO_SIP"] + sip_zip_object
-        tar_lib.s3_objects_to_s3_tar_gz_file_with_prefix_substitution(
-            s3_bucket_in=s3_data_bucket,
-            s3_objects_with_prefix_subs=(metadata_objects_to_zip, data_objects_to_zip),
-            tar_gz_object=sip_zip_key,
-            s3_bucket_out=env_out_bucket
-        )
-        # make the checksum of the zip
-        sip_zip_checksum = checksum_lib.get_s3_object_checksum(env_out_bucket, sip_zip_key)
-        object_lib.string_to_s3_object(f'{sip_zip_checksum}  {sip_zip_object}\n', env_out_bucket, sip_zip_key + '.sha256')
-        # make presigned urls and add to output message
-        presigned_tar_gz_url = object_lib.get_s3_object_presigned_url(
-            bucket=env_out_bucket,
-            key=sip_zip_key,
-            expiry=env_tre_presigned_url_expiry)
-        presigned_checksum_url = object_lib.get_s3_object_presigned_url(
-            bucket=env_out_bucket,
-            key=sip_zip_key + '.sha256',
-            expiry=env_tre_presigned_url_expiry)
+        object_lib.string_to_s3_object(read_schema('metadata-schema.txt'), s3_data_bucket, s3c["PREFIX_TO_SIP"] + dc["METADATA_SCHEMA_IN_SIP"])
+        object_lib.string_to_s3_object(read_schema('closure-schema.txt'), s3_data_bucket, s3c["PREFIX_TO_SIP"] + dc["CLOSURE_SCHEMA_IN_SIP"])
+        # zip it all up; split into size-bounded volumes if configured, with
+        # the metadata files at the start of the first volume
+        if summary is not None:
+            data_object_sizes = summary_lib.get_data_object_sizes(summary)
+        else:
+            data_object_sizes = object_lib.s3_ls_with_size(s3_data_bucket, s3c["PREFIX_TO_BAGIT"] + bc["PREFIX_FOR_DATA"])
+        metadata_object_sizes = object_lib.s3_ls_with_size(s3_data_bucket, s3c["PREFIX_TO_SIP"] + dc["INTERNAL_PREFIX"])
+        volumes = volume_lib.split_into_volumes(
+            {**metadata_object_sizes, **data_object_sizes}, env_sip_volume_max_bytes)
+        # verify each file is unchanged since validation as it is packed;
+        # data files against the manifest, csv files against their checksums
+        expected_checksums = {
+            s3c["PREFIX_TO_BAGIT"].rstrip('/') + '/' + item[checksum_lib.ITEM_FILE]: item[checksum_lib.ITEM_CHECKSUM]
+            for item in manifest_dict
+        }
+        expected_checksums[s3c["PREFIX_TO_SIP"] + dc["METADATA_IN_SIP"]] = metadata_file.hex_digest
+        expected_checksums[s3c["PREFIX_TO_SIP"] + dc["CLOSURE_IN_SIP"]] = closure_file.hex_digest
+
+        def build_volume(number, objects):
+            return build_sip_volume(
+                s3_data_bucket=s3_data_bucket,
+                sip_object=volume_lib.get_volume_name(dc["BATCH"], number, len(volumes), env_sip_format),
+                prefix_to_sip=s3c["PREFIX_TO_SIP"],
+                objects_to_zip=(
+                    tar_lib.S3objectsToZip(
+                        [name for name in objects if name in metadata_object_sizes],
+                        s3c["PREFIX_TO_SIP"] + dc["INTERNAL_PREFIX"], dc["INTERNAL_PREFIX"]),
+                    tar_lib.S3objectsToZip(
+                        [name for name in objects if name not in metadata_object_sizes],
+                        s3c["PREFIX_TO_BAGIT"] + bc["PREFIX_FOR_DATA"], dc["INTERNAL_PREFIX"])),
+                expected_checksums=expected_checksums)
 
+        # The batch's workers already use the memory budget between them
+        sip_volumes = volume_lib.build_volumes(
+            volumes, build_volume, max_workers=1 if batch_item else None)
+
+        output_block = {
+            tre_event_api.KEY_REFERENCE: consignment_reference,
+            KEY_S3_FOLDER_URL: sip_volumes[0][KEY_S3_FOLDER_URL],
+            KEY_S3_SHA256_URL: sip_volumes[0][KEY_S3_SHA256_URL],
+            KEY_S3_MEMBER_SHA256_URL: sip_volumes[0][KEY_S3_MEMBER_SHA256_URL],
+            KEY_FILE_TYPE:  "TAR"
+        }
+        # volume index, in order; the first volume is also given above
+        if len(sip_volumes) > 1:
+            output_block[KEY_VOLUMES] = sip_volumes
         output_parameter_block = {
-            EVENT_NAME_OUTPUT_OK: {
-                tre_event_api.KEY_REFERENCE: consignment_reference,
-                KEY_S3_FOLDER_URL: presigned_tar_gz_url,
-                KEY_S3_SHA256_URL: presigned_checksum_url,
-                KEY_FILE_TYPE:  "TAR"
-            }
+            EVENT_NAME_OUTPUT_OK: output_block
         }
 
         event_output_ok = tre_event_api.create_event(
@@ -125,29 +173,115 @@ def handler(event, context):
             parameters=output_parameter_block
         )
 
+        timing.finish_hop(event_output_ok, timing_ledger, hop_timer)
         logger.info(f'event_output_ok:\n%s\n', event_output_ok)
         return event_output_ok
 
     except ValueError as e:
         logging.error('handler error: %s', str(e))
-        output_parameter_block = {
-            EVENT_NAME_OUTPUT_ERROR: {
-                tre_event_api.KEY_REFERENCE: consignment_reference,
-                tre_event_api.KEY_ERRORS: [str(e)]
-            }
+        event_output_error = create_error_event(event, consignment_reference, e)
+        timing.finish_hop(event_output_error, timing_ledger, hop_timer)
+        logger.info(f'event_output_error:\n%s\n', event_output_error)
+        return event_output_error
+
+
+def batch_handler(event, context):
+    """
+    Process the list of "bagit-validated" events in event's "events" in one
+    invocation, building their SIPs concurrently; return the output events
+    (in the same order) in "events". An error with one event gives an error
+    event for it, without stopping the others.
+    """
+    events = event[KEY_EVENTS]
+    logger.info(f'batch_handler start: events={len(events)}')
+
+    def process(item):
+        try:
+            return handler(item, context, batch_item=True)
+        except Exception as e:
+            logger.exception('batch_handler item error')
+            consignment_reference = item.get(tre_event_api.KEY_PARAMETERS, {}).get(
+                EVENT_NAME_INPUT, {}).get(tre_event_api.KEY_REFERENCE)
+            return create_error_event(item, consignment_reference, e)
+
+    workers = volume_lib.get_volume_worker_count(len(events))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        output_events = list(executor.map(process, events))
+
+    logger.info('batch_handler return')
+    return {KEY_EVENTS: output_events}
+
+
+def create_error_event(event, consignment_reference, error):
+    output_parameter_block = {
+        EVENT_NAME_OUTPUT_ERROR: {
+            tre_event_api.KEY_REFERENCE: consignment_reference,
+            tre_event_api.KEY_ERRORS: [str(error)]
         }
+    }
 
-        event_output_error = tre_event_api.create_event(
-            environment=env_environment,
-            producer=env_producer,
-            process=env_process,
-            event_name=EVENT_NAME_OUTPUT_ERROR,
-            prior_event=event,
-            parameters=output_parameter_block
-        )
+    return tre_event_api.create_event(
+        environment=env_environment,
+        producer=env_producer,
+        process=env_process,
+        event_name=EVENT_NAME_OUTPUT_ERROR,
+        prior_event=event,
+        parameters=output_parameter_block
+    )
 
-        logger.info(f'event_output_error:\n%s\n', event_output_error)
-        return event_output_error
+
+@functools.lru_cache(maxsize=None)
+def read_schema(file_name):
+    with open(file_name) as file:
+        return file.read()
+
+
+def build_sip_volume(s3_data_bucket, sip_object, prefix_to_sip, objects_to_zip, expected_checksums):
+    """
+    Write SIP volume `sip_object` (of `objects_to_zip`), its `.sha256`
+    file and its `.members.sha256` file (the SHA 256 of each member, by name
+    in the SIP) to env var S3_DRI_OUT_BUCKET; return the volume's index
+    entry. The checksums are calculated while the volume is written, so it
+    isn't read back; the member checksums are in a file rather than the
+    output event, whose size is limited.
+    """
+    sip_zip_key = prefix_to_sip + sip_object
+    if env_sip_format == SIP_FORMAT_TAR:
+        tar_items, sip_zip_checksum = tar_copy_lib.s3_objects_to_s3_tar_file_with_checksum(
+            s3_bucket_in=s3_data_bucket,
+            s3_objects_with_prefix_subs=objects_to_zip,
+            tar_object=sip_zip_key,
+            s3_bucket_out=env_out_bucket,
+            expected_checksums=expected_checksums
+        )
+    else:
+        tar_items, sip_zip_checksum = tar_lib.s3_objects_to_s3_tar_gz_file_with_checksum(
+            s3_bucket_in=s3_data_bucket,
+            s3_objects_with_prefix_subs=objects_to_zip,
+            tar_gz_object=sip_zip_key,
+            s3_bucket_out=env_out_bucket,
+            expected_checksums=expected_checksums
+        )
+    object_lib.string_to_s3_object(f'{sip_zip_checksum}  {sip_object}\n', env_out_bucket, sip_zip_key + '.sha256')
+    object_lib.string_to_s3_object(
+        ''.join(f'{tar_item["sha256"]}  {tar_item["name"]}\n' for tar_item in tar_items),
+        env_out_bucket, sip_zip_key + '.members.sha256')
+    # make presigned urls for the output message
+    return {
+        KEY_VOLUME_NAME: sip_object,
+        KEY_S3_FOLDER_URL: object_lib.get_s3_object_presigned_url(
+            bucket=env_out_bucket,
+            key=sip_zip_key,
+            expiry=env_tre_presigned_url_expiry),
+        KEY_S3_SHA256_URL: object_lib.get_s3_object_presigned_url(
+            bucket=env_out_bucket,
+            key=sip_zip_key + '.sha256',
+            expiry=env_tre_presigned_url_expiry),
+        KEY_S3_MEMBER_SHA256_URL: object_lib.get_s3_object_presigned_url(
+            bucket=env_out_bucket,
+            key=sip_zip_key + '.members.sha256',
+            expiry=env_tre_presigned_url_expiry)
+    }
 
 
 def bagit_config_dict():
@@ -1,78 +1,100 @@
 #!/usr/bin/env python3
+import collections
+import functools
 
-def simple_dri_metadata(bagit_metadata_row):
-    dri_metadata = {}
-    for k, v in bagit_metadata_row.items():
-        if k == 'Filepath':
-            pass  # used in a function to build dri 'identifier'
-        elif k == 'FileName':
-            dri_metadata['file_name'] = v
-        elif k == 'FileType':
-            if v == 'File':
-                dri_metadata['folder'] = 'file'
-            elif v == 'Folder':
-                dri_metadata['folder'] = 'folder'
-            else:
-                handle_error(k, v)
-        elif k == 'Filesize':
-            pass  # not taken by dri
-        elif k == 'RightsCopyright':
-            if v == 'Crown Copyright':
-                dri_metadata['rights_copyright'] = 'Crown Copyright'
-            else:
-                handle_error(k, v)
-        elif k == 'LegalStatus':
-            if v in ('Public Record', 'Public Record(s)'):
-                dri_metadata['legal_status'] = 'Public Record(s)'
-            else:
-                handle_error(k, v)
-        elif k == 'HeldBy':
-            if v in ('TNA', 'The National Archives, Kew'):
-                dri_metadata['held_by'] = 'The National Archives, Kew'
-            else:
-                handle_error(k, v)
-        elif k == 'Language':
-            if v == 'English':
-                dri_metadata['language'] = 'English'
-            else:
-                handle_error(k, v)
-        elif k == 'FoiExemptionCode':
-            pass  # not used in dri metadata file (related to closure)
-        elif k == 'LastModified':
-            pass  # used in a function to build dri 'last_modified'
-        elif k == 'OriginalFilePath':
-            pass  # not implemented yet
-        else:
-            handle_error(k, v)
-    return dri_metadata
-
-
-def simple_dri_closure(bagit_metadata_row):
-    dri_closure = {}
-    for k, v in bagit_metadata_row.items():
-        if k == 'FileType':
-            if v == 'File':
-                dri_closure['folder'] = 'file'
-            elif v == 'Folder':
-                dri_closure['folder'] = 'folder'
-            else:
-                handle_error(k, v)
-        elif k == 'FoiExemptionCode':
-            if v in ('', 'open'):
-                dri_closure['foi_exemption_code'] = 'open'
-            else:
-                handle_error(k, v)
-        elif k in ('RightsCopyright', 'LegalStatus', 'HeldBy', 'Language', 'LastModified', 'FileName'):
-            pass  # not used in closure
-        elif k == 'Filepath':
-            pass  # used in a function to build dri 'identifier'
-        elif k == 'Filesize':
-            pass  # not taken by dri
-        elif k == 'OriginalFilePath':
-            pass  # not implemented yet
-        else:
-            handle_error(k, v)
-    return dri_closure
+# How each TDR file-metadata.csv column maps to DRI metadata.csv and
+# closure.csv: the DRI field it sets in each (`None` if not used) and the
+# accepted TDR values with their DRI value (`None` to pass any value through)
+DriFieldMapping = collections.namedtuple(
+    'DriFieldMapping', ['metadata', 'closure', 'values'], defaults=(None, None, None))
+
+FOLDER_VALUES = {'File': 'file', 'Folder': 'folder'}
+
+DRI_FIELD_MAPPINGS = {
+    'Filepath': DriFieldMapping(),  # used in a function to build dri 'identifier'
+    'FileName': DriFieldMapping(metadata='file_name'),
+    'FileType': DriFieldMapping(metadata='folder', closure='folder', values=FOLDER_VALUES),
+    'Filesize': DriFieldMapping(),  # not taken by dri
+    'RightsCopyright': DriFieldMapping(
+        metadata='rights_copyright', values={'Crown Copyright': 'Crown Copyright'}),
+    'LegalStatus': DriFieldMapping(
+        metadata='legal_status',
+        values={'Public Record': 'Public Record(s)', 'Public Record(s)': 'Public Record(s)'}),
+    'HeldBy': DriFieldMapping(
+        metadata='held_by',
+        values={'TNA': 'The National Archives, Kew',
+                'The National Archives, Kew': 'The National Archives, Kew'}),
+    'Language': DriFieldMapping(metadata='language', values={'English': 'English'}),
+    'FoiExemptionCode': DriFieldMapping(closure='foi_exemption_code', values={'': 'open', 'open': 'open'}),
+    'LastModified': DriFieldMapping(),  # used in a function to build dri 'last_modified'
+    'OriginalFilePath': DriFieldMapping()  # not implemented yet
+}
+
+# columns needed to build the dri 'identifier', 'folder' and 'last_modified'
+REQUIRED_COLUMNS = ('Filepath', 'FileType')
+
+
+class DriRowTransformer:
+    """
+    Maps the columns of one file-metadata.csv header to DRI metadata and
+    closure columns; built by `compile_row_transformer`.
+    """
+
+    def __init__(self, fieldnames, metadata_mappings, closure_mappings, errors):
+        self.fieldnames = fieldnames
+        self.metadata_mappings = metadata_mappings
+        self.closure_mappings = closure_mappings
+        self.errors = errors
+
+    @staticmethod
+    def convert_column(fieldname, column, values, errors):
+        if values is None:
+            return column
+        converted = [values.get(value) for value in column]
+        for index, dri_value in enumerate(converted):
+            if dri_value is None:
+                # line 1 of file-metadata.csv is its header
+                errors.append(f'Unexpected value "{column[index]}" for "{fieldname}" on line {index + 2}')
+        return converted
+
+    def transform(self, columns):
+        """
+        Return `(metadata_columns, closure_columns)`: dictionaries of DRI
+        field to list of values, converted a whole column at a time from
+        `columns` (CSV column name to list of values). Raises `ValueError`
+        listing every unexpected column or value.
+        """
+        errors = list(self.errors)
+        converted = {}
+        for fieldname, mapping in dict(self.metadata_mappings + self.closure_mappings).items():
+            converted[fieldname] = self.convert_column(fieldname, columns[fieldname], mapping.values, errors)
+
+        if errors:
+            raise ValueError(f'Invalid file metadata ({len(errors)} errors): ' + '; '.join(errors))
+
+        metadata_columns = {mapping.metadata: converted[fieldname] for fieldname, mapping in self.metadata_mappings}
+        closure_columns = {mapping.closure: converted[fieldname] for fieldname, mapping in self.closure_mappings}
+        return metadata_columns, closure_columns
+
+
+@functools.lru_cache(maxsize=8)
+def compile_row_transformer(fieldnames):
+    """
+    Return a `DriRowTransformer` for file-metadata.csv header `fieldnames`
+    (a tuple); the mappings are looked up once per header rather than for
+    every key of every row.
+    """
+    # an empty file-metadata.csv has no columns and nothing to map
+    errors = [f'Missing column "{fieldname}"' for fieldname in REQUIRED_COLUMNS
+              if fieldnames and fieldname not in fieldnames]
+    errors += [f'Unexpected column "{fieldname}"' for fieldname in fieldnames if fieldname not in DRI_FIELD_MAPPINGS]
+    mappings = [(fieldname, DRI_FIELD_MAPPINGS[fieldname]) for fieldname in fieldnames
+                if fieldname in DRI_FIELD_MAPPINGS]
+    return DriRowTransformer(
+        fieldnames=fieldnames,
+        metadata_mappings=tuple((fieldname, mapping) for fieldname, mapping in mappings if mapping.metadata),
+        closure_mappings=tuple((fieldname, mapping) for fieldname, mapping in mappings if mapping.closure),
+        errors=tuple(errors))
 
 
 def dri_config_dict(consignment_reference, consignment_series) -> object:
@@ -99,6 +121,3 @@ def dri_config_dict(consignment_reference, consignment_series) -> object:
         CLOSURE_CHECKSUM_IN_SIP=internal_prefix + closure + '.sha256'
     )
 
-
-def handle_error(k,v):
-    return ValueError("value " + v + "not expected for key " + k)
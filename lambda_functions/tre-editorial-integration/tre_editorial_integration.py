@@ -2,10 +2,10 @@
 import logging
 from s3_lib import common_lib
 from s3_lib import object_lib
-from s3_lib import tar_lib
-from s3_lib import checksum_lib
+from s3_lib import package_lib
+from s3_lib import summary_lib
 import json
-import boto3
+import os
 
 # Set global logging options; AWS environment may override this though
 logging.basicConfig(
@@ -35,6 +35,7 @@ KEY_NUMBER_OF_RETRIES='number-of-retries'
 KEY_BAG_INFO = 'bag-info-txt'
 KEY_JUDGMENT_DOC = 'judgment-document'
 KEY_CONSIGNMENT_TYPE = 'consignment-type'
+KEY_CONSIGNMENT_SUMMARY = 'consignment-summary'
 
 KEY_PARSER_INPUTS = 'parser-inputs'
 KEY_CONSIGNMENT_REF='consignment-reference'
@@ -62,6 +63,19 @@ KEY_PRESIGNED_TAR_GZ_URL = 's3-folder-url'
 KEY_PRESIGNED_TAR_GZ_SHA256_URL = 's3-sha256-url'
 KEY_EDITORIAL_OUTPUT = 'editorial-output'
 
+# Per-consignment state document, next to the TDR retry folders; updated on
+# every write so a retry is resolved without listing the consignment's files
+STATE_FILE = 'editorial-state.json'
+STATE_VERSION = 1
+KEY_STATE_VERSION = 'version'
+KEY_TDR_RETRY = 'tdr-retry'
+KEY_EDITORIAL_RETRY = 'editorial-retry'
+KEY_OUTPUT_MESSAGE = 'output-message'
+# Times to read and update the state if another writer updates it first
+STATE_UPDATE_ATTEMPTS = 3
+# Records of packages by a hash of their inputs, for reuse by TDR retries
+PACKAGE_RECORD_FOLDER = 'packages/'
+
 def handler(event, context):
     """
     Determine input event type (parser or retry) and process accordingly.
@@ -187,6 +201,16 @@ class ParserHandler:
                 f'"{self.parser_inputs[KEY_S3_PREFIX]}" in bucket '
                 f'"{self.parser_inputs[KEY_S3_BUCKET]}".')
 
+        # The output prefix is the consignment's TDR retry folder
+        self.s3_tdr_root, tdr_retry = (self.parser_inputs[KEY_S3_PREFIX]
+            .rstrip(S3_SEP).rsplit(S3_SEP, 1))
+        self.s3_tdr_root += S3_SEP
+        if not tdr_retry.isdigit():
+            raise TEEditorialIntegrationError(
+                f'Expected "{KEY_S3_PREFIX}" to end with a TDR retry number: '
+                f'"{self.parser_inputs[KEY_S3_PREFIX]}"')
+        self.number_of_tdr_retries = int(tdr_retry)
+
         # Set path for editorial output to be retry 0 (always zero for creation via TDR call)
         self.number_of_editorial_retries = 0
         self.s3_output_prefix_ed = (self.parser_inputs[KEY_S3_PREFIX]
@@ -250,14 +274,19 @@ class ParserHandler:
         * Generate a pre-shared URL for the `tar.gz` archive
         * Return JSON output with message for Editorial notification (via
           subsequent SNS step) and save this to s3 for any retry processing
+
+        The files are fetched concurrently and the tar.gz is hashed as it is
+        streamed to s3, so it is not read back; all outputs are written with
+        conditional PUTs (which fail if the object already exists). If an
+        earlier attempt built a package from the same inputs, it is copied
+        instead of being built again.
         """
         logger.info('process start')
 
         # Build list of files to tar
         to_tar_list = []
         prefix = self.parser_inputs[KEY_S3_PREFIX]
-        tre_metadata_file = self.create_tre_metadata_file()
-        to_tar_list.append(tre_metadata_file)
+        tre_metadata_file, tre_metadata_content = self.create_tre_metadata_file()
 
         if self.parser_outputs[KEY_XML] is None:
             logger.info('Parser did not specify an XML output file')
@@ -278,22 +307,33 @@ class ParserHandler:
                 for image in self.parser_outputs[KEY_IMAGES]:
                     to_tar_list.append(prefix + image)
 
-        # Write the list of s3 files to the output tar
+        # Write the metadata file (from memory) and the list of s3 files to
+        # the output tar
+        tar_internal_prefix = f'{self.parser_inputs[KEY_CONSIGNMENT_REF]}/'
+        to_tar_members = [package_lib.PackageMember(
+            tar_internal_prefix + os.path.basename(tre_metadata_file),
+            content=tre_metadata_content)]
+        to_tar_members += [
+            package_lib.PackageMember(
+                tar_internal_prefix + os.path.basename(s3_object_name),
+                s3_object_name=s3_object_name)
+            for s3_object_name in to_tar_list
+        ]
         output_tar_gz = (self.s3_output_prefix_ed + PRODUCER_NAME + '-' 
             + self.parser_inputs[KEY_CONSIGNMENT_REF] + '.tar.gz')
         logger.info(f'output_tar_gz={output_tar_gz}')
-        tar_items = tar_lib.s3_objects_to_s3_tar_gz_file(
+        tar_items, tar_gz_checksum = package_lib.s3_objects_to_s3_tar_gz_package(
             self.parser_inputs[KEY_S3_BUCKET],
-            to_tar_list,
+            to_tar_members,
             output_tar_gz,
-            f'{self.parser_inputs[KEY_CONSIGNMENT_REF]}/')
+            reuse_prefix=self.s3_tdr_root + PACKAGE_RECORD_FOLDER)
 
-        # get the checksum of output_tar_gz and write it to output_tar_gz.sha256
-        tar_gz_checksum = checksum_lib.get_s3_object_checksum(self.parser_inputs[KEY_S3_BUCKET], output_tar_gz)
+        # write the checksum of output_tar_gz to output_tar_gz.sha256
         object_lib.string_to_s3_object(
             f'{tar_gz_checksum} {PRODUCER_NAME}-{self.parser_inputs[KEY_CONSIGNMENT_REF]}.tar.gz',
             self.parser_inputs[KEY_S3_BUCKET],
-            output_tar_gz + KEY_SHA256)
+            output_tar_gz + KEY_SHA256,
+            conditional_put=True)
 
         # Generate a presigned URL for the output tar.gz file
         presigned_tar_gz_url = object_lib.get_s3_object_presigned_url(
@@ -327,12 +367,53 @@ class ParserHandler:
         object_lib.string_to_s3_object(
             json.dumps(output_message),
             self.parser_inputs[KEY_S3_BUCKET],
-            self.s3_output_prefix_ed + OUTPUT_MESSAGE_FILE)
-    
+            self.s3_output_prefix_ed + OUTPUT_MESSAGE_FILE,
+            conditional_put=True)
+
+        self.update_state(output_message)
+
         # Return output message with presigned URL
         logger.info(f'process return')
         return output_message
         
+    def update_state(self, output_message):
+        """
+        Record `output_message` as the consignment's latest state, unless this
+        or a later TDR retry already has been (e.g. by an Editorial retry that
+        found this run's output message). The update is a conditional PUT; if
+        another writer updates the state first, it is read again and the
+        update retried, so the outputs already written are not left without
+        a state.
+        """
+        logger.info('update_state start')
+        state_key = self.s3_tdr_root + STATE_FILE
+        for attempt in range(1, STATE_UPDATE_ATTEMPTS + 1):
+            state, state_etag = object_lib.get_object_json_and_etag(
+                self.parser_inputs[KEY_S3_BUCKET], state_key)
+            if state is not None and state[KEY_TDR_RETRY] >= self.number_of_tdr_retries:
+                logger.info(
+                    f'update_state return: not updated; found TDR retry '
+                    f'{state[KEY_TDR_RETRY]} Editorial retry {state[KEY_EDITORIAL_RETRY]}')
+                return
+            try:
+                object_lib.put_object_json_if_unchanged(
+                    build_editorial_state(
+                        self.number_of_tdr_retries,
+                        self.number_of_editorial_retries,
+                        output_message),
+                    self.parser_inputs[KEY_S3_BUCKET],
+                    state_key,
+                    state_etag)
+                logger.info('update_state return')
+                return
+            except ValueError as e:
+                logger.info(f'State update attempt {attempt} failed: {e}')
+
+        raise TEEditorialIntegrationError(
+            f'Unable to update "{state_key}" in bucket '
+            f'"{self.parser_inputs[KEY_S3_BUCKET]}" after '
+            f'{STATE_UPDATE_ATTEMPTS} attempts')
+
     def get_reference_prefix(self):
         """
         Use producer name + consignment reference as a prefix.
@@ -342,7 +423,7 @@ class ParserHandler:
 
     def create_tre_metadata_file(self):
         """
-        Create the metadata file for the tar and return its path.
+        Create the metadata file for the tar and return its path and content.
         """
         logger.info('create_tre_metadata_file start')
         output_name = self.get_reference_prefix() + FILE_TRE_METADATA
@@ -351,21 +432,40 @@ class ParserHandler:
         
         # Load parser metadata file as dictionary
         parser_metadata = self.get_parser_metadata_file()
-        bagit_info_dict = object_lib.s3_object_to_dictionary(
-            self.parser_inputs[KEY_S3_BUCKET],
-            self.parser_inputs[KEY_S3_PREFIX] + self.context[KEY_BAG_INFO])
+        bagit_info_dict = self.get_bagit_info()
         
         # Create metadata dictionary
         tre_metadata = self.build_tre_metadata(output_name, parser_metadata, bagit_info_dict)
 
         # Save metadata to S3 object (raises error if exists)
+        content = json.dumps(tre_metadata)
         object_lib.string_to_s3_object(
-            json.dumps(tre_metadata),
+            content,
             self.parser_inputs[KEY_S3_BUCKET],
-            s3_path)
+            s3_path,
+            conditional_put=True)
         
         logger.info(f'create_tre_metadata_file return: s3_path={s3_path}')
-        return s3_path
+        return s3_path, content.encode('utf-8')
+
+    def get_bagit_info(self):
+        """
+        Load the bag-info.txt values; from the consignment summary if the
+        prior step provided one, otherwise from the bag-info.txt file.
+        """
+        logger.info('get_bagit_info start')
+        bucket = self.parser_inputs[KEY_S3_BUCKET]
+        prefix = self.parser_inputs[KEY_S3_PREFIX]
+        if self.context.get(KEY_CONSIGNMENT_SUMMARY):
+            summary = summary_lib.read_consignment_summary(
+                bucket, key=prefix + self.context[KEY_CONSIGNMENT_SUMMARY])
+            if summary is not None:
+                logger.info('get_bagit_info return: from consignment summary')
+                return summary[summary_lib.KEY_BAG_INFO]
+
+        logger.info('get_bagit_info return: from bag-info.txt')
+        return object_lib.s3_object_to_dictionary(
+            bucket, prefix + self.context[KEY_BAG_INFO])
 
     def get_parser_metadata_file(self):
         """
@@ -378,8 +478,7 @@ class ParserHandler:
 
         bucket = self.parser_inputs[KEY_S3_BUCKET]
         key = self.parser_inputs[KEY_S3_PREFIX] + self.parser_outputs[KEY_PARSER_METADATA]
-        s3_object = object_lib.get_object(bucket, key)
-        parser_metadata = json.loads(s3_object['Body'].read())
+        parser_metadata = object_lib.get_object_json(bucket, key)
         logger.info(f'get_parser_metadata_file return {parser_metadata}')
         return parser_metadata
 
@@ -474,47 +573,32 @@ class RetryHandler:
         Return new output message with regenerated presigned URL and updated
         number-of-retries field values. Save a copy of the message in case
         subsequent retries are received.
+
+        The latest retries and output message are read from the consignment's
+        state document (one GET) and the retry is claimed by updating it with
+        a conditional PUT; so a duplicate retry message fails, and the cost
+        does not grow with the number of attempts. Consignments without a
+        state document fall back to listing their folders.
         """
         logger.info('process start')
 
-        # Prior TDR stage number-of-retries is unknown when get an Editorial retry
-        # message, so use the count in the TDR input path to find the latest one
         s3_tdr_root = (self.s3_object_root
             + self.event[KEY_CONSIGNMENT_TYPE] + S3_SEP
             + self.event[KEY_CONSIGNMENT_REF] + S3_SEP)
-        
-        latest_tdr_retry = object_lib.get_max_s3_subfolder_number(
-            self.s3_bucket, s3_tdr_root)
+        state_key = s3_tdr_root + STATE_FILE
+        state, state_etag = object_lib.get_object_json_and_etag(self.s3_bucket, state_key)
+        if state is None:
+            state = self.get_state_from_folders(s3_tdr_root)
 
-        if latest_tdr_retry is None:
-            raise TEEditorialIntegrationError('No TDR output data found')
-        
-        latest_tdr_retry = int(latest_tdr_retry)
-
-        # Get last editorial retry number from S3 ("should" exist from TDR "retry" 0)
-        ed_root = s3_tdr_root + str(latest_tdr_retry) + S3_SEP
-        last_s3_ed_retry = object_lib.get_max_s3_subfolder_number(
-            self.s3_bucket, ed_root)
-
-        # Abort if no prior Editorial retry found (should be at least 0 from TDR stage)
-        if last_s3_ed_retry is None:
-            raise TEEditorialIntegrationError('No Editorial output data found')
-
-        # Abort if message number-of-retries value is not the expected value
-        expected_ed_retry = int(last_s3_ed_retry) + 1
+        # Abort if message number-of-retries value is not the expected value
+        expected_ed_retry = state[KEY_EDITORIAL_RETRY] + 1
 
         if int(self.event[KEY_NUMBER_OF_RETRIES]) != int(expected_ed_retry) :
             raise TEEditorialIntegrationError(
                 f'Expected number-of-retries to be "{expected_ed_retry}" '
                 f'but got "{self.event[KEY_NUMBER_OF_RETRIES]}"')
 
-        # Read last message
-        bucket = self.s3_bucket
-        key = ed_root + str(last_s3_ed_retry) + S3_SEP + OUTPUT_MESSAGE_FILE
-        logger.info(f'getting prior output_message bucket={bucket} key={key}')
-        s3c = boto3.client('s3')
-        s3_object = s3c.get_object(Bucket=bucket, Key=key)
-        output_message = json.loads(s3_object['Body'].read())
+        output_message = state[KEY_OUTPUT_MESSAGE]
 
         # Regenerate presigned URLS
         presigned_tar_gz_url = object_lib.get_s3_object_presigned_url(
@@ -526,17 +610,78 @@ class RetryHandler:
             key=output_message[KEY_TAR_GZ][KEY_KEY] + KEY_SHA256,
             expiry=env_tre_presigned_url_expiry)
 
-        # Update output message with new presigned URLs and retry counter
+        # Update output message with new presigned URLs and retry counter
         output_message[KEY_EDITORIAL_OUTPUT][KEY_PRESIGNED_TAR_GZ_URL] = presigned_tar_gz_url
         output_message[KEY_EDITORIAL_OUTPUT][KEY_PRESIGNED_TAR_GZ_SHA256_URL] = presigned_tar_gz_sha256_url
         output_message[KEY_EDITORIAL_OUTPUT][KEY_NUMBER_OF_RETRIES] = expected_ed_retry
 
-        # Save new output message (for any subsequent retries to update again)
+        # Claim this retry number (fails if another retry got there first)
+        object_lib.put_object_json_if_unchanged(
+            build_editorial_state(state[KEY_TDR_RETRY], expected_ed_retry, output_message),
+            self.s3_bucket,
+            state_key,
+            state_etag)
+
+        # Save new output message alongside the prior attempts' messages
+        ed_root = s3_tdr_root + str(state[KEY_TDR_RETRY]) + S3_SEP
         output_key = ed_root + str(expected_ed_retry) + S3_SEP + OUTPUT_MESSAGE_FILE
         object_lib.string_to_s3_object(
             string=json.dumps(output_message),
             target_bucket_name=output_message[KEY_TAR_GZ][KEY_BUCKET],
-            target_object_name=output_key)
+            target_object_name=output_key,
+            conditional_put=True)
 
         logger.info('process return')
         return output_message
+
+    def get_state_from_folders(self, s3_tdr_root):
+        """
+        Return the consignment's state from its latest TDR retry and Editorial
+        retry folders; for consignments processed before the state document
+        was added.
+        """
+        logger.info('get_state_from_folders start')
+
+        # Prior TDR stage number-of-retries is unknown when get an Editorial retry
+        # message, so use the count in the TDR input path to find the latest one
+        latest_tdr_retry = object_lib.get_max_s3_subfolder_number(
+            self.s3_bucket, s3_tdr_root)
+
+        if latest_tdr_retry is None:
+            raise TEEditorialIntegrationError('No TDR output data found')
+        
+        latest_tdr_retry = int(latest_tdr_retry)
+
+        # Get last editorial retry number from S3 ("should" exist from TDR "retry" 0)
+        ed_root = s3_tdr_root + str(latest_tdr_retry) + S3_SEP
+        last_s3_ed_retry = object_lib.get_max_s3_subfolder_number(
+            self.s3_bucket, ed_root)
+
+        # Abort if no prior Editorial retry found (should be at least 0 from TDR stage)
+        if last_s3_ed_retry is None:
+            raise TEEditorialIntegrationError('No Editorial output data found')
+
+        # Read last message
+        bucket = self.s3_bucket
+        key = ed_root + str(last_s3_ed_retry) + S3_SEP + OUTPUT_MESSAGE_FILE
+        logger.info(f'getting prior output_message bucket={bucket} key={key}')
+        output_message = object_lib.get_object_json(bucket, key)
+
+        logger.info('get_state_from_folders return')
+        return build_editorial_state(latest_tdr_retry, int(last_s3_ed_retry), output_message)
+
+def build_editorial_state(tdr_retry, editorial_retry, output_message):
+    """
+    Return the consignment's state document for its latest TDR retry number,
+    Editorial retry number and output message.
+    """
+    return {
+        KEY_STATE_VERSION: STATE_VERSION,
+        KEY_TDR_RETRY: tdr_retry,
+        KEY_EDITORIAL_RETRY: editorial_retry,
+        KEY_TAR_GZ: {
+            KEY_BUCKET: output_message[KEY_TAR_GZ][KEY_BUCKET],
+            KEY_KEY: output_message[KEY_TAR_GZ][KEY_KEY]
+        },
+        KEY_OUTPUT_MESSAGE: output_message
+    }
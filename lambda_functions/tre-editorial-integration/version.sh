@@ -1,6 +1,6 @@
 #!/usr/bin/env bash
 docker_image_name=tre-editorial-integration
-docker_image_tag=0.0.21
+docker_image_tag=0.0.31
 # shellcheck disable=SC2034  # var imported elsewhere
 docker_image="${docker_image_name}":"${docker_image_tag}"
 # shellcheck disable=SC2034  # var imported elsewhere
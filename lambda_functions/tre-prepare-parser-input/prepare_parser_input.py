@@ -6,7 +6,8 @@ import requests
 import base64
 import json
 
-from s3_lib import object_lib, common_lib
+from s3_lib import object_lib, common_lib, summary_lib
+from tre_lib import claim_check
 
 # Set global logging options; AWS environment may override this though
 logging.basicConfig(
@@ -22,6 +23,8 @@ KEY_ERROR = "error"
 KEY_ERROR_MESSAGE = "error-message"
 KEY_S3_PARSER_BUCKET = "dev-te-judgment-out"
 KEY_NUM_RETRIES = "number-of-retries"
+KEY_CONSIGNMENT_SUMMARY = "consignment-summary"
+FILE_CONSIGNMENT_SUMMARY = "consignment-summary.json"
 
 ENV_PRESIGNED_URL_EXPIRY = common_lib.get_env_var('TE_PRESIGNED_URL_EXPIRY', must_exist=True, must_have_value=True)
 
@@ -71,7 +74,9 @@ def handler(event, context):
         },
     }
 
-    Output message structure; `error-message` only present if `error` is True:
+    Output message structure; `error-message` only present if `error` is True
+    and context `consignment-summary` only present if the validation step saved
+    a consignment summary (see `s3_lib.summary_lib`):
 
     {
         "context" : {
@@ -79,7 +84,8 @@ def handler(event, context):
             "s3-bagit-name": "bag-info.txt",
             "judgment-document": "judgment.docx",
             "consignment-type": "judgment",
-            "bagit-info": "bag-info.txt"
+            "bagit-info": "bag-info.txt",
+            "consignment-summary": "consignment-summary.json"
             },
         "parser-inputs": {
             "consignment-reference": "ABC-123",
@@ -120,14 +126,18 @@ def handler(event, context):
         # get document from s3
         S3_resource = boto3.resource("s3")
 
+        # validated-files may be a claim-check pointer for large bags
+        validated_files = claim_check.resolve(
+            event.get("validated-files"), claim_check.S3ClaimCheckStore())
+
         # get judgment filename
-        path = event.get("validated-files").get("data")[0]
+        path = validated_files.get("data")[0]
         filename = os.path.basename(path)
 
         #  copy judgment to parser bucket
         source = {
             "Bucket": s3_bucket,
-            "Key": event.get("validated-files").get("data")[0],
+            "Key": path,
         }
         dest = S3_resource.Bucket(KEY_S3_PARSER_BUCKET)
         dest.copy(
@@ -142,7 +152,7 @@ def handler(event, context):
         # copy bagit to parser bucket
         source = {
             "Bucket": s3_bucket,
-            "Key": f"{event.get('validated-files').get('path')}/bagit.txt",
+            "Key": f"{validated_files.get('path')}/bagit.txt",
         }
         dest = S3_resource.Bucket(KEY_S3_PARSER_BUCKET)
         dest.copy(
@@ -155,7 +165,7 @@ def handler(event, context):
         # copy bagit-info to parser bucket
         source = {
             "Bucket": s3_bucket,
-            "Key": f"{event.get('validated-files').get('path')}/bag-info.txt",
+            "Key": f"{validated_files.get('path')}/bag-info.txt",
         }
         dest = S3_resource.Bucket(KEY_S3_PARSER_BUCKET)
         dest.copy(
@@ -165,6 +175,20 @@ def handler(event, context):
 
         logger.info("Successfully copied bag-info.")
 
+        # copy consignment summary (if validation step saved one) to parser bucket
+        parser_output_prefix = f"parsed/{event['output-message']['consignment-type']}/{event['output-message']['consignment-reference']}/{event['output-message']['number-of-retries']}/"
+        summary_copied = False
+        if "s3-object-root" in event:
+            summary_key = summary_lib.get_summary_key(event["s3-object-root"])
+            if object_lib.s3_object_exists(s3_bucket, summary_key):
+                copy_s3_file(
+                    S3_resource,
+                    s3_bucket,
+                    KEY_S3_PARSER_BUCKET,
+                    summary_key,
+                    parser_output_prefix + FILE_CONSIGNMENT_SUMMARY)
+                summary_copied = True
+
         # create presigned url for judgment document
         document_url = object_lib.get_s3_object_presigned_url(
                 KEY_S3_PARSER_BUCKET,
@@ -179,6 +203,9 @@ def handler(event, context):
             "bag-info-txt": "bag-info.txt", 
         }
 
+        if summary_copied:
+            output["context"][KEY_CONSIGNMENT_SUMMARY] = FILE_CONSIGNMENT_SUMMARY
+
         output["parser-inputs"] = {
             "consignment-reference": event["output-message"]["consignment-reference"],
             "s3-bucket": KEY_S3_PARSER_BUCKET,
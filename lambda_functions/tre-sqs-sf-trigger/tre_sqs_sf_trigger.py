@@ -74,10 +74,9 @@ def get_latest_uuid(tre_event: dict) -> str:
         if isinstance(uuid_list, list):
             if len(uuid_list) > 0:
                 latest_uuid_dict = uuid_list[-1]
-                key_count = len(latest_uuid_dict.keys())
+                key_count = len(latest_uuid_dict)
                 if key_count == 1:
-                    uuid_key = list(latest_uuid_dict.keys())[0]
-                    return latest_uuid_dict[uuid_key]
+                    return next(iter(latest_uuid_dict.values()))
                 else:
                     raise ValueError(f'UUID key count is {key_count}, not 1')
             else:
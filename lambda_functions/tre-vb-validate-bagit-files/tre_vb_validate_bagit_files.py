@@ -1,10 +1,12 @@
 #!/usr/bin/env python3
 import logging
 import os
-from s3_lib import checksum_lib
-from s3_lib import tar_lib
-from s3_lib import object_lib
+from s3_lib import bagit_lib
+from s3_lib import checkpoint_lib
 from s3_lib import common_lib
+from s3_lib import summary_lib
+from tre_lib import claim_check
+from tre_lib import timing
 from tre_event_lib import tre_event_api
 
 # Set global logging options; AWS environment may override this though
@@ -24,6 +26,14 @@ env_process = common_lib.get_env_var(
     'TRE_PROCESS_NAME', must_exist=True, must_have_value=True)
 env_environment = common_lib.get_env_var(
     'TRE_ENVIRONMENT', must_exist=True, must_have_value=True)
+# Opt-in: the tre_event_lib bagit-validated schema has no claim-check form,
+# so large values are only offloaded if a threshold is set
+env_claim_check_threshold = common_lib.get_env_var(
+    'TRE_CLAIM_CHECK_THRESHOLD_BYTES', must_exist=False, must_have_value=False)
+env_claim_check_threshold = int(env_claim_check_threshold) if env_claim_check_threshold else None
+env_deduplicate = (common_lib.get_env_var(
+    'TRE_DEDUPLICATE_EXTRACTION', must_exist=False, must_have_value=False)
+    or 'true').lower() == 'true'
 
 EVENT_NAME_INPUT = 'bagit-received'
 EVENT_NAME_OUTPUT_OK = 'bagit-validated'
@@ -37,14 +47,147 @@ KEY_S3_OBJECT_ROOT = 's3-object-root'
 KEY_VALIDATED_FILES = 'validated-files'
 
 
+def get_unpacked_paths(s3_bagit_name):
+    """
+    Return the output prefix (the BagIt's existing path prefix, if any) and
+    the unpacked folder name (the BagIt's name without `.tar.gz`).
+    """
+    output_prefix = os.path.split(s3_bagit_name)[0]
+    output_prefix = output_prefix + \
+        '/' if len(output_prefix) > 0 else output_prefix
+    suffix = '.tar.gz'
+    unpacked_folder_name = s3_bagit_name[:-len(suffix)] if s3_bagit_name.endswith(suffix) else s3_bagit_name
+    return output_prefix, unpacked_folder_name
+
+
+def get_prior_attempts_prefix(output_prefix):
+    """
+    Return the prefix holding the folders of all attempts of a consignment
+    (i.e. the parent of this attempt's `output_prefix`), or `None`.
+    """
+    parent = os.path.dirname(output_prefix.rstrip('/'))
+    return parent + '/' if len(parent) > 0 else None
+
+
+def create_output_ok(event, input_params, unpacked_folder_name, validation):
+    """
+    Save the consignment summary for a successful `validation` and return
+    the `bagit-validated` event.
+    """
+    s3_bucket = input_params[KEY_S3_BUCKET]
+    checksum_ok_list = validation.get_validated_files()
+    logger.info('checksum_ok_list=%s', checksum_ok_list)
+
+    # Save one summary of the bag for downstream steps to load
+    consignment_summary = summary_lib.build_consignment_summary(
+        s3_bucket, unpacked_folder_name, validation.get_object_sizes(),
+        tag_manifest=validation.tag_manifest,
+        data_manifest=validation.data_manifest,
+        bag_info=validation.get_bag_info(),
+        metadata=validation.get_file_metadata())
+    summary_key = summary_lib.write_consignment_summary(consignment_summary)
+    logger.info('summary_key=%s', summary_key)
+
+    output_block = {
+        KEY_REFERENCE: input_params[KEY_REFERENCE],
+        KEY_S3_BUCKET: s3_bucket,
+        KEY_S3_BAGIT_NAME: input_params[KEY_S3_BAGIT_NAME],
+        KEY_S3_OBJECT_ROOT: unpacked_folder_name,
+        KEY_VALIDATED_FILES: checksum_ok_list
+    }
+    # If enabled, large values (e.g. validated-files for big bags) are saved
+    # to s3 and replaced with a claim-check pointer to keep the event small
+    if env_claim_check_threshold is not None:
+        output_block = claim_check.offload_large_values(
+            block=output_block,
+            store=claim_check.S3ClaimCheckStore(bucket=s3_bucket),
+            key_prefix=f'{unpacked_folder_name}.claim-checks/',
+            threshold=env_claim_check_threshold)
+    output_parameter_block = {
+        EVENT_NAME_OUTPUT_OK: output_block
+    }
+
+    return tre_event_api.create_event(
+        environment=env_environment,
+        producer=env_producer,
+        process=env_process,
+        event_name=EVENT_NAME_OUTPUT_OK,
+        prior_event=event,
+        parameters=output_parameter_block
+    )
+
+
+def create_output_error(event, consignment_reference, errors):
+    """
+    Return a `bagit-validation-error` event with the given `errors`.
+    """
+    output_parameter_block = {
+        EVENT_NAME_OUTPUT_ERROR: {
+            KEY_REFERENCE: consignment_reference,
+            KEY_ERRORS: errors
+        }
+    }
+
+    return tre_event_api.create_event(
+        environment=env_environment,
+        producer=env_producer,
+        process=env_process,
+        event_name=EVENT_NAME_OUTPUT_ERROR,
+        prior_event=event,
+        parameters=output_parameter_block
+    )
+
+
+def create_output_event(event, input_params, unpacked_folder_name, validate):
+    """
+    Call `validate` to get a `bagit_lib.BagValidation` and return the
+    `bagit-validated` or `bagit-validation-error` event for it; a ValueError
+    raised at any stage gives a `bagit-validation-error` event. If
+    validation stopped at a checkpoint, the input `event` is returned with
+    the continuation to resume from instead.
+    """
+    try:
+        validation = validate()
+        if not validation.is_complete:
+            logger.info('continuation=%s', validation.continuation)
+            return checkpoint_lib.set_continuation(event, validation.continuation)
+        if not validation.is_valid:
+            raise ValueError('; '.join(validation.get_errors()))
+        event_output_ok = create_output_ok(
+            event, input_params, unpacked_folder_name, validation)
+        logger.info(f'event_output_ok:\n%s\n', event_output_ok)
+        return event_output_ok
+    except ValueError as e:
+        logging.error('handler error: %s', str(e))
+        event_output_error = create_output_error(
+            event, input_params[KEY_REFERENCE], [str(e)])
+        logger.info(f'event_output_error:\n%s\n', event_output_error)
+        return event_output_error
+
+
 def handler(event, context):
     """
     Given input fields `s3-bucket` and `s3-bagit-name` in `event`:
 
-    * untar s3://`s3-bucket`/`s3-bagit-name` in place with existing path prefix
-    * verify checksums of extracted tar's root files using file tagmanifest-sha256.txt
-    * verify checksums of extracted tar's data directory files using file manifest-sha256.txt
-    * verify the number of extracted files matches the numbers in the 2 manifest files
+    * pre-flight check the tar headers against bag-info.txt's Payload-Oxum
+      and the manifests' file lists, so malformed, truncated or corrupt
+      BagIts are rejected before anything is extracted
+    * untar s3://`s3-bucket`/`s3-bagit-name` in place with existing path
+      prefix, calculating each file's checksum as it is extracted; files
+      already extracted by an earlier attempt of the consignment (or earlier
+      in the BagIt) are copied server-side rather than uploaded again (unless
+      `TRE_DEDUPLICATE_EXTRACTION` is `false`)
+    * verify the extracted files exactly match the files and checksums in
+      tagmanifest-sha256.txt and manifest-sha256.txt; any missing,
+      unexpected or mismatched files are named in the error
+    * save a consignment summary (bag-info, manifests, sizes and file metadata)
+      for downstream steps; see `summary_lib`
+
+    If the Lambda is close to its timeout before every file is extracted,
+    progress is saved to s3 and the input event is returned with a
+    `continuation` field; invoking the handler again with that output
+    resumes from the saved progress (e.g. loop while `$.continuation` is
+    present). This is how bags too large for one invocation are validated.
 
     Expected Input:
     * A `bagit-received` event
@@ -52,123 +195,49 @@ def handler(event, context):
     Output:
     * A `bagit-validated` event if validation is successful
     * A `bagit-validation-error` event if validation fails
+    * The input event with a `continuation` (and the timing ledger so far)
+      if validation is not finished
     """
     logger.info('handler start"')
     logger.info('type(event)="%s', type(event))
     logger.info('event="%s"', event)
+    # Remove the input's timing ledger (if any) before validation; this
+    # hop's record is appended and the ledger is carried over to the output
+    # event if TRE_TIMING_IN_BAND is set (otherwise it is logged)
+    timing_ledger, hop_timer = timing.start_hop(event, stage=env_process)
+    continuation = checkpoint_lib.pop_continuation(event)
     tre_event_api.validate_event(event=event, schema_name=EVENT_NAME_INPUT)
 
     # Get required values from input event's parameters block
     input_params = event[tre_event_api.KEY_PARAMETERS][EVENT_NAME_INPUT]
-    consignment_reference = input_params[KEY_REFERENCE]
     s3_bucket = input_params[KEY_S3_BUCKET]
     s3_bagit_name = input_params[KEY_S3_BAGIT_NAME]
 
-
-    output_parameter_values = {}
-
-    try:
-        # Unpack tar in temporary bucket; use path prefix, if there is one
-        output_prefix = os.path.split(s3_bagit_name)[0]
-        output_prefix = output_prefix + \
-            '/' if len(output_prefix) > 0 else output_prefix
-        extracted_object_list = tar_lib.untar_s3_object(
-            s3_bucket, s3_bagit_name, output_prefix=output_prefix)
-        logger.info('extracted_object_list=%s', extracted_object_list)
-
-        # Verify extracted tar content checksums
-        suffix = '.tar.gz'
-        unpacked_folder_name = s3_bagit_name[:-len(suffix)] if s3_bagit_name.endswith(suffix) else s3_bagit_name
-        output_parameter_values[KEY_S3_OBJECT_ROOT] = unpacked_folder_name
-        checksum_ok_list = checksum_lib.verify_s3_manifest_checksums(
-            s3_bucket, unpacked_folder_name)
-        logger.info('checksum_ok_list=%s', checksum_ok_list)
-        output_parameter_values[KEY_VALIDATED_FILES] = checksum_ok_list
-
-        # Determine expected file counts (from manifest files)
-        # not main manifest itself
-        manifest_root_count = len(checksum_ok_list['root'])
-        manifest_data_count = len(checksum_ok_list['data'])
-        # +1 file here as root manifest doesn't include itself (Catch-22...)
-        manifests_total_count = 1 + manifest_root_count + manifest_data_count
-
-        # Determine how many files were extracted from the archive
-        extracted_total_count = len(extracted_object_list)
-
-        # Determine how many of the extracted files are in the data sub-directory
-        data_dir = f'{unpacked_folder_name}/data/'
-        data_dir_files = [
-            i for i in extracted_object_list if i.startswith(data_dir)]
-        extracted_data_count = len(data_dir_files)
-
+    # Unpack tar in temporary bucket; use path prefix, if there is one
+    output_prefix, unpacked_folder_name = get_unpacked_paths(s3_bagit_name)
+
+    def validate():
+        # Extract and hash each file in one pass, then compare the extracted
+        # files with the manifests (no s3 re-reads or listing)
+        validation = bagit_lib.untar_and_validate_s3_object(
+            s3_bucket, s3_bagit_name, bag_root=unpacked_folder_name,
+            output_prefix=output_prefix,
+            deadline=checkpoint_lib.Deadline(context),
+            checkpoint=checkpoint_lib.Checkpoint(
+                s3_bucket, checkpoint_lib.get_checkpoint_key(unpacked_folder_name)),
+            resume=continuation is not None,
+            deduplicate=env_deduplicate,
+            prior_prefix=get_prior_attempts_prefix(output_prefix))
+        logger.info('profile=%s', validation.profile)
+        logger.info('plan=%s', validation.plan)
+        logger.info('copied=%s', validation.copied)
         logger.info(
-            'manifest_root_count=%s manifest_data_count=%s '
-            'manifests_total_count=%s extracted_total_count=%s '
-            'extracted_data_count=%s data_dir_files=%s',
-            manifest_root_count, manifest_data_count, manifests_total_count,
-            extracted_total_count, extracted_data_count, data_dir_files)
-
-        # Confirm untar output file count matches combined manifests' file count
-        if extracted_total_count != manifests_total_count:
-            raise ValueError(
-                f'Incorrect total file count; {manifests_total_count} in '
-                f'manifest, but {extracted_total_count} found')
-
-        # Confirm correct number of files in extracted data sub-directory
-        if manifest_data_count != extracted_data_count:
-            raise ValueError(
-                f'Incorrect data file count; {manifest_data_count} in manifest'
-                f'but {extracted_data_count} found')
-
-        # Verify there are no additional unexpected files in the s3 location
-        s3_check_dir = f'{unpacked_folder_name}/'
-        s3_check_list = object_lib.s3_ls(s3_bucket, s3_check_dir)
-        s3_check_list_count = len(s3_check_list)
-        logger.info('s3_check_list_count=%s s3_check_dir=%s',
-                    s3_check_list_count, s3_check_dir)
-        if s3_check_list_count != extracted_total_count:
-            raise ValueError(
-                f'Incorrect data file count; {extracted_total_count} extracted'
-                f'but {s3_check_list_count} found')
-
-        output_parameter_block = {
-            EVENT_NAME_OUTPUT_OK: {
-                KEY_REFERENCE: consignment_reference,
-                KEY_S3_BUCKET: s3_bucket,
-                KEY_S3_BAGIT_NAME: s3_bagit_name,
-                KEY_S3_OBJECT_ROOT: unpacked_folder_name,
-                KEY_VALIDATED_FILES: checksum_ok_list
-            }
-        }
-
-        event_output_ok = tre_event_api.create_event(
-            environment=env_environment,
-            producer=env_producer,
-            process=env_process,
-            event_name=EVENT_NAME_OUTPUT_OK,
-            prior_event=event,
-            parameters=output_parameter_block
-        )
-
-        logger.info(f'event_output_ok:\n%s\n', event_output_ok)
-        return event_output_ok
-    except ValueError as e:
-        logging.error('handler error: %s', str(e))
-        output_parameter_block = {
-            EVENT_NAME_OUTPUT_ERROR: {
-                KEY_REFERENCE: consignment_reference,
-                KEY_ERRORS: [str(e)]
-            }
-        }
+            'extracted_object_list=%s', validation.extracted_object_names)
+        return validation
 
-        event_output_error = tre_event_api.create_event(
-            environment=env_environment,
-            producer=env_producer,
-            process=env_process,
-            event_name=EVENT_NAME_OUTPUT_ERROR,
-            prior_event=event,
-            parameters=output_parameter_block
-        )
+    output_event = create_output_event(
+        event, input_params, unpacked_folder_name, validate)
+    # A continuation re-invokes this step, so it keeps the ledger in-band
+    in_band = True if checkpoint_lib.KEY_CONTINUATION in output_event else None
+    return timing.finish_hop(output_event, timing_ledger, hop_timer, in_band=in_band)
 
-        logger.info(f'event_output_error:\n%s\n', event_output_error)
-        return event_output_error
@@ -4,10 +4,15 @@ Lambda handler for validate-bagit Step Function step.
 """
 import logging
 import os
+import concurrent.futures
+import boto3
 from urllib.parse import urlparse
 from s3_lib import common_lib
 from s3_lib import checksum_lib
+from s3_lib import dedup_lib
 from s3_lib import object_lib
+from s3_lib import idempotency_lib
+from tre_lib import timing
 from tre_event_lib import tre_event_api
 
 # Set global logging options; AWS environment may override this though
@@ -38,6 +43,105 @@ KEY_RESOURCE = 'resource'
 KEY_RESOURCE_VALIDATION = 'resource-validation'
 KEY_VALUE = 'value'
 KEY_S3_BAGIT_NAME = 's3-bagit-name'
+KEY_S3_SHA_NAME = 's3-sha-name'
+
+# Prior results by consignment reference and BagIt checksum, so duplicate
+# input events (resends, repeated SQS deliveries) are not processed again
+idempotency_store = idempotency_lib.get_store(bucket=env_output_bucket)
+idempotency_index = (
+    None if idempotency_store is None
+    else idempotency_lib.IdempotencyIndex(idempotency_store))
+# Created before any hop starts, so passed to the hop timer to be counted
+timed_clients = (
+    [idempotency_store.s3_client]
+    if isinstance(idempotency_store, idempotency_lib.S3MarkerStore) else [])
+
+
+def prior_result_exists(prior_result):
+    """
+    Return `True` if the BagIt and checksum file copies of an earlier run's
+    `prior_result` still exist.
+    """
+    bucket = prior_result[tre_event_api.KEY_S3_BUCKET]
+    return all(
+        name is not None and name in object_lib.s3_ls(bucket, name)
+        for name in (prior_result[KEY_S3_BAGIT_NAME], prior_result.get(KEY_S3_SHA_NAME)))
+
+
+def get_prior_result(consignment_reference, checksum):
+    """
+    Return the recorded result of an earlier run for the same BagIt, or
+    `None` if there is none or its files no longer exist.
+    """
+    if idempotency_index is None:
+        return None
+    return idempotency_index.lookup(
+        consignment_reference, checksum, is_available=prior_result_exists)
+
+
+def record_result(consignment_reference, checksum, result):
+    """
+    Record `result` for the BagIt, unless an earlier run's result is already
+    recorded.
+    """
+    if idempotency_index is not None:
+        idempotency_index.record(consignment_reference, checksum, result)
+
+
+def copy_prior_result(prior_result, s3_bagit_name, s3_sha_name):
+    """
+    Copy the BagIt and checksum files of an earlier run's `prior_result` to
+    this run's `s3_bagit_name` and `s3_sha_name` server-side and return this
+    run's result, or `None` if either file has since been removed.
+
+    Each run keeps its own copy, so the steps after this one never share an
+    output prefix with another execution.
+    """
+    s3_client = boto3.client('s3')
+    prior_bucket = prior_result[tre_event_api.KEY_S3_BUCKET]
+    for source_name, target_name in (
+            (prior_result[KEY_S3_BAGIT_NAME], s3_bagit_name),
+            (prior_result[KEY_S3_SHA_NAME], s3_sha_name)):
+        source = dedup_lib.ContentSource(prior_bucket, source_name, size=None)
+        if not dedup_lib.copy_s3_object(s3_client, source, env_output_bucket, target_name):
+            return None
+
+    return {
+        tre_event_api.KEY_S3_BUCKET: env_output_bucket,
+        KEY_S3_BAGIT_NAME: s3_bagit_name,
+        KEY_S3_SHA_NAME: s3_sha_name
+    }
+
+
+def copy_and_verify(
+        s3_bagit_url, s3_bagit_name, s3_sha_url, s3_sha_name, expected_checksum):
+    """
+    Copy the BagIt and checksum files to s3 and return the result (their s3
+    locations).
+
+    Both files are copied concurrently; the BagIt is hashed as it is streamed
+    into s3 and its upload is aborted if the checksum does not match, so it
+    does not need to be read back from s3 to be verified.
+    """
+    logger.info(f'Copy "{s3_bagit_url}" to "{s3_bagit_name}" and '
+                f'"{s3_sha_url}" to "{s3_sha_name}" '
+                f'in "{env_output_bucket}"')
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        copy_bagit = executor.submit(
+            object_lib.url_to_s3_object,
+            s3_bagit_url, env_output_bucket, s3_bagit_name,
+            expected_checksum=expected_checksum)
+        copy_sha = executor.submit(
+            object_lib.url_to_s3_object,
+            s3_sha_url, env_output_bucket, s3_sha_name)
+        copy_bagit.result()
+        copy_sha.result()
+
+    return {
+        tre_event_api.KEY_S3_BUCKET: env_output_bucket,
+        KEY_S3_BAGIT_NAME: s3_bagit_name,
+        KEY_S3_SHA_NAME: s3_sha_name
+    }
 
 
 def handler(event, context):
@@ -45,6 +149,15 @@ def handler(event, context):
     Saves the BagIt and checksum files in the input's pre-signed URLs to S3
     and validates the BagIt's checksum matches the checksum file.
 
+    The checksum file is read first; the BagIt is then hashed as it is
+    streamed into S3 (concurrently with the checksum file's copy), so it is
+    only read once.
+
+    If the same BagIt (consignment reference and checksum) has already been
+    received, the earlier run's verified copies are copied server-side into
+    this run's folder instead of being fetched and hashed again (see
+    `idempotency_lib`).
+
     Expected Input:
     * A `bagit-available` event
 
@@ -55,6 +168,10 @@ def handler(event, context):
     logger.info('handler start')
     logger.info(f'type(event)="%s', type(event))
     logger.info(f'event:\n%s\n', event)
+    # Remove the input's timing ledger (if any) before validation; this
+    # hop's record is appended and the ledger is carried over to the output
+    # event if TRE_TIMING_IN_BAND is set (otherwise it is logged)
+    timing_ledger, hop_timer = timing.start_hop(event, stage=env_process, clients=timed_clients)
     tre_event_api.validate_event(event=event, schema_name=EVENT_NAME_INPUT)
 
     # Get required values from input event's parameter block
@@ -64,7 +181,7 @@ def handler(event, context):
     s3_sha_url = input_params[KEY_RESOURCE_VALIDATION][KEY_VALUE]
     consignment_type = event[tre_event_api.KEY_PRODUCER][tre_event_api.KEY_TYPE]
     # Get latest (last) UUID value from UUIDs list (list of dict)
-    event_uuid = list(event[tre_event_api.KEY_UUIDS][-1].values())[0]
+    event_uuid = next(iter(event[tre_event_api.KEY_UUIDS][-1].values()))
     logger.info(f'event_uuid=%s\n', event_uuid)
 
     try:
@@ -84,29 +201,20 @@ def handler(event, context):
         s3_sha_name = f'{output_object_prefix}/{sha_name}'
         logger.info(f's3_sha_name=%s\n', s3_sha_name)
 
-        # Copy files
-        logger.info(f'Copy "{s3_bagit_url}" to "{s3_bagit_name}" '
-                    f'in "{env_output_bucket}"')
-        object_lib.url_to_s3_object(
-            s3_bagit_url, env_output_bucket, s3_bagit_name)
-        logger.info(f'Copy "{s3_sha_url}" to "{s3_sha_name}" '
-                    f'in "{env_output_bucket}"')
-        object_lib.url_to_s3_object(s3_sha_url, env_output_bucket, s3_sha_name)
-
-        # Load checksum(s) from the s3 manifest; there should be only 1 here
-        s3_sha_manifest = checksum_lib.get_manifest_s3(
-            env_output_bucket, s3_sha_name)
+        # Load checksum(s) from the (small) checksum file first, so the
+        # BagIt is only fetched if the checksum file is valid for it
+        sha_manifest = checksum_lib.get_manifest_url(s3_sha_url)
 
         # Only expect 1 checksum; verify this is so
-        checksum_count = len(s3_sha_manifest)
+        checksum_count = len(sha_manifest)
         if checksum_count != 1:
             raise ValueError(
                 f'Incorrect number of checksums; expected '
                 f'1, found {checksum_count}')
 
-        manifest_file = s3_sha_manifest[0][checksum_lib.ITEM_FILE]
-        manifest_basename = s3_sha_manifest[0][checksum_lib.ITEM_BASENAME]
-        expected_checksum = s3_sha_manifest[0][checksum_lib.ITEM_CHECKSUM]
+        manifest_file = sha_manifest[0][checksum_lib.ITEM_FILE]
+        manifest_basename = sha_manifest[0][checksum_lib.ITEM_BASENAME]
+        expected_checksum = sha_manifest[0][checksum_lib.ITEM_CHECKSUM]
 
         # Verify the file (basename) from the checksum file is in the s3 URL
         if manifest_basename != bagit_name:
@@ -115,17 +223,24 @@ def handler(event, context):
                 f'entry "{manifest_file}") does not match the value '
                 f'"{bagit_name}" (derived from the input URL)')
 
-        # Validate the main checksum
-        checksum_lib.verify_s3_object_checksum(
-            env_output_bucket,
-            s3_bagit_name,
-            expected_checksum)
+        # If this BagIt has already been received, copy the earlier run's
+        # verified files rather than fetching and hashing them again
+        result = None
+        prior_result = get_prior_result(consignment_reference, expected_checksum)
+        if prior_result is not None:
+            logger.info(f'Duplicate input; copying prior result {prior_result}')
+            result = copy_prior_result(prior_result, s3_bagit_name, s3_sha_name)
+        if result is None:
+            result = copy_and_verify(
+                s3_bagit_url, s3_bagit_name, s3_sha_url, s3_sha_name,
+                expected_checksum)
+            record_result(consignment_reference, expected_checksum, result)
 
         output_parameter_block = {
             EVENT_NAME_OUTPUT_OK: {
                 tre_event_api.KEY_REFERENCE: consignment_reference,
-                tre_event_api.KEY_S3_BUCKET: env_output_bucket,
-                KEY_S3_BAGIT_NAME: s3_bagit_name
+                tre_event_api.KEY_S3_BUCKET: result[tre_event_api.KEY_S3_BUCKET],
+                KEY_S3_BAGIT_NAME: result[KEY_S3_BAGIT_NAME]
             }
         }
 
@@ -136,7 +251,8 @@ def handler(event, context):
             event_name=EVENT_NAME_OUTPUT_OK,
             prior_event=event,
             parameters=output_parameter_block)
-        
+
+        timing.finish_hop(event_output_ok, timing_ledger, hop_timer)
         logger.info(f'event_output_ok:\n%s\n', event_output_ok)
         return event_output_ok
     except ValueError as e:
@@ -157,5 +273,6 @@ def handler(event, context):
             parameters=output_parameter_block
         )
 
+        timing.finish_hop(event_output_error, timing_ledger, hop_timer)
         logger.info(f'event_output_error:\n%s\n', event_output_error)
         return event_output_error
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+Claim-check support for TRE message parameter blocks.
+
+Values in a parameter block whose JSON form exceeds a size threshold are
+written to a store as gzip compressed JSON and replaced with a small, typed
+pointer:
+
+    {
+        "claim-check": {
+            "type": "application/json+gzip",
+            "s3-bucket": "...",
+            "s3-key": "...",
+            "sha256": "...",
+            "size": 123456
+        }
+    }
+
+Consumers wrap a parameter block with `LazyParameters`; pointers are only
+fetched (and verified) when the corresponding value is actually read.
+"""
+import logging
+import json
+import gzip
+import hashlib
+import collections.abc
+
+logger = logging.getLogger(__name__)
+
+KEY_CLAIM_CHECK = 'claim-check'
+KEY_TYPE = 'type'
+KEY_S3_BUCKET = 's3-bucket'
+KEY_S3_KEY = 's3-key'
+KEY_SHA256 = 'sha256'
+KEY_SIZE = 'size'
+CLAIM_CHECK_TYPE = 'application/json+gzip'
+DEFAULT_THRESHOLD_BYTES = 128 * 1024
+
+
+class ClaimCheckError(Exception):
+    """
+    Used to indicate a claim-check could not be stored or resolved.
+    """
+
+
+class InMemoryClaimCheckStore:
+    """
+    Claim-check store held in a dictionary; for local use and tests.
+    """
+    def __init__(self, bucket: str = 'memory'):
+        self.bucket = bucket
+        self.objects = {}
+
+    def put(self, key: str, data: bytes) -> dict:
+        self.objects[(self.bucket, key)] = data
+        return {KEY_S3_BUCKET: self.bucket, KEY_S3_KEY: key}
+
+    def get(self, bucket: str, key: str) -> bytes:
+        try:
+            return self.objects[(bucket, key)]
+        except KeyError:
+            raise ClaimCheckError(f'Claim-check "{key}" not found in "{bucket}"')
+
+
+class S3ClaimCheckStore:
+    """
+    Claim-check store in AWS s3; boto3 is only imported when this is used.
+    """
+    def __init__(self, bucket: str = None, s3_client=None):
+        self.bucket = bucket
+        self.s3_client = s3_client
+
+    def client(self):
+        if self.s3_client is None:
+            import boto3
+            self.s3_client = boto3.client('s3')
+        return self.s3_client
+
+    def put(self, key: str, data: bytes) -> dict:
+        if not self.bucket:
+            raise ClaimCheckError('No s3 bucket set for claim-check store')
+        self.client().put_object(
+            Bucket=self.bucket, Key=key, Body=data,
+            ContentType='application/json', ContentEncoding='gzip')
+        return {KEY_S3_BUCKET: self.bucket, KEY_S3_KEY: key}
+
+    def get(self, bucket: str, key: str) -> bytes:
+        return self.client().get_object(Bucket=bucket, Key=key)['Body'].read()
+
+
+def is_claim_check(value) -> bool:
+    """
+    Return True if `value` is a claim-check pointer.
+    """
+    return (
+        isinstance(value, dict)
+        and len(value) == 1
+        and isinstance(value.get(KEY_CLAIM_CHECK), dict)
+    )
+
+
+def offload(value, store, key: str) -> dict:
+    """
+    Write `value` to `store` at `key` as gzip compressed JSON and return a
+    claim-check pointer to it.
+    """
+    data = json.dumps(value, separators=(',', ':')).encode()
+    location = store.put(key, gzip.compress(data, mtime=0))
+    pointer = {
+        KEY_CLAIM_CHECK: {
+            KEY_TYPE: CLAIM_CHECK_TYPE,
+            KEY_S3_BUCKET: location[KEY_S3_BUCKET],
+            KEY_S3_KEY: location[KEY_S3_KEY],
+            KEY_SHA256: hashlib.sha256(data).hexdigest(),
+            KEY_SIZE: len(data)
+        }
+    }
+    logger.info(f'offload: pointer={pointer}')
+    return pointer
+
+
+def offload_large_values(
+    block: dict,
+    store,
+    key_prefix: str,
+    threshold: int = DEFAULT_THRESHOLD_BYTES
+) -> dict:
+    """
+    Return a copy of parameter `block` with any value whose JSON form is
+    larger than `threshold` bytes replaced by a claim-check pointer. Stored
+    objects are named `key_prefix` + the value's key + `.json.gz`.
+    """
+    output = {}
+    for name, value in block.items():
+        size = len(json.dumps(value, separators=(',', ':')))
+        if size > threshold and not is_claim_check(value):
+            logger.info(f'Offloading "{name}"; size {size} > threshold {threshold}')
+            output[name] = offload(value, store, f'{key_prefix}{name}.json.gz')
+        else:
+            output[name] = value
+    return output
+
+
+def resolve(value, store):
+    """
+    Return `value`, or the content it points to if it is a claim-check. The
+    content's SHA-256 digest is verified.
+    """
+    if not is_claim_check(value):
+        return value
+
+    pointer = value[KEY_CLAIM_CHECK]
+    if pointer.get(KEY_TYPE) != CLAIM_CHECK_TYPE:
+        raise ClaimCheckError(f'Unsupported claim-check type "{pointer.get(KEY_TYPE)}"')
+
+    logger.info(f'resolve: pointer={pointer}')
+    data = gzip.decompress(store.get(pointer[KEY_S3_BUCKET], pointer[KEY_S3_KEY]))
+    if hashlib.sha256(data).hexdigest() != pointer[KEY_SHA256]:
+        raise ClaimCheckError(
+            f'Checksum mismatch for claim-check "{pointer[KEY_S3_KEY]}" in '
+            f'"{pointer[KEY_S3_BUCKET]}"')
+    return json.loads(data)
+
+
+class LazyParameters(collections.abc.Mapping):
+    """
+    Read-only view of a parameter block that resolves claim-check values on
+    first access and caches the result.
+    """
+    def __init__(self, block: dict, store):
+        self.block = block
+        self.store = store
+        self.resolved = {}
+
+    def __getitem__(self, name):
+        if name not in self.resolved:
+            self.resolved[name] = resolve(self.block[name], self.store)
+        return self.resolved[name]
+
+    def __iter__(self):
+        return iter(self.block)
+
+    def __len__(self):
+        return len(self.block)
@@ -6,9 +6,19 @@ import logging
 import uuid
 import json
 import os
+import hashlib
+import re
 import time
 import pkgutil
-from jsonschema import validate
+import functools
+from jsonschema.validators import validator_for
+
+try:
+    from tre_lib import claim_check
+    from tre_lib import timing
+except ImportError:  # running from this directory; e.g. unit tests
+    import claim_check
+    import timing
 
 logger = logging.getLogger(__name__)
 
@@ -44,9 +54,16 @@ class Message():
     KEY_EVENT_NAME = 'event-name'
     KEY_ENVIRONMENT = 'environment'
     KEY_PARAMETERS = 'parameters'
+    KEY_UUIDS_FOLDED = 'UUIDs-folded'
+    CLAIM_CHECK_PREFIX = 'claim-checks/'
+    KEY_COUNT = 'count'
+    KEY_SHA256 = 'sha256'
+    KEY_TIMINGS = timing.KEY_TIMINGS
+
+    SCHEMA_NAME = 'schema.json'
 
     @staticmethod
-    def get_schema(schema_name: str = 'schema.json'):
+    def get_schema(schema_name: str = SCHEMA_NAME):
         return json.loads(
             pkgutil.get_data(
                 package=__name__,
@@ -54,6 +71,109 @@ class Message():
             ).decode()
         )
 
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def get_validator(schema_name: str = SCHEMA_NAME):
+        """
+        Return a compiled validator for `schema_name`; the schema is loaded
+        and checked once per process, then the validator is reused.
+        """
+        logger.info(f'get_validator: compiling schema_name={schema_name}')
+        schema = Message.get_schema(schema_name)
+        validator_class = validator_for(schema)
+        validator_class.check_schema(schema)
+        return validator_class(schema)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def get_structure_rules(schema_name: str = SCHEMA_NAME):
+        """
+        Return the `StructureRules` read from `schema_name`; loaded once per
+        process.
+        """
+        return StructureRules(Message.get_schema(schema_name))
+
+    @classmethod
+    def is_valid_structure(cls, message) -> bool:
+        """
+        Fast-path check of `message` against the rules in `schema.json` for
+        the common event types, without invoking jsonschema. The keys,
+        enumerations and patterns checked are read from the schema (see
+        `StructureRules`). Returns `False` if the message does not match
+        (use the full validator for the detail).
+        """
+        rules = cls.get_structure_rules()
+        if not isinstance(message, dict):
+            return False
+        if not rules.message_keys_required <= message.keys() <= rules.message_keys:
+            return False
+        if not isinstance(message[cls.KEY_VERSION], str):
+            return False
+        timestamp = message[cls.KEY_TIMESTAMP]
+        if not isinstance(timestamp, int) or isinstance(timestamp, bool):
+            return False
+
+        uuids = message[cls.KEY_UUIDS]
+        if not isinstance(uuids, list) or len(uuids) == 0:
+            return False
+        for uuid_item in uuids:
+            if not isinstance(uuid_item, dict):
+                return False
+            for key, value in uuid_item.items():
+                if not rules.uuid_key_pattern.match(key):
+                    return False
+                if not isinstance(value, str) or not rules.uuid_value_pattern.match(value):
+                    return False
+
+        if cls.KEY_PRODUCER in message:
+            producer = message[cls.KEY_PRODUCER]
+            if not isinstance(producer, dict):
+                return False
+            if not rules.producer_keys_required <= producer.keys() <= rules.producer_keys:
+                return False
+            for key in (cls.KEY_NAME, cls.KEY_PROCESS, cls.KEY_ENVIRONMENT):
+                if not isinstance(producer[key], str):
+                    return False
+            if producer[cls.KEY_TYPE] not in rules.consignment_types:
+                return False
+            if producer[cls.KEY_EVENT_NAME] not in rules.event_names:
+                return False
+            if cls.KEY_VERSION in producer and not isinstance(producer[cls.KEY_VERSION], (str, dict)):
+                return False
+
+        if cls.KEY_UUIDS_FOLDED in message:
+            folded = message[cls.KEY_UUIDS_FOLDED]
+            if not isinstance(folded, dict) or not rules.folded_keys_required <= folded.keys() <= rules.folded_keys:
+                return False
+            count = folded[cls.KEY_COUNT]
+            if not isinstance(count, int) or isinstance(count, bool) or count < 1:
+                return False
+            if not isinstance(folded[cls.KEY_SHA256], str) or not rules.sha256_pattern.match(folded[cls.KEY_SHA256]):
+                return False
+
+        if cls.KEY_TIMINGS in message and not timing.is_valid_ledger(message[cls.KEY_TIMINGS]):
+            return False
+
+        parameters = message[cls.KEY_PARAMETERS]
+        if not isinstance(parameters, dict):
+            return False
+        for key, value in parameters.items():
+            if key not in rules.parameter_names or not isinstance(value, dict):
+                return False
+
+        return True
+
+    @classmethod
+    def validate_message(cls, message, schema_name: str = SCHEMA_NAME, fast_path: bool = True):
+        """
+        Raise a jsonschema ValidationError if `message` is not valid for
+        `schema_name`. If `fast_path` is True, messages that pass
+        `is_valid_structure` are accepted without running the full validator.
+        """
+        if fast_path and schema_name == cls.SCHEMA_NAME and cls.is_valid_structure(message):
+            return
+        cls.get_validator(schema_name).validate(message)
+
     def validate_input(
         self,
         environment: str,
@@ -79,8 +199,7 @@ class Message():
         elif parameters and not isinstance(parameters, dict):
             raise ValueError(f'parameters is not dict type')
         elif prior_message is not None:
-            validate(instance=prior_message,
-                     schema=Message.get_schema())
+            Message.validate_message(prior_message)
 
     def __init__(
             self,
@@ -91,7 +210,11 @@ class Message():
             parameters: dict = None,
             type: str = None,
             prior_message: dict = None,
-            timestamp_ns_utc: int = None
+            timestamp_ns_utc: int = None,
+            uuid_history_keep: int = None,
+            claim_check_store=None,
+            claim_check_threshold: int = claim_check.DEFAULT_THRESHOLD_BYTES,
+            timing_record: dict = None
     ):
         """
         Validate input, initialise new message object.
@@ -115,6 +238,19 @@ class Message():
             parameter, etc)
         timestamp_ns_utc: int
             Optional alternate timestamp value (nanoseconds UTC)
+        uuid_history_keep: int
+            Optional cap on the UUID history; if set, only the first and last
+            `uuid_history_keep` UUIDs are kept and those in between are folded
+            into the `UUIDs-folded` count and chained SHA-256 digest
+        claim_check_store:
+            Optional claim-check store (see `claim_check`); if set, parameter
+            values larger than `claim_check_threshold` bytes are written to
+            the store and replaced with claim-check pointers
+        claim_check_threshold: int
+            Size in bytes above which parameter values are offloaded
+        timing_record: dict
+            Optional record for this hop (e.g. from `timing.HopTimer.stop`)
+            to append to the timing ledger carried over from prior_message
         """
         logger.info('__init__')
         self.validate_input(
@@ -139,10 +275,21 @@ class Message():
         else:
             # Use [:] to copy (not reference) prior UUIDs
             self.new_message[self.KEY_UUIDS] = prior_message[self.KEY_UUIDS][:]
-            self.new_message[self.KEY_UUIDS] = prior_message[self.KEY_UUIDS][:]
+            if self.KEY_UUIDS_FOLDED in prior_message:
+                self.new_message[self.KEY_UUIDS_FOLDED] = dict(
+                    prior_message[self.KEY_UUIDS_FOLDED])
 
         self.new_message[self.KEY_UUIDS].append({self.uuid_key: self.uuid})
 
+        if uuid_history_keep is not None:
+            self.fold_uuid_history(uuid_history_keep)
+
+        if timing_record is not None or (prior_message and self.KEY_TIMINGS in prior_message):
+            ledger = timing.get_ledger(prior_message or {})
+            if timing_record is not None:
+                timing.append_record(ledger, timing_record)
+            self.new_message[self.KEY_TIMINGS] = ledger
+
         self.new_message[self.KEY_PRODUCER] = {}
         self.new_message[self.KEY_PRODUCER][self.KEY_ENVIRONMENT] = environment
         self.new_message[self.KEY_PRODUCER][self.KEY_NAME] = producer
@@ -160,8 +307,87 @@ class Message():
 
         if parameters is None:
             self.new_message[self.KEY_PARAMETERS] = {}
-        else:
+        elif claim_check_store is None:
             self.new_message[self.KEY_PARAMETERS] = parameters
+        else:
+            self.new_message[self.KEY_PARAMETERS] = {
+                block_name: claim_check.offload_large_values(
+                    block=block,
+                    store=claim_check_store,
+                    key_prefix=f'{self.CLAIM_CHECK_PREFIX}{self.uuid}/{block_name}/',
+                    threshold=claim_check_threshold)
+                for block_name, block in parameters.items()
+            }
+
+    def fold_uuid_history(self, keep: int):
+        """
+        Keep the first and last `keep` UUIDs; fold any in between into the
+        `UUIDs-folded` record, whose digest chains from any prior fold so the
+        full history remains verifiable.
+        """
+        if keep < 1:
+            raise ValueError('uuid_history_keep must be at least 1')
+
+        uuids = self.new_message[self.KEY_UUIDS]
+        if len(uuids) <= 2 * keep:
+            return
+
+        to_fold = uuids[keep:-keep]
+        self.new_message[self.KEY_UUIDS] = uuids[:keep] + uuids[-keep:]
+        prior_fold = self.new_message.get(self.KEY_UUIDS_FOLDED, {})
+        digest = hashlib.sha256(prior_fold.get(self.KEY_SHA256, '').encode())
+        digest.update(json.dumps(to_fold, separators=(',', ':'), sort_keys=True).encode())
+        self.new_message[self.KEY_UUIDS_FOLDED] = {
+            self.KEY_COUNT: prior_fold.get(self.KEY_COUNT, 0) + len(to_fold),
+            self.KEY_SHA256: digest.hexdigest()
+        }
+        logger.info(f'Folded {len(to_fold)} UUIDs: {self.new_message[self.KEY_UUIDS_FOLDED]}')
+
+    @staticmethod
+    def get_latest_uuid_item(message: dict) -> tuple:
+        """
+        Return the (key, value) pair of `message`'s latest UUID; e.g.
+        ('TRE-UUID', '...'). Raises ValueError if there isn't exactly one.
+        """
+        uuids = message.get(Message.KEY_UUIDS)
+        if not isinstance(uuids, list) or len(uuids) == 0:
+            raise ValueError(f'Key "{Message.KEY_UUIDS}" missing or empty')
+        latest = uuids[-1]
+        if len(latest) != 1:
+            raise ValueError(f'UUID key count is {len(latest)}, not 1')
+        return next(iter(latest.items()))
+
+    @staticmethod
+    def get_latest_uuid(message: dict) -> str:
+        """
+        Return the value of `message`'s latest UUID.
+        """
+        return Message.get_latest_uuid_item(message)[1]
+
+    @staticmethod
+    def get_uuid_history_length(message: dict) -> int:
+        """
+        Return the number of UUIDs in `message`'s history, including any that
+        have been folded.
+        """
+        folded = message.get(Message.KEY_UUIDS_FOLDED, {})
+        return len(message[Message.KEY_UUIDS]) + folded.get(Message.KEY_COUNT, 0)
+
+    @staticmethod
+    def get_parameters(message: dict, block_name: str, claim_check_store) -> claim_check.LazyParameters:
+        """
+        Return parameter block `block_name` of `message` as a read-only
+        mapping that fetches any claim-check values only when they are read.
+        """
+        return claim_check.LazyParameters(
+            message[Message.KEY_PARAMETERS][block_name], claim_check_store)
+
+    @staticmethod
+    def get_timing_breakdown(message: dict) -> str:
+        """
+        Return a per-hop latency breakdown of `message`'s timing ledger.
+        """
+        return timing.render_breakdown(message)
 
     def to_json_str(self, indent=None) -> str:
         return json.dumps(self.new_message, indent=indent)
@@ -170,5 +396,36 @@ class Message():
         return self.new_message
 
 
+class StructureRules():
+    """
+    The required and allowed keys, enumerations and patterns of a message
+    `schema` (e.g. `schema.json`) that `Message.is_valid_structure` checks.
+    Value types (and the timing ledger, see `timing.is_valid_ledger`) are
+    checked in code.
+    """
+    def __init__(self, schema: dict):
+        properties = schema['properties']
+        self.message_keys_required = frozenset(schema['required'])
+        self.message_keys = frozenset(properties)
+
+        producer = properties[Message.KEY_PRODUCER]
+        self.producer_keys_required = frozenset(producer['required'])
+        self.producer_keys = frozenset(producer['properties'])
+        self.consignment_types = tuple(producer['properties'][Message.KEY_TYPE]['enum'])
+        self.event_names = tuple(producer['properties'][Message.KEY_EVENT_NAME]['enum'])
+
+        uuid_properties = properties[Message.KEY_UUIDS]['items']['patternProperties']
+        (uuid_key_pattern, uuid_value), = uuid_properties.items()
+        self.uuid_key_pattern = re.compile(uuid_key_pattern)
+        self.uuid_value_pattern = re.compile(uuid_value['pattern'])
+
+        folded = properties[Message.KEY_UUIDS_FOLDED]
+        self.folded_keys_required = frozenset(folded['required'])
+        self.folded_keys = frozenset(folded['properties'])
+        self.sha256_pattern = re.compile(folded['properties'][Message.KEY_SHA256]['pattern'])
+
+        self.parameter_names = frozenset(properties[Message.KEY_PARAMETERS]['properties'])
+
+
 if __name__ == "__main__":
     setup_logging(default_level=logging.INFO)
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+Benchmark TRE message validation throughput (messages/second).
+
+Compares the original per-message `jsonschema.validate` call (schema reloaded
+and validator rebuilt each time) with the cached compiled validator and the
+fast-path structural check.
+
+Run from the parent directory with: python3 -m tests.benchmark_message
+"""
+import time
+import jsonschema
+from message import Message
+
+MESSAGE_COUNT = 2000
+
+
+def build_prior_message(uuid_count: int = 5) -> dict:
+    message = Message(
+        producer='TRE',
+        process='benchmark',
+        type='judgment',
+        event_name='bagit-validated',
+        environment='benchmark',
+        parameters={'bagit-validated': {'reference': 'ABC-123'}})
+    for _ in range(uuid_count - 1):
+        message = Message(
+            producer='TRE',
+            process='benchmark',
+            event_name='bagit-validated',
+            environment='benchmark',
+            parameters={'bagit-validated': {'reference': 'ABC-123'}},
+            prior_message=message.to_dict())
+    return message.to_dict()
+
+
+def uncached(message: dict):
+    jsonschema.validate(instance=message, schema=Message.get_schema())
+
+
+def cached_full(message: dict):
+    Message.validate_message(message, fast_path=False)
+
+
+def cached_fast_path(message: dict):
+    Message.validate_message(message, fast_path=True)
+
+
+def run(name: str, function, message: dict, count: int = MESSAGE_COUNT):
+    function(message)  # warm up (e.g. compile cached validator)
+    start = time.perf_counter()
+    for _ in range(count):
+        function(message)
+    elapsed = time.perf_counter() - start
+    rate = count / elapsed
+    print(f'{name:<24} {rate:>12,.0f} messages/second')
+    return rate
+
+
+if __name__ == '__main__':
+    prior_message = build_prior_message()
+    baseline = run('uncached validate', uncached, prior_message)
+    full = run('cached validator', cached_full, prior_message)
+    fast = run('cached + fast path', cached_fast_path, prior_message)
+    print(f'cached validator speed-up   : {full / baseline:.1f}x')
+    print(f'cached + fast path speed-up : {fast / baseline:.1f}x')
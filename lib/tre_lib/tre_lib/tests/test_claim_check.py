@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Module to test TRE claim-check code.
+
+Run from the parent directory with: python3 -m unittest discover ./tests
+"""
+import unittest
+import json
+import gzip
+import claim_check
+from message import Message
+
+
+class TestClaimCheck(unittest.TestCase):
+    PRODUCER = 'TRE'
+    EVENT_NAME = 'bagit-validated'
+    THRESHOLD = 1024
+
+    def build_parameters(self, file_count: int) -> dict:
+        return {
+            self.EVENT_NAME: {
+                'reference': 'ABC-123',
+                'validated-files': {
+                    'path': 'consignments/ABC-123',
+                    'root': ['consignments/ABC-123/bag-info.txt'],
+                    'data': [
+                        f'consignments/ABC-123/data/file-{i}.docx'
+                        for i in range(file_count)
+                    ]
+                }
+            }
+        }
+
+    def test_small_values_not_offloaded(self):
+        store = claim_check.InMemoryClaimCheckStore()
+        parameters = self.build_parameters(file_count=1)
+        message = Message(
+            producer=self.PRODUCER,
+            process='p',
+            type='judgment',
+            event_name=self.EVENT_NAME,
+            environment='e',
+            parameters=parameters,
+            claim_check_store=store,
+            claim_check_threshold=self.THRESHOLD)
+
+        self.assertEqual(message.to_dict()[Message.KEY_PARAMETERS], parameters)
+        self.assertEqual(len(store.objects), 0)
+
+    def test_large_values_offloaded_and_resolved_lazily(self):
+        store = claim_check.InMemoryClaimCheckStore()
+        parameters = self.build_parameters(file_count=500)
+        message = Message(
+            producer=self.PRODUCER,
+            process='p',
+            type='judgment',
+            event_name=self.EVENT_NAME,
+            environment='e',
+            parameters=parameters,
+            claim_check_store=store,
+            claim_check_threshold=self.THRESHOLD)
+
+        block = message.to_dict()[Message.KEY_PARAMETERS][self.EVENT_NAME]
+        self.assertEqual(block['reference'], 'ABC-123')
+        self.assertTrue(claim_check.is_claim_check(block['validated-files']))
+        self.assertLess(len(message.to_json_str()), self.THRESHOLD)
+        Message.get_validator().validate(message.to_dict())
+
+        # Nothing is fetched until the offloaded value is read
+        fetched = []
+        store_get = store.get
+        store.get = lambda bucket, key: fetched.append(key) or store_get(bucket, key)
+        lazy = Message.get_parameters(message.to_dict(), self.EVENT_NAME, store)
+        self.assertEqual(lazy['reference'], 'ABC-123')
+        self.assertEqual(len(fetched), 0)
+        self.assertEqual(
+            lazy['validated-files'],
+            parameters[self.EVENT_NAME]['validated-files'])
+        self.assertEqual(lazy['validated-files']['data'][0], 'consignments/ABC-123/data/file-0.docx')
+        self.assertEqual(len(fetched), 1)
+
+    def test_corrupt_claim_check_rejected(self):
+        store = claim_check.InMemoryClaimCheckStore()
+        pointer = claim_check.offload({'a': 1}, store, 'k')
+        store.put('k', gzip.compress(json.dumps({'a': 2}).encode()))
+        with self.assertRaises(claim_check.ClaimCheckError):
+            claim_check.resolve(pointer, store)
@@ -5,6 +5,8 @@ Module to test TRE message code.
 Run from this directory with: python3 -m unittest
 """
 import unittest
+import copy
+from jsonschema import ValidationError
 from message import Message
 import json
 import uuid
@@ -226,5 +228,160 @@ class TestMessage(unittest.TestCase):
         self.assertTrue(len(m2.new_message[Message.KEY_UUIDS]) == 2,
                         'm2 UUIDs list len is not 2')
 
+    def test_validator_is_cached(self):
+        self.assertIs(
+            Message.get_validator(), Message.get_validator(),
+            'Validator was not reused')
+
+    def test_fast_path_agrees_with_full_validation(self):
+        """
+        Run `is_valid_structure` and the full schema validator over the same
+        valid and invalid messages; they must agree on every one.
+        """
+        valid = Message(
+            producer=self.PRODUCER,
+            process='p',
+            type=self.TYPE_JUDGMENT,
+            event_name=self.EVENT_NAME,
+            environment='e',
+            parameters={self.EVENT_NAME: {'reference': 'ABC-123'}}).to_dict()
+
+        def variant(change):
+            message = copy.deepcopy(valid)
+            change(message)
+            return message
+
+        producer = Message.KEY_PRODUCER
+        folded = {Message.KEY_COUNT: 3, Message.KEY_SHA256: 'a' * 64}
+        hop = {'stage': 's', 'start-ns': 1, 'end-ns': 2}
+        valid_messages = {
+            'minimal': valid,
+            'no producer': variant(lambda m: m.pop(producer)),
+            'no type': variant(lambda m: m[producer].update({Message.KEY_TYPE: None})),
+            'producer version object': variant(
+                lambda m: m[producer].update({Message.KEY_VERSION: {'a': '1'}})),
+            'empty parameters': variant(lambda m: m.update({Message.KEY_PARAMETERS: {}})),
+            'folded': variant(lambda m: m.update({Message.KEY_UUIDS_FOLDED: folded})),
+            'timings': variant(lambda m: m.update({Message.KEY_TIMINGS: {'hops': [hop]}})),
+        }
+        invalid_messages = {
+            'not a dict': [],
+            'extra key': variant(lambda m: m.update({'unexpected': 1})),
+            'no version': variant(lambda m: m.pop(Message.KEY_VERSION)),
+            'version not string': variant(lambda m: m.update({Message.KEY_VERSION: 1})),
+            'timestamp string': variant(lambda m: m.update({Message.KEY_TIMESTAMP: '1'})),
+            'no UUIDs': variant(lambda m: m.update({Message.KEY_UUIDS: []})),
+            'UUID item not dict': variant(lambda m: m[Message.KEY_UUIDS].append('x')),
+            'bad UUID key': variant(
+                lambda m: m[Message.KEY_UUIDS].append({'TRE-ID': str(uuid.uuid4())})),
+            'bad UUID': variant(
+                lambda m: m[Message.KEY_UUIDS].append({'TRE-UUID': 'not-a-uuid'})),
+            'producer missing key': variant(lambda m: m[producer].pop(Message.KEY_PROCESS)),
+            'producer extra key': variant(lambda m: m[producer].update({'x': 'y'})),
+            'producer name not string': variant(
+                lambda m: m[producer].update({Message.KEY_NAME: 1})),
+            'bad type': variant(lambda m: m[producer].update({Message.KEY_TYPE: 'x'})),
+            'bad event name': variant(
+                lambda m: m[producer].update({Message.KEY_EVENT_NAME: 'x'})),
+            'producer version number': variant(
+                lambda m: m[producer].update({Message.KEY_VERSION: 1})),
+            'folded missing sha256': variant(
+                lambda m: m.update({Message.KEY_UUIDS_FOLDED: {Message.KEY_COUNT: 1}})),
+            'folded count zero': variant(lambda m: m.update({
+                Message.KEY_UUIDS_FOLDED: dict(folded, **{Message.KEY_COUNT: 0})})),
+            'folded bad sha256': variant(lambda m: m.update({
+                Message.KEY_UUIDS_FOLDED: dict(folded, **{Message.KEY_SHA256: 'x'})})),
+            'timings no hops': variant(lambda m: m.update({Message.KEY_TIMINGS: {}})),
+            'timings bad hop': variant(lambda m: m.update({
+                Message.KEY_TIMINGS: {'hops': [dict(hop, **{'end-ns': 'x'})]}})),
+            'parameters not dict': variant(lambda m: m.update({Message.KEY_PARAMETERS: []})),
+            'unknown parameters': variant(
+                lambda m: m[Message.KEY_PARAMETERS].update({'x': {}})),
+            'parameters value not dict': variant(
+                lambda m: m[Message.KEY_PARAMETERS].update({self.EVENT_NAME: 1})),
+        }
+
+        for name, message in valid_messages.items():
+            with self.subTest(name):
+                self.assertTrue(Message.is_valid_structure(message))
+                Message.get_validator().validate(message)
+
+        for name, message in invalid_messages.items():
+            with self.subTest(name):
+                self.assertFalse(Message.is_valid_structure(message))
+                with self.assertRaises(ValidationError):
+                    Message.validate_message(message)
+
+    def test_structure_rules_read_from_schema(self):
+        rules = Message.get_structure_rules()
+        self.assertIs(rules, Message.get_structure_rules(), 'Rules were not reused')
+        schema = Message.get_schema()
+        self.assertEqual(rules.message_keys, frozenset(schema['properties']))
+        self.assertEqual(
+            rules.event_names,
+            tuple(schema['properties'][Message.KEY_PRODUCER]['properties'][Message.KEY_EVENT_NAME]['enum']))
+
+    def test_invalid_prior_message(self):
+        with self.assertRaises(ValidationError):
+            Message(
+                producer=self.PRODUCER,
+                process='p',
+                type=self.TYPE_JUDGMENT,
+                event_name=self.EVENT_NAME,
+                environment='e',
+                prior_message={Message.KEY_VERSION: '0.0.2'})
+
+    def test_uuid_history_folding(self):
+        KEEP = 2
+        HOPS = 10
+        messages = [
+            Message(
+                producer=self.PRODUCER,
+                process='p',
+                type=self.TYPE_JUDGMENT,
+                event_name=self.EVENT_NAME,
+                environment='e')
+        ]
+
+        for _ in range(HOPS - 1):
+            messages.append(
+                Message(
+                    producer=self.PRODUCER,
+                    process='p',
+                    event_name=self.EVENT_NAME,
+                    environment='e',
+                    prior_message=messages[-1].to_dict(),
+                    uuid_history_keep=KEEP))
+
+        first = messages[0].to_dict()
+        last = messages[-1].to_dict()
+        self.assertEqual(len(last[Message.KEY_UUIDS]), 2 * KEEP)
+        self.assertEqual(last[Message.KEY_UUIDS][0], first[Message.KEY_UUIDS][0])
+        self.assertEqual(
+            last[Message.KEY_UUIDS_FOLDED][Message.KEY_COUNT], HOPS - 2 * KEEP)
+        self.assertEqual(Message.get_uuid_history_length(last), HOPS)
+        self.assertEqual(Message.get_latest_uuid(last), messages[-1].uuid)
+        self.assertEqual(
+            Message.get_latest_uuid_item(last),
+            (f'{self.PRODUCER}-UUID', messages[-1].uuid))
+        self.assertTrue(Message.is_valid_structure(last))
+        Message.get_validator().validate(last)
+
+    def test_uuid_history_not_folded_by_default(self):
+        m1 = Message(
+            producer=self.PRODUCER,
+            process='p',
+            type=self.TYPE_JUDGMENT,
+            event_name=self.EVENT_NAME,
+            environment='e')
+        m2 = Message(
+            producer=self.PRODUCER,
+            process='p',
+            event_name=self.EVENT_NAME,
+            environment='e',
+            prior_message=m1.to_dict())
+        self.assertNotIn(Message.KEY_UUIDS_FOLDED, m2.to_dict())
+        self.assertEqual(len(m2.to_dict()[Message.KEY_UUIDS]), 2)
+
 
 setup_logging(default_level=logging.INFO)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+Module to test TRE message timing ledger code.
+
+Run from the parent directory with: python3 -m unittest discover ./tests
+"""
+import unittest
+import io
+import timing
+from message import Message
+
+
+class TestTiming(unittest.TestCase):
+    PRODUCER = 'TRE'
+    EVENT_NAME = 'bagit-validated'
+
+    def build_message(self, stage: str, prior_message: dict = None, start_ns: int = 0) -> dict:
+        return Message(
+            producer=self.PRODUCER,
+            process=stage,
+            type='judgment',
+            event_name=self.EVENT_NAME,
+            environment='e',
+            prior_message=prior_message,
+            timing_record=timing.build_record(
+                stage=stage,
+                start_ns=start_ns,
+                end_ns=start_ns + 2_000_000,
+                bytes_read=10,
+                bytes_written=20,
+                s3_requests=3)).to_dict()
+
+    def test_ledger_accumulates_per_hop(self):
+        m1 = self.build_message('stage-1')
+        m2 = self.build_message('stage-2', prior_message=m1, start_ns=5_000_000)
+        hops = m2[Message.KEY_TIMINGS][timing.KEY_HOPS]
+        self.assertEqual([h[timing.KEY_STAGE] for h in hops], ['stage-1', 'stage-2'])
+        self.assertEqual(len(m1[Message.KEY_TIMINGS][timing.KEY_HOPS]), 1)
+        self.assertTrue(Message.is_valid_structure(m2))
+        Message.get_validator().validate(m2)
+
+        breakdown = Message.get_timing_breakdown(m2)
+        self.assertIn('stage-2', breakdown)
+        self.assertIn('total 7.0 ms; run 4.0 ms; gaps 3.0 ms', breakdown)
+
+    def test_ledger_is_size_bounded(self):
+        message = None
+        for i in range(timing.MAX_HOPS + 5):
+            message = self.build_message(f'stage-{i}', prior_message=message, start_ns=i * 10)
+        ledger = message[Message.KEY_TIMINGS]
+        self.assertEqual(len(ledger[timing.KEY_HOPS]), timing.MAX_HOPS)
+        self.assertEqual(ledger[timing.KEY_DROPPED], 5)
+        self.assertEqual(ledger[timing.KEY_DROPPED_NS], 5 * 2_000_000)
+        self.assertEqual(ledger[timing.KEY_HOPS][-1][timing.KEY_STAGE], f'stage-{timing.MAX_HOPS + 4}')
+        Message.get_validator().validate(message)
+
+    def test_invalid_ledger_rejected(self):
+        message = self.build_message('stage-1')
+        message[Message.KEY_TIMINGS][timing.KEY_HOPS][0][timing.KEY_S3_REQUESTS] = -1
+        self.assertFalse(Message.is_valid_structure(message))
+        with self.assertRaises(Exception):
+            Message.validate_message(message)
+
+    def test_start_and_finish_hop(self):
+        event = self.build_message('stage-1')
+        ledger, hop_timer = timing.start_hop(event, 'stage-2', instrument_boto3=False)
+        self.assertNotIn(Message.KEY_TIMINGS, event)
+        hop_timer.add_bytes(read=5)
+        output = timing.finish_hop({}, ledger, hop_timer, in_band=True)
+        hops = output[timing.KEY_TIMINGS][timing.KEY_HOPS]
+        self.assertEqual(len(hops), 2)
+        self.assertEqual(hops[-1][timing.KEY_BYTES_READ], 5)
+        self.assertGreaterEqual(hops[-1][timing.KEY_END_NS], hops[-1][timing.KEY_START_NS])
+
+    def test_standalone_hops_do_not_stop_each_other(self):
+        active_ledger, active_timer = timing.start_hop({}, 'stage-1', instrument_boto3=False)
+        item_ledgers = [
+            timing.start_hop({}, f'item-{i}', instrument_boto3=False, standalone=True)
+            for i in range(2)
+        ]
+        self.assertIs(timing.active_hop_timer, active_timer)
+        for ledger, hop_timer in item_ledgers:
+            self.assertIsNone(hop_timer.end_ns)
+        self.assertIsNone(active_timer.end_ns)
+        for ledger, hop_timer in item_ledgers:
+            timing.finish_hop({}, ledger, hop_timer)
+        self.assertIsNone(active_timer.end_ns)
+        timing.finish_hop({}, active_ledger, active_timer)
+
+    def test_finish_hop_out_of_band(self):
+        event = self.build_message('stage-1')
+        ledger, hop_timer = timing.start_hop(event, 'stage-2', instrument_boto3=False)
+        output = timing.finish_hop({}, ledger, hop_timer, in_band=False)
+        self.assertNotIn(timing.KEY_TIMINGS, output)
+        self.assertEqual(len(ledger[timing.KEY_HOPS]), 2)
+
+    def test_s3_requests_counted(self):
+        try:
+            import boto3
+            from botocore.stub import Stubber
+        except ImportError:
+            self.skipTest('boto3 not installed')
+
+        hop_timer = timing.HopTimer('stage-1')
+        s3_client = boto3.client(
+            's3', region_name='eu-west-2',
+            aws_access_key_id='x', aws_secret_access_key='x')
+        with Stubber(s3_client) as stubber:
+            stubber.add_response('put_object', {}, {'Bucket': 'b', 'Key': 'k', 'Body': b'12345'})
+            stubber.add_response(
+                'get_object', {'ContentLength': 7, 'Body': io.BytesIO(b'1234567')},
+                {'Bucket': 'b', 'Key': 'k'})
+            s3_client.put_object(Bucket='b', Key='k', Body=b'12345')
+            s3_client.get_object(Bucket='b', Key='k')
+
+        record = hop_timer.stop()
+        self.assertEqual(record[timing.KEY_S3_REQUESTS], 2)
+        self.assertEqual(record[timing.KEY_BYTES_WRITTEN], 5)
+        self.assertEqual(record[timing.KEY_BYTES_READ], 7)
+
+    def test_s3_requests_counted_for_existing_client(self):
+        try:
+            import boto3
+            from botocore.stub import Stubber
+        except ImportError:
+            self.skipTest('boto3 not installed')
+
+        # Created before the timer, so it has a copy of the session's hooks
+        s3_client = boto3.client(
+            's3', region_name='eu-west-2',
+            aws_access_key_id='x', aws_secret_access_key='x')
+        uncounted_timer = timing.HopTimer('stage-1')
+        hop_timer = timing.HopTimer('stage-2', clients=[s3_client])
+        with Stubber(s3_client) as stubber:
+            stubber.add_response('put_object', {}, {'Bucket': 'b', 'Key': 'k', 'Body': b'12345'})
+            s3_client.put_object(Bucket='b', Key='k', Body=b'12345')
+
+        self.assertEqual(uncounted_timer.stop()[timing.KEY_S3_REQUESTS], 0)
+        record = hop_timer.stop()
+        self.assertEqual(record[timing.KEY_S3_REQUESTS], 1)
+        self.assertEqual(record[timing.KEY_BYTES_WRITTEN], 5)
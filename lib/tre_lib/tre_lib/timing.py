@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+"""
+In-band per-hop timing ledger for TRE messages.
+
+Each hop (Lambda, step, etc) appends one compact record to the message's
+`timings` ledger so end-to-end consignment latency can be attributed to
+individual stages without searching each Lambda's logs:
+
+    "timings": {
+        "hops": [
+            {
+                "stage": "tre-vb-validate-bagit",
+                "start-ns": 1660000000000000000,
+                "end-ns": 1660000001500000000,
+                "bytes-read": 1048576,
+                "bytes-written": 1048576,
+                "s3-requests": 4
+            }
+        ],
+        "dropped": 0,
+        "dropped-ns": 0
+    }
+
+The ledger is size-bounded; only the latest `MAX_HOPS` records are kept and
+older ones are summarised by the `dropped` count and their total duration.
+
+`Message` schemas allow the ledger, but the tre_event_lib event schemas do
+not; so `finish_hop` only sets it on an output event if `TRE_TIMING_IN_BAND`
+is `true` (otherwise the hop's record is logged).
+"""
+import logging
+import os
+import time
+import threading
+
+logger = logging.getLogger(__name__)
+
+KEY_TIMINGS = 'timings'
+KEY_HOPS = 'hops'
+KEY_DROPPED = 'dropped'
+KEY_DROPPED_NS = 'dropped-ns'
+KEY_STAGE = 'stage'
+KEY_START_NS = 'start-ns'
+KEY_END_NS = 'end-ns'
+KEY_BYTES_READ = 'bytes-read'
+KEY_BYTES_WRITTEN = 'bytes-written'
+KEY_S3_REQUESTS = 's3-requests'
+
+REQUIRED_HOP_KEYS = frozenset([KEY_STAGE, KEY_START_NS, KEY_END_NS])
+HOP_KEYS = REQUIRED_HOP_KEYS | {KEY_BYTES_READ, KEY_BYTES_WRITTEN, KEY_S3_REQUESTS}
+
+MAX_HOPS = int(os.environ.get('TRE_TIMING_MAX_HOPS', 16))
+IN_BAND = os.environ.get('TRE_TIMING_IN_BAND', 'false').lower() == 'true'
+MAX_STAGE_LENGTH = 64
+
+S3_WRITE_OPERATIONS = ('PutObject', 'UploadPart')
+S3_READ_OPERATIONS = ('GetObject',)
+
+active_hop_timer = None
+
+
+def empty_ledger() -> dict:
+    return {KEY_HOPS: [], KEY_DROPPED: 0, KEY_DROPPED_NS: 0}
+
+
+def get_ledger(message: dict) -> dict:
+    """
+    Return a copy of `message`'s timing ledger (or an empty ledger).
+    """
+    ledger = message.get(KEY_TIMINGS) if isinstance(message, dict) else None
+    if not isinstance(ledger, dict):
+        return empty_ledger()
+    return {
+        KEY_HOPS: list(ledger.get(KEY_HOPS, [])),
+        KEY_DROPPED: ledger.get(KEY_DROPPED, 0),
+        KEY_DROPPED_NS: ledger.get(KEY_DROPPED_NS, 0)
+    }
+
+
+def is_int(value, minimum: int = None) -> bool:
+    return (
+        isinstance(value, int) and not isinstance(value, bool)
+        and (minimum is None or value >= minimum)
+    )
+
+
+def is_valid_ledger(ledger) -> bool:
+    """
+    Return True if `ledger` matches the `timings` rules in `schema.json`.
+    """
+    if not isinstance(ledger, dict) or KEY_HOPS not in ledger:
+        return False
+    if not ledger.keys() <= {KEY_HOPS, KEY_DROPPED, KEY_DROPPED_NS}:
+        return False
+    for key in (KEY_DROPPED, KEY_DROPPED_NS):
+        if key in ledger and not is_int(ledger[key], minimum=0):
+            return False
+    if not isinstance(ledger[KEY_HOPS], list):
+        return False
+    for hop in ledger[KEY_HOPS]:
+        if not isinstance(hop, dict) or not REQUIRED_HOP_KEYS <= hop.keys() <= HOP_KEYS:
+            return False
+        if not isinstance(hop[KEY_STAGE], str):
+            return False
+        if not is_int(hop[KEY_START_NS]) or not is_int(hop[KEY_END_NS]):
+            return False
+        for key in (KEY_BYTES_READ, KEY_BYTES_WRITTEN, KEY_S3_REQUESTS):
+            if key in hop and not is_int(hop[key], minimum=0):
+                return False
+    return True
+
+
+def append_record(ledger: dict, record: dict, max_hops: int = MAX_HOPS) -> dict:
+    """
+    Append `record` to `ledger` (in place) keeping at most `max_hops` records;
+    the oldest are dropped and summarised. Returns `ledger`.
+    """
+    hops = ledger[KEY_HOPS]
+    hops.append(record)
+    while len(hops) > max(max_hops, 1):
+        dropped = hops.pop(0)
+        ledger[KEY_DROPPED] += 1
+        ledger[KEY_DROPPED_NS] += dropped[KEY_END_NS] - dropped[KEY_START_NS]
+    return ledger
+
+
+def build_record(
+    stage: str,
+    start_ns: int,
+    end_ns: int,
+    bytes_read: int = 0,
+    bytes_written: int = 0,
+    s3_requests: int = 0
+) -> dict:
+    return {
+        KEY_STAGE: str(stage)[:MAX_STAGE_LENGTH],
+        KEY_START_NS: start_ns,
+        KEY_END_NS: end_ns,
+        KEY_BYTES_READ: bytes_read,
+        KEY_BYTES_WRITTEN: bytes_written,
+        KEY_S3_REQUESTS: s3_requests
+    }
+
+
+def render_breakdown(message_or_ledger: dict) -> str:
+    """
+    Return a per-hop latency breakdown of a message (or ledger) as text; the
+    `gap` column is the time between the previous hop's end and this hop's
+    start (e.g. queueing and Step Function transitions).
+    """
+    if KEY_HOPS in message_or_ledger:
+        ledger = message_or_ledger
+    else:
+        ledger = get_ledger(message_or_ledger)
+
+    hops = ledger[KEY_HOPS]
+    lines = [
+        f'{"stage":<{MAX_STAGE_LENGTH // 2}} {"gap ms":>10} {"run ms":>10} '
+        f'{"read":>12} {"written":>12} {"s3 reqs":>8}'
+    ]
+    if ledger.get(KEY_DROPPED):
+        lines.append(
+            f'({ledger[KEY_DROPPED]} earlier hops, '
+            f'{ledger[KEY_DROPPED_NS] / 1e6:,.1f} ms run time, not shown)')
+
+    prior_end_ns = None
+    for hop in hops:
+        gap_ns = 0 if prior_end_ns is None else hop[KEY_START_NS] - prior_end_ns
+        run_ns = hop[KEY_END_NS] - hop[KEY_START_NS]
+        lines.append(
+            f'{hop[KEY_STAGE]:<{MAX_STAGE_LENGTH // 2}} {gap_ns / 1e6:>10,.1f} '
+            f'{run_ns / 1e6:>10,.1f} {hop.get(KEY_BYTES_READ, 0):>12,} '
+            f'{hop.get(KEY_BYTES_WRITTEN, 0):>12,} {hop.get(KEY_S3_REQUESTS, 0):>8,}')
+        prior_end_ns = hop[KEY_END_NS]
+
+    if hops:
+        total_ns = hops[-1][KEY_END_NS] - hops[0][KEY_START_NS]
+        run_ns = sum(hop[KEY_END_NS] - hop[KEY_START_NS] for hop in hops)
+        lines.append(
+            f'total {total_ns / 1e6:,.1f} ms; run {run_ns / 1e6:,.1f} ms; '
+            f'gaps {(total_ns - run_ns) / 1e6:,.1f} ms')
+    return '\n'.join(lines)
+
+
+class HopTimer:
+    """
+    Times one hop and counts its S3 requests and bytes read / written.
+
+    A boto3 client copies its session's event hooks when it is created, so
+    S3 requests are counted for clients created from the default session
+    while the timer is running, and for the `clients` given (or added with
+    `instrument_client`), e.g. ones created before the hop started. Other
+    I/O (e.g. HTTP downloads) can be added with `add_bytes`.
+    """
+    EVENT_PARAMETER_BUILD = 'before-parameter-build.s3'
+    EVENT_AFTER_CALL = 'after-call.s3'
+
+    def __init__(self, stage: str, instrument_boto3: bool = True, clients=()):
+        self.stage = stage
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.s3_requests = 0
+        self.lock = threading.Lock()
+        self.unique_id = f'tre-hop-timer-{id(self)}'
+        self.event_systems = []
+        if instrument_boto3:
+            self.register_boto3()
+        for client in clients:
+            self.instrument_client(client)
+
+    def register_boto3(self):
+        """
+        Count requests of clients created from the default session from now.
+        """
+        try:
+            import boto3
+        except ImportError:
+            logger.info('boto3 not available; S3 requests not counted')
+            return
+        if boto3.DEFAULT_SESSION is None:
+            boto3.setup_default_session()
+        self.register_events(boto3.DEFAULT_SESSION.events)
+
+    def instrument_client(self, client):
+        """
+        Count requests made with existing boto3 `client`.
+        """
+        self.register_events(client.meta.events)
+
+    def register_events(self, events):
+        # A unique_id already registered (e.g. on a client copy) is ignored
+        events.register(
+            self.EVENT_PARAMETER_BUILD, self.on_request, unique_id=f'{self.unique_id}-before')
+        events.register(
+            self.EVENT_AFTER_CALL, self.on_response, unique_id=f'{self.unique_id}-after')
+        self.event_systems.append(events)
+
+    def unregister_boto3(self):
+        for events in self.event_systems:
+            events.unregister(
+                self.EVENT_PARAMETER_BUILD, unique_id=f'{self.unique_id}-before')
+            events.unregister(
+                self.EVENT_AFTER_CALL, unique_id=f'{self.unique_id}-after')
+        self.event_systems = []
+
+    @staticmethod
+    def get_body_size(body) -> int:
+        if body is None:
+            return 0
+        if isinstance(body, (bytes, bytearray, memoryview)):
+            return len(body)
+        try:
+            position = body.tell()
+            body.seek(0, os.SEEK_END)
+            size = body.tell() - position
+            body.seek(position)
+            return size
+        except (AttributeError, OSError, ValueError):
+            return 0
+
+    def on_request(self, model=None, params=None, **kwargs):
+        if self.end_ns is not None:
+            return
+        written = 0
+        if model is not None and model.name in S3_WRITE_OPERATIONS and params:
+            written = self.get_body_size(params.get('Body'))
+        with self.lock:
+            self.s3_requests += 1
+            self.bytes_written += written
+
+    def on_response(self, model=None, parsed=None, **kwargs):
+        if self.end_ns is not None:
+            return
+        if model is not None and model.name in S3_READ_OPERATIONS and parsed:
+            with self.lock:
+                self.bytes_read += parsed.get('ContentLength', 0) or 0
+
+    def add_bytes(self, read: int = 0, written: int = 0):
+        with self.lock:
+            self.bytes_read += read
+            self.bytes_written += written
+
+    def stop(self) -> dict:
+        """
+        Stop the timer (if not already stopped) and return its record.
+        """
+        if self.end_ns is None:
+            self.end_ns = time.time_ns()
+            self.unregister_boto3()
+        return build_record(
+            stage=self.stage,
+            start_ns=self.start_ns,
+            end_ns=self.end_ns,
+            bytes_read=self.bytes_read,
+            bytes_written=self.bytes_written,
+            s3_requests=self.s3_requests)
+
+
+def start_hop(
+    event: dict,
+    stage: str,
+    instrument_boto3: bool = True,
+    clients=(),
+    standalone: bool = False
+) -> tuple:
+    """
+    Remove and return the timing ledger from input `event` (so the event can
+    be validated without it) along with a started `HopTimer` for `stage`,
+    which also counts the requests of existing boto3 `clients`.
+
+    Set `standalone` when hops run concurrently (e.g. items of a batch); the
+    timer is then independent of, and does not stop, the active hop timer.
+    """
+    global active_hop_timer
+    ledger = get_ledger(event)
+    if isinstance(event, dict):
+        event.pop(KEY_TIMINGS, None)
+
+    if standalone:
+        return ledger, HopTimer(stage=stage, instrument_boto3=instrument_boto3, clients=clients)
+
+    # Stop any timer left running by a failed prior invocation (warm Lambda)
+    if active_hop_timer is not None:
+        active_hop_timer.stop()
+    active_hop_timer = HopTimer(stage=stage, instrument_boto3=instrument_boto3, clients=clients)
+    return ledger, active_hop_timer
+
+
+def finish_hop(output_event: dict, ledger: dict, hop_timer: HopTimer, in_band: bool = None) -> dict:
+    """
+    Stop `hop_timer`, append its record to `ledger` and, if `in_band` (by
+    default `IN_BAND`), set the ledger on `output_event`, which is returned.
+    Pass `in_band=True` for outputs that stay within a TRE step (e.g. a
+    continuation) and are not validated against a tre_event_lib schema.
+    """
+    record = hop_timer.stop()
+    append_record(ledger, record)
+    if in_band is None:
+        in_band = IN_BAND
+    if in_band:
+        output_event[KEY_TIMINGS] = ledger
+    logger.info(f'finish_hop: {record}')
+    return output_event
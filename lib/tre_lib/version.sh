@@ -1,2 +1,2 @@
 #!/usr/bin/env bash
-export TRE_LIB_VERSION=0.0.2
+export TRE_LIB_VERSION=0.0.9
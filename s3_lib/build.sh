@@ -8,6 +8,10 @@ rm -rf __pycache__/
 rm -rf s3_lib/__pycache__/
 rm -rf s3_lib/s3_lib.egg-info/
 
+# Check tests pass
+printf 'Running Python tests\n'
+python3 -m unittest discover ./tests -p 'test_*.py'
+
 # Build package .whl file in ./dist/
 . version.sh
 printf 'Building package: S3_LIB_VERSION=%s\n' "${S3_LIB_VERSION}"
@@ -0,0 +1,736 @@
+#!/usr/bin/env python3
+"""
+Single-pass BagIt validation.
+
+Each member of a BagIt tar archive is extracted to s3 and hashed as it is
+streamed, and small root (tag) files are kept in memory. The extracted files
+are then compared with the tag and data manifests by a sorted merge, giving
+the exact sets of missing, unexpected and mismatched files without listing
+or re-reading the extracted objects from s3.
+"""
+import logging
+import io
+import base64
+import hashlib
+import shutil
+import tarfile
+import concurrent.futures
+import boto3  # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/index.html
+from s3_lib import checksum_lib
+from s3_lib import dedup_lib
+from s3_lib import object_lib
+from s3_lib import plan_lib
+from s3_lib import spill_lib
+from s3_lib import tar_lib
+
+# Set global logging options; AWS environment may override this though
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+TAG_MANIFEST = 'tagmanifest-sha256.txt'
+DATA_MANIFEST = 'manifest-sha256.txt'
+BAG_INFO_TEXT = 'bag-info.txt'
+FILE_METADATA = 'file-metadata.csv'
+DATA_PREFIX = 'data/'
+MAX_ERROR_FILES = 50  # limit on file names listed per error message
+
+PAYLOAD_OXUM = 'Payload-Oxum'
+
+KEY_PATH = 'path'
+KEY_ROOT = 'root'
+KEY_DATA = 'data'
+
+
+def compare_sorted(expected, actual):
+    """
+    Compare `expected` and `actual` dictionaries of file name to checksum by
+    merging their sorted names; return lists of the `missing` (expected
+    only), `extra` (actual only) and `mismatched` (checksum differs) names.
+    """
+    missing = []
+    extra = []
+    mismatched = []
+    expected_names = sorted(expected)
+    actual_names = sorted(actual)
+    i = j = 0
+    while i < len(expected_names) and j < len(actual_names):
+        expected_name = expected_names[i]
+        actual_name = actual_names[j]
+        if expected_name == actual_name:
+            if expected[expected_name] != actual[actual_name]:
+                mismatched.append(expected_name)
+            i += 1
+            j += 1
+        elif expected_name < actual_name:
+            missing.append(expected_name)
+            i += 1
+        else:
+            extra.append(actual_name)
+            j += 1
+    missing.extend(expected_names[i:])
+    extra.extend(actual_names[j:])
+    return missing, extra, mismatched
+
+
+def format_file_list(names, describe=None):
+    """
+    Return `names` as a string for an error message, truncated to
+    `MAX_ERROR_FILES` names; `describe` optionally returns detail for a name.
+    """
+    shown = ', '.join(
+        f'"{name}"' if describe is None else f'"{name}": {describe(name)}'
+        for name in names[:MAX_ERROR_FILES])
+    more = len(names) - MAX_ERROR_FILES
+    return shown if more <= 0 else f'{shown} (and {more} more)'
+
+
+class BagValidation:
+    """
+    Result of a single-pass BagIt extraction and validation.
+
+    `digests` and `sizes` are keyed by path relative to `bag_root`;
+    `tag_files` holds the content of the small files in the bag's root.
+    """
+    def __init__(self, bag_root, bucket_name):
+        self.bag_root = bag_root.rstrip(object_lib.S3_PATH_SEPARATOR)
+        self.bucket_name = bucket_name
+        self.digests = {}
+        self.sizes = {}
+        self.tag_files = {}
+        self.extracted_object_names = []
+        self.duplicates = []
+        self.outside_root = []
+        self.tag_manifest = []
+        self.data_manifest = []
+        self.missing = []
+        self.extra = []
+        self.mismatched = []
+        self.expected = {}
+        self.profile = None
+        self.plan = None
+        self.continuation = None
+        self.copied = {}
+
+    def add_member(self, relative_name, digest, size, content=None):
+        if relative_name in self.digests:
+            self.duplicates.append(relative_name)
+        self.digests[relative_name] = digest
+        self.sizes[relative_name] = size
+        if content is not None:
+            self.tag_files[relative_name] = content
+
+    def to_state(self, cursor):
+        """
+        Return the extraction progress so far as a JSON-serialisable dict;
+        `cursor` is the index of the next tar member to extract.
+        """
+        return {
+            'cursor': cursor,
+            'digests': self.digests,
+            'sizes': self.sizes,
+            'tag-files': {
+                name: base64.b64encode(content).decode('ascii')
+                for name, content in self.tag_files.items()
+            },
+            'extracted-object-names': self.extracted_object_names,
+            'duplicates': self.duplicates,
+            'outside-root': self.outside_root,
+            'archive-size': None if self.profile is None else self.profile.archive_size,
+            'member-sizes': None if self.profile is None else self.profile.member_sizes,
+            'manifest-digests': None if self.profile is None else self.profile.manifest_digests,
+            'copied': self.copied
+        }
+
+    def restore_state(self, state):
+        """
+        Restore the progress saved by `to_state` and return its cursor.
+        """
+        self.digests = state['digests']
+        self.sizes = state['sizes']
+        self.tag_files = {
+            name: base64.b64decode(content)
+            for name, content in state['tag-files'].items()
+        }
+        self.extracted_object_names = state['extracted-object-names']
+        self.duplicates = state['duplicates']
+        self.outside_root = state['outside-root']
+        if state['member-sizes'] is not None:
+            self.profile = BagProfile(state['archive-size'])
+            self.profile.member_sizes = state['member-sizes']
+            self.profile.manifest_digests = state.get('manifest-digests') or {}
+        self.copied = state.get('copied', {})
+        return state['cursor']
+
+    def get_tag_file(self, name):
+        return self.tag_files.get(name)
+
+    def get_bag_info(self):
+        """
+        Return the parsed bag-info.txt if it was kept in memory, else `None`.
+        """
+        content = self.get_tag_file(BAG_INFO_TEXT)
+        return None if content is None else object_lib.parse_dictionary(io.BytesIO(content))
+
+    def get_file_metadata(self):
+        """
+        Return the parsed file-metadata.csv rows if it was kept in memory,
+        else `None`.
+        """
+        content = self.get_tag_file(FILE_METADATA)
+        return None if content is None else object_lib.parse_csv(io.BytesIO(content))
+
+    def get_manifest(self, name):
+        """
+        Return manifest `name`'s items; from memory unless it was too large
+        to keep there, or an empty list if it was not in the BagIt.
+        """
+        if name not in self.digests:
+            return []
+        content = self.get_tag_file(name)
+        if content is None:
+            return checksum_lib.get_manifest_s3(self.bucket_name, self.get_object_name(name))
+        return checksum_lib.parse_manifest(io.BytesIO(content))
+
+    def verify(self):
+        """
+        Compare the extracted files with the tag and data manifests. The tag
+        manifest does not list itself, so it is always expected.
+        """
+        self.tag_manifest = self.get_manifest(TAG_MANIFEST)
+        self.data_manifest = self.get_manifest(DATA_MANIFEST)
+
+        self.expected = {
+            item[checksum_lib.ITEM_FILE]: item[checksum_lib.ITEM_CHECKSUM]
+            for item in self.tag_manifest + self.data_manifest
+        }
+        actual = dict(self.digests)
+        if TAG_MANIFEST in actual:
+            self.expected[TAG_MANIFEST] = actual[TAG_MANIFEST]
+
+        self.missing, self.extra, self.mismatched = compare_sorted(self.expected, actual)
+        logger.info(
+            f'verify: expected={len(self.expected)} actual={len(actual)} '
+            f'missing={len(self.missing)} extra={len(self.extra)} '
+            f'mismatched={len(self.mismatched)} '
+            f'duplicates={len(self.duplicates)} '
+            f'outside_root={len(self.outside_root)}')
+        return self
+
+    @property
+    def is_complete(self):
+        return self.continuation is None
+
+    @property
+    def has_tag_manifest(self):
+        return TAG_MANIFEST in self.digests
+
+    @property
+    def failed_preflight(self):
+        return self.profile is not None and len(self.profile.errors) > 0
+
+    @property
+    def is_valid(self):
+        if self.failed_preflight:
+            return False
+        return self.has_tag_manifest and not (
+            self.missing or self.extra or self.mismatched
+            or self.duplicates or self.outside_root)
+
+    def get_errors(self):
+        """
+        Return a list of error messages naming the offending files.
+        """
+        if self.failed_preflight:
+            return list(self.profile.errors)
+        errors = []
+        if not self.has_tag_manifest:
+            errors.append(f'File "{TAG_MANIFEST}" not found in BagIt')
+        if self.missing:
+            errors.append(
+                f'{len(self.missing)} file(s) in manifest but not in BagIt: '
+                f'{format_file_list(self.missing)}')
+        if self.extra:
+            errors.append(
+                f'{len(self.extra)} file(s) in BagIt but not in manifest: '
+                f'{format_file_list(self.extra)}')
+        if self.mismatched:
+            errors.append(
+                f'{len(self.mismatched)} file(s) with incorrect checksum: '
+                + format_file_list(
+                    self.mismatched,
+                    lambda name: (
+                        f'calculated checksum "{self.digests[name]}" does not match '
+                        f'expected checksum "{self.expected[name]}"')))
+        if self.duplicates:
+            errors.append(
+                f'{len(self.duplicates)} file(s) repeated in BagIt: '
+                f'{format_file_list(self.duplicates)}')
+        if self.outside_root:
+            errors.append(
+                f'{len(self.outside_root)} file(s) outside BagIt root '
+                f'"{self.bag_root}": {format_file_list(self.outside_root)}')
+        return errors
+
+    def get_object_name(self, relative_name):
+        return f'{self.bag_root}{object_lib.S3_PATH_SEPARATOR}{relative_name}'
+
+    def get_object_sizes(self):
+        """
+        Return the extracted files' sizes keyed by s3 object name.
+        """
+        return {
+            self.get_object_name(name): size
+            for name, size in self.sizes.items()
+        }
+
+    def get_validated_files(self):
+        """
+        Return the validated file lists in the format returned by
+        `checksum_lib.verify_s3_manifest_checksums`.
+        """
+        return {
+            KEY_PATH: self.bag_root,
+            KEY_ROOT: [
+                self.get_object_name(item[checksum_lib.ITEM_FILE])
+                for item in self.tag_manifest
+            ],
+            KEY_DATA: [
+                self.get_object_name(item[checksum_lib.ITEM_FILE])
+                for item in self.data_manifest
+            ]
+        }
+
+
+def is_tag_file(relative_name):
+    return object_lib.S3_PATH_SEPARATOR not in relative_name
+
+
+def get_stream_size(stream):
+    """
+    Return the size of seekable `stream` and rewind it to the start.
+    """
+    stream.seek(0, io.SEEK_END)
+    size = stream.tell()
+    stream.seek(0)
+    return size
+
+
+def parse_payload_oxum(value):
+    """
+    Return (octets, file count) from a `Payload-Oxum` value (e.g. "1024.3");
+    raises ValueError if the value is not in that format.
+    """
+    octets, separator, count = (value or '').partition('.')
+    if not (separator and octets.isdigit() and count.isdigit()):
+        raise ValueError(f'Invalid {PAYLOAD_OXUM} value "{value}"')
+    return int(octets), int(count)
+
+
+class BagProfile:
+    """
+    Member names and sizes of a BagIt archive, collected from its tar
+    headers by `preflight_tar_stream`, plus any pre-flight check errors.
+    Sizes are keyed by path relative to the BagIt's root.
+    """
+    def __init__(self, archive_size):
+        self.archive_size = archive_size
+        self.member_sizes = {}
+        self.manifest_digests = {}
+        self.outside_root = []
+        self.errors = []
+
+    @property
+    def member_count(self):
+        return len(self.member_sizes)
+
+    @property
+    def total_bytes(self):
+        return sum(self.member_sizes.values())
+
+    @property
+    def largest_member_bytes(self):
+        return max(self.member_sizes.values(), default=0)
+
+    def get_data_sizes(self):
+        return {
+            name: size for name, size in self.member_sizes.items()
+            if name.startswith(DATA_PREFIX)
+        }
+
+    def __repr__(self):
+        return (
+            f'BagProfile(archive_size={self.archive_size} '
+            f'member_count={self.member_count} total_bytes={self.total_bytes} '
+            f'largest_member_bytes={self.largest_member_bytes} '
+            f'errors={len(self.errors)})')
+
+
+def check_manifest_names(profile, manifest_name, content, expected_names):
+    """
+    Add an error to `profile` if the files listed in manifest `content` are
+    not exactly `expected_names`. Returns the listed files' checksums.
+    """
+    listed = {
+        item[checksum_lib.ITEM_FILE]: item[checksum_lib.ITEM_CHECKSUM]
+        for item in checksum_lib.parse_manifest(io.BytesIO(content))
+    }
+    missing, extra, _ = compare_sorted(listed, dict.fromkeys(expected_names))
+    if missing:
+        profile.errors.append(
+            f'{len(missing)} file(s) in {manifest_name} but not in BagIt: '
+            f'{format_file_list(missing)}')
+    if extra:
+        profile.errors.append(
+            f'{len(extra)} file(s) in BagIt but not in {manifest_name}: '
+            f'{format_file_list(extra)}')
+    return listed
+
+
+def preflight_tar_stream(tar_stream, bag_root, output_prefix='', archive_size=None):
+    """
+    Read just the tar headers (and the small bag-info and manifest files) of
+    BagIt archive `tar_stream` and check the member names and sizes against
+    `Payload-Oxum` in bag-info.txt and the manifests' file lists, without
+    extracting or hashing anything. Returns a `BagProfile`; any problems
+    found (including a corrupt or truncated archive) are in its `errors`.
+
+    The archive is read once, in order, so `tar_stream` need not be
+    seekable (e.g. an s3 GET body as it is downloaded).
+    """
+    logger.info(f'preflight_tar_stream start: bag_root={bag_root}')
+    profile = BagProfile(archive_size)
+    root_prefix = bag_root.rstrip(object_lib.S3_PATH_SEPARATOR) + object_lib.S3_PATH_SEPARATOR
+    tag_content = {}
+
+    try:
+        with tarfile.open(fileobj=tar_stream, mode='r|*') as tar_content:
+            for item in tar_content:
+                if not item.isfile():
+                    continue
+                output_object_name = tar_lib.get_member_object_name(item, output_prefix)
+                if not output_object_name.startswith(root_prefix):
+                    profile.outside_root.append(output_object_name)
+                    continue
+                relative_name = output_object_name[len(root_prefix):]
+                profile.member_sizes[relative_name] = item.size
+                if (relative_name in (BAG_INFO_TEXT, TAG_MANIFEST, DATA_MANIFEST)
+                        and not spill_lib.should_stream_member(item.size)):
+                    tag_content[relative_name] = tar_content.extractfile(item).read()
+    except (tarfile.TarError, EOFError, OSError) as e:
+        profile.errors.append(f'BagIt archive is corrupt or truncated: {e}')
+        logger.info(f'preflight_tar_stream return: {profile}')
+        return profile
+
+    if profile.outside_root:
+        profile.errors.append(
+            f'{len(profile.outside_root)} file(s) outside BagIt root '
+            f'"{bag_root}": {format_file_list(profile.outside_root)}')
+
+    data_sizes = profile.get_data_sizes()
+    if BAG_INFO_TEXT in tag_content:
+        bag_info = object_lib.parse_dictionary(io.BytesIO(tag_content[BAG_INFO_TEXT]))
+        if PAYLOAD_OXUM in bag_info:
+            try:
+                octets, count = parse_payload_oxum(bag_info[PAYLOAD_OXUM])
+                if (octets, count) != (sum(data_sizes.values()), len(data_sizes)):
+                    profile.errors.append(
+                        f'{PAYLOAD_OXUM} "{bag_info[PAYLOAD_OXUM]}" does not '
+                        f'match BagIt data: {sum(data_sizes.values())} bytes in '
+                        f'{len(data_sizes)} file(s)')
+            except ValueError as e:
+                profile.errors.append(str(e))
+        else:
+            logger.info(f'No {PAYLOAD_OXUM} in {BAG_INFO_TEXT}; not checked')
+
+    if TAG_MANIFEST not in profile.member_sizes:
+        profile.errors.append(f'File "{TAG_MANIFEST}" not found in BagIt')
+    elif TAG_MANIFEST in tag_content:
+        profile.manifest_digests.update(check_manifest_names(
+            profile, TAG_MANIFEST, tag_content[TAG_MANIFEST],
+            [n for n in profile.member_sizes if is_tag_file(n) and n != TAG_MANIFEST]))
+
+    if DATA_MANIFEST in tag_content:
+        profile.manifest_digests.update(check_manifest_names(
+            profile, DATA_MANIFEST, tag_content[DATA_MANIFEST],
+            [n for n in profile.member_sizes if not is_tag_file(n)]))
+
+    logger.info(f'preflight_tar_stream return: {profile}')
+    return profile
+
+
+def wait_for_uploads(pending, return_when=concurrent.futures.ALL_COMPLETED):
+    """
+    Wait for upload futures in `pending` as per `return_when`, re-raising the
+    first upload error; returns the futures still pending.
+    """
+    done, pending = concurrent.futures.wait(pending, return_when=return_when)
+    for future in done:
+        future.result()
+    return pending
+
+
+def copy_or_upload_streamed_member(
+        s3_client, member_stream, source, expected_digest, bucket, key, max_in_memory):
+    """
+    Read streamed tar member `member_stream` once, hashing it as it is
+    written to a spooled buffer (moved to ephemeral storage above
+    `max_in_memory` bytes). If its digest is `expected_digest`, copy
+    `source` (a `dedup_lib.ContentSource`) to `key` in `bucket`
+    server-side, else (or if the source no longer exists) upload the
+    buffered content. Returns the member's digest and True if it was copied.
+    """
+    with spill_lib.spooled_buffer(max_size=max_in_memory) as buffer:
+        reader = tar_lib.HashingReader(member_stream)
+        shutil.copyfileobj(reader, buffer, spill_lib.READ_BLOCK_SIZE)
+        digest = reader.hexdigest()
+        if digest == expected_digest and dedup_lib.copy_s3_object(
+                s3_client, source, bucket, key):
+            return digest, True
+        buffer.seek(0)
+        s3_client.upload_fileobj(buffer, Bucket=bucket, Key=key)
+        return digest, False
+
+
+def record_copied(validation, object_name, source_key):
+    """
+    Return a done callback for a `put_or_copy_member` future that adds
+    `object_name` to `validation.copied` if the member was copied.
+    """
+    def on_done(future):
+        if future.exception() is None and future.result():
+            validation.copied[object_name] = source_key
+    return on_done
+
+
+def put_or_copy_member(s3_client, source, content, bucket, key):
+    """
+    Write in-memory member `content` to `key` in `bucket`; as a server-side
+    copy of `source` (a `dedup_lib.ContentSource`), if given and it still
+    exists, else as an upload. Returns True if the member was copied.
+    """
+    if source is not None and dedup_lib.copy_s3_object(s3_client, source, bucket, key):
+        return True
+    s3_client.put_object(Bucket=bucket, Key=key, Body=content)
+    return False
+
+
+def extract_and_hash_members(
+        s3_client,
+        tar_stream,
+        validation,
+        output_bucket_name,
+        output_prefix,
+        start_index=0,
+        deadline=None,
+        content_index=None):
+    """
+    Write each file in tar archive `tar_stream` to `output_bucket_name` with
+    name prefix `output_prefix`, adding its digest and size to `validation`.
+
+    Members are streamed or read into memory, and written by a pool of
+    `validation.plan.workers` threads, as per the execution plan; members
+    are read (and hashed) in archive order and at most `max_in_flight`
+    in-memory members are held at once.
+
+    If `content_index` (a `dedup_lib.ContentIndex`) is given, members whose
+    content is already in s3 (in the index, or earlier in this archive) are
+    copied server-side instead of uploaded. A streamed member is looked up
+    by its manifest digest, and only copied if its calculated digest
+    matches.
+
+    Members before index `start_index` are skipped (i.e. were extracted by
+    an earlier invocation). If `deadline` (a `checkpoint_lib.Deadline`)
+    expires, the writes in progress are completed and the index of the next
+    member is returned; `None` is returned once every member is extracted.
+    """
+    plan = validation.plan
+    root_prefix = validation.bag_root + object_lib.S3_PATH_SEPARATOR
+    expected_digests = {} if validation.profile is None else validation.profile.manifest_digests
+    pending = set()
+    extracted_count = 0
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=plan.workers) as executor:
+        with tarfile.open(fileobj=tar_stream) as tar_content:
+            for index, item in enumerate(tar_content):
+                if index < start_index or not item.isfile():
+                    continue
+                # Always extract at least one member, so each call progresses
+                if extracted_count > 0 and deadline is not None and deadline.expired:
+                    logger.info(f'Stopping at tar member {index}: {deadline}')
+                    wait_for_uploads(pending)
+                    return index
+                output_object_name = tar_lib.get_member_object_name(item, output_prefix)
+                logger.info(f'output_object_name={output_object_name} size={item.size}')
+                in_root = output_object_name.startswith(root_prefix)
+                relative_name = output_object_name[len(root_prefix):] if in_root else None
+                member_stream = tar_content.extractfile(item)
+                future = None
+                source = None
+                if plan.should_stream_member(item.size):
+                    content = None
+                    expected_digest = expected_digests.get(relative_name)
+                    if content_index is not None and expected_digest is not None:
+                        source = content_index.get(expected_digest)
+                    if source is not None and not spill_lib.has_free_space(item.size):
+                        logger.info(f'No space to buffer {output_object_name}; not copying')
+                        source = None
+                    if source is not None:
+                        # Buffer while hashing, so the member is read once
+                        # whether it is then copied or uploaded
+                        digest, copied = copy_or_upload_streamed_member(
+                            s3_client, member_stream, source, expected_digest,
+                            output_bucket_name, output_object_name,
+                            plan.member_stream_threshold)
+                        source = source if copied else None
+                    else:
+                        reader = tar_lib.HashingReader(member_stream)
+                        s3_client.upload_fileobj(
+                            reader, Bucket=output_bucket_name, Key=output_object_name)
+                        digest = reader.hexdigest()
+                else:
+                    content = member_stream.read()
+                    digest = hashlib.sha256(content).hexdigest()
+                    if content_index is not None:
+                        source = content_index.get(digest)
+                    future = executor.submit(
+                        put_or_copy_member, s3_client, source, content,
+                        output_bucket_name, output_object_name)
+                    if source is not None:
+                        future.add_done_callback(
+                            record_copied(validation, output_object_name, source.key))
+                    pending.add(future)
+                    if len(pending) >= plan.max_in_flight:
+                        pending = wait_for_uploads(
+                            pending, return_when=concurrent.futures.FIRST_COMPLETED)
+
+                if future is None and source is not None:
+                    validation.copied[output_object_name] = source.key
+                if content_index is not None:
+                    content_index.add(
+                        digest, output_bucket_name, output_object_name, item.size,
+                        future=future)
+
+                extracted_count += 1
+                validation.extracted_object_names.append(output_object_name)
+                if not in_root:
+                    validation.outside_root.append(output_object_name)
+                    continue
+
+                validation.add_member(
+                    relative_name, digest, item.size,
+                    content=content if is_tag_file(relative_name) else None)
+
+        wait_for_uploads(pending)
+    return None
+
+
+def untar_and_validate_s3_object(
+        input_bucket_name,
+        object_name,
+        bag_root,
+        output_prefix='',
+        output_bucket_name=None,
+        preflight=True,
+        deadline=None,
+        checkpoint=None,
+        resume=False,
+        deduplicate=False,
+        prior_prefix=None):
+    """
+    Extract the BagIt tar `object_name` in `input_bucket_name` to
+    `output_bucket_name` (default `input_bucket_name`) with object name
+    prefix `output_prefix`, hashing each member as it is written, then
+    verify the extracted files against the BagIt's manifests. `bag_root` is
+    the s3 path of the extracted BagIt's root (e.g. the archive's name
+    without `.tar.gz`). Returns a verified `BagValidation`.
+
+    If `preflight` is True the archive is checked with
+    `preflight_tar_stream` as it is downloaded; if that fails the download
+    is stopped, nothing is extracted and the returned `BagValidation` has
+    the pre-flight errors. The collected
+    `BagProfile` is available as `BagValidation.profile`, and the
+    `plan_lib.ExecutionPlan` chosen from it as `BagValidation.plan`.
+
+    If `deadline` (a `checkpoint_lib.Deadline`) expires before every member
+    is extracted, progress is saved to `checkpoint` (a
+    `checkpoint_lib.Checkpoint`) and the returned `BagValidation` is not
+    complete; its `continuation` identifies the checkpoint. Calling again
+    with `resume=True` continues from the checkpoint (if there is one).
+
+    If `deduplicate` is True, files with the same content are only uploaded
+    once (further copies are made server-side), and if `prior_prefix` is
+    also given, so are files already extracted by earlier attempts saved
+    under that prefix (see `dedup_lib.build_prior_index`). The copied
+    objects are listed in `BagValidation.copied`.
+    """
+    logger.info(
+        f'untar_and_validate_s3_object start: input_bucket_name={input_bucket_name} '
+        f'object_name={object_name} bag_root={bag_root} '
+        f'output_prefix={output_prefix} output_bucket_name={output_bucket_name}')
+
+    output_bucket_name = input_bucket_name if output_bucket_name is None else output_bucket_name
+    validation = BagValidation(bag_root, output_bucket_name)
+    s3_client = boto3.client('s3')
+
+    start_index = 0
+    state = checkpoint.load() if checkpoint is not None and resume else None
+    if state is not None:
+        start_index = validation.restore_state(state)
+        logger.info(f'Resuming from tar member {start_index}')
+
+    content_index = None
+    if deduplicate:
+        content_index = dedup_lib.ContentIndex() if prior_prefix is None else (
+            dedup_lib.build_prior_index(
+                s3_client, output_bucket_name, prior_prefix, exclude_root=validation.bag_root))
+        for name, digest in validation.digests.items():
+            content_index.add(
+                digest, output_bucket_name, validation.get_object_name(name),
+                validation.sizes[name])
+
+    inspect = None
+    if state is None and preflight:
+        def inspect(download_stream):
+            # Check the headers as the archive is downloaded, so a failed
+            # pre-flight stops the download
+            validation.profile = preflight_tar_stream(
+                download_stream, validation.bag_root, output_prefix=output_prefix)
+            return not validation.failed_preflight
+
+    with tar_lib.open_s3_tar_stream(
+            s3_client, input_bucket_name, object_name, inspect=inspect) as tar_stream:
+        if tar_stream is None:
+            logger.info('untar_and_validate_s3_object return: failed pre-flight')
+            return validation
+        archive_size = get_stream_size(tar_stream)
+        if inspect is not None:
+            validation.profile.archive_size = archive_size
+        if validation.profile is not None:
+            validation.plan = plan_lib.plan_for_profile(validation.profile)
+        else:
+            validation.plan = plan_lib.plan_execution(archive_size)
+
+        next_index = extract_and_hash_members(
+            s3_client, tar_stream, validation, output_bucket_name, output_prefix,
+            start_index=start_index,
+            deadline=deadline if checkpoint is not None else None,
+            content_index=content_index)
+
+    if next_index is not None:
+        validation.continuation = checkpoint.save(validation.to_state(next_index))
+        logger.info('untar_and_validate_s3_object return: checkpoint saved')
+        return validation
+
+    if state is not None:
+        checkpoint.delete()
+    logger.info(
+        f'copied={len(validation.copied)} of '
+        f'{len(validation.extracted_object_names)} extracted objects')
+    validation.verify()
+    logger.info('untar_and_validate_s3_object return')
+    return validation
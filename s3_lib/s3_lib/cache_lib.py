@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+In-process, size-bounded LRU cache of small, parsed s3 objects.
+
+Entries survive between invocations of a warm Lambda container. Every cache
+hit is revalidated with a conditional GET (`If-None-Match` with the cached
+ETag), so a changed object is always re-read and re-parsed.
+
+Limits can be overridden with environment variables:
+
+* `TRE_S3_CACHE_MAX_BYTES`       : total size of cached objects (0 disables)
+* `TRE_S3_CACHE_MAX_ENTRY_BYTES` : largest object that will be cached
+"""
+import logging
+import os
+import io
+import copy
+import threading
+import collections
+from botocore.exceptions import ClientError
+
+# Set global logging options; AWS environment may override this though
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+DEFAULT_MAX_BYTES = 16 * 1024 * 1024
+DEFAULT_MAX_ENTRY_BYTES = 1024 * 1024
+NOT_MODIFIED_CODES = ('304', 'NotModified')
+
+CacheEntry = collections.namedtuple('CacheEntry', ['etag', 'body', 'parsed'])
+
+
+class S3ObjectCache:
+    """
+    LRU cache keyed by (bucket, key). Each entry holds the object's ETag, its
+    raw body and the parsed form(s) produced from it, keyed by parser name.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, max_entry_bytes=DEFAULT_MAX_ENTRY_BYTES):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = min(max_entry_bytes, max_bytes)
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, s3_client, bucket, key, parser, parser_name, use_cache=True):
+        """
+        Return `parser(stream)` for object `key` in `bucket`, where `stream`
+        is a binary file-like object of the object's body. A copy of the
+        cached parsed object is returned if the object is unchanged.
+
+        Set `use_cache` to `False` to bypass the cache for a single call.
+        """
+        if not use_cache or self.max_bytes <= 0:
+            s3_object = s3_client.get_object(Bucket=bucket, Key=key)
+            return parser(s3_object['Body'])
+
+        cache_key = (bucket, key)
+        with self.lock:
+            entry = self.entries.get(cache_key)
+
+        if entry is not None:
+            try:
+                s3_object = s3_client.get_object(
+                    Bucket=bucket, Key=key, IfNoneMatch=entry.etag)
+            except ClientError as e:
+                if e.response.get('Error', {}).get('Code') not in NOT_MODIFIED_CODES:
+                    raise
+                logger.info(f'Cache hit (not modified): bucket={bucket} key={key}')
+                return copy.deepcopy(self.get_parsed(cache_key, entry, parser, parser_name))
+        else:
+            s3_object = s3_client.get_object(Bucket=bucket, Key=key)
+
+        logger.info(f'Cache miss: bucket={bucket} key={key}')
+        self.misses += 1
+        if s3_object['ContentLength'] > self.max_entry_bytes:
+            logger.info(f'Not caching {s3_object["ContentLength"]} byte object')
+            self.evict(cache_key)
+            return parser(s3_object['Body'])
+
+        body = s3_object['Body'].read()
+        entry = CacheEntry(etag=s3_object['ETag'], body=body, parsed={})
+        parsed = self.get_parsed(cache_key, entry, parser, parser_name, count_hit=False)
+        self.put(cache_key, entry)
+        return copy.deepcopy(parsed)
+
+    def get_parsed(self, cache_key, entry, parser, parser_name, count_hit=True):
+        """
+        Return `entry`'s parsed object for `parser_name`, parsing the cached
+        body with `parser` if this form has not been requested before.
+        """
+        if parser_name not in entry.parsed:
+            entry.parsed[parser_name] = parser(io.BytesIO(entry.body))
+
+        with self.lock:
+            if count_hit:
+                self.hits += 1
+            if cache_key in self.entries:
+                self.entries.move_to_end(cache_key)
+
+        return entry.parsed[parser_name]
+
+    def put(self, cache_key, entry):
+        """
+        Add `entry` as the most recently used item, evicting the least
+        recently used items until the cache is within `max_bytes`.
+        """
+        with self.lock:
+            prior = self.entries.pop(cache_key, None)
+            if prior is not None:
+                self.size -= len(prior.body)
+            self.entries[cache_key] = entry
+            self.size += len(entry.body)
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted.body)
+
+    def evict(self, cache_key):
+        """
+        Remove `cache_key` from the cache, if present.
+        """
+        with self.lock:
+            prior = self.entries.pop(cache_key, None)
+            if prior is not None:
+                self.size -= len(prior.body)
+
+    def clear(self):
+        """
+        Remove all entries from the cache.
+        """
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+# Shared by all s3_lib readers in this process (i.e. warm Lambda container)
+s3_object_cache = S3ObjectCache(
+    max_bytes=int(os.environ.get('TRE_S3_CACHE_MAX_BYTES', DEFAULT_MAX_BYTES)),
+    max_entry_bytes=int(os.environ.get('TRE_S3_CACHE_MAX_ENTRY_BYTES', DEFAULT_MAX_ENTRY_BYTES)))
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Cooperative checkpointing for long-running steps.
+
+A step checks a `Deadline` (from the Lambda context's remaining time)
+between units of work; when too little time is left it saves its progress
+as a JSON `Checkpoint` in s3 and returns a continuation. When re-invoked
+with the continuation it loads the checkpoint and resumes from it instead
+of redoing completed work.
+
+The margin kept before the Lambda's timeout (to finish the current unit of
+work and save the checkpoint) can be set with environment variable
+`TRE_CHECKPOINT_MARGIN_MS`.
+"""
+import logging
+import json
+import time
+import boto3  # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/index.html
+from s3_lib import common_lib
+from s3_lib import plan_lib
+
+# Set global logging options; AWS environment may override this though
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+DEFAULT_MARGIN_MS = 60 * 1000
+CHECKPOINT_OBJECT_SUFFIX = '.checkpoint.json'
+
+KEY_CONTINUATION = 'continuation'
+KEY_S3_BUCKET = 's3-bucket'
+KEY_CHECKPOINT_KEY = 'checkpoint-key'
+KEY_SAVED_AT = 'saved-at'
+KEY_STATE = 'state'
+
+
+class Deadline:
+    """
+    Tracks the time left in an invocation; `expired` becomes True when less
+    than `margin_ms` remains. With no `context` (e.g. when run locally) the
+    deadline never expires.
+    """
+    def __init__(self, context=None, margin_ms=None):
+        self.context = context
+        self.margin_ms = plan_lib.get_env_number(
+            'TRE_CHECKPOINT_MARGIN_MS', DEFAULT_MARGIN_MS) if margin_ms is None else margin_ms
+
+    def get_remaining_ms(self):
+        if self.context is None:
+            return None
+        return self.context.get_remaining_time_in_millis()
+
+    @property
+    def expired(self):
+        remaining_ms = self.get_remaining_ms()
+        return remaining_ms is not None and remaining_ms <= self.margin_ms
+
+    def __repr__(self):
+        return f'Deadline(remaining_ms={self.get_remaining_ms()} margin_ms={self.margin_ms})'
+
+
+def get_checkpoint_key(s3_object_root):
+    return s3_object_root.rstrip('/') + CHECKPOINT_OBJECT_SUFFIX
+
+
+class Checkpoint:
+    """
+    Progress of one step, saved as JSON object `key` in `bucket`.
+    """
+    def __init__(self, bucket, key):
+        self.bucket = bucket
+        self.key = key
+        self.s3_client = boto3.client('s3')
+
+    def load(self):
+        """
+        Return the saved state, or `None` if there is no checkpoint.
+        """
+        try:
+            s3_object = self.s3_client.get_object(Bucket=self.bucket, Key=self.key)
+        except self.s3_client.exceptions.NoSuchKey:
+            logger.info(f'No checkpoint at {self.bucket}/{self.key}')
+            return None
+        saved = json.load(s3_object['Body'])
+        logger.info(
+            f'Loaded checkpoint {self.bucket}/{self.key} saved at '
+            f'{saved[KEY_SAVED_AT]}')
+        return saved[KEY_STATE]
+
+    def save(self, state):
+        """
+        Save `state` and return the continuation to resume from it.
+        """
+        logger.info(f'Saving checkpoint {self.bucket}/{self.key}')
+        self.s3_client.put_object(
+            Bucket=self.bucket, Key=self.key,
+            Body=json.dumps(
+                {KEY_SAVED_AT: int(time.time()), KEY_STATE: state},
+                separators=(',', ':')).encode('utf-8'))
+        return self.get_continuation()
+
+    def delete(self):
+        logger.info(f'Deleting checkpoint {self.bucket}/{self.key}')
+        self.s3_client.delete_object(Bucket=self.bucket, Key=self.key)
+
+    def get_continuation(self):
+        return {KEY_S3_BUCKET: self.bucket, KEY_CHECKPOINT_KEY: self.key}
+
+    @staticmethod
+    def from_continuation(continuation):
+        if not continuation or KEY_CHECKPOINT_KEY not in continuation:
+            raise common_lib.S3LibError(f'Invalid continuation {continuation}')
+        return Checkpoint(continuation[KEY_S3_BUCKET], continuation[KEY_CHECKPOINT_KEY])
+
+
+def pop_continuation(event):
+    """
+    Remove and return the continuation (if any) from `event`, so the event
+    can be validated without it.
+    """
+    return event.pop(KEY_CONTINUATION, None) if isinstance(event, dict) else None
+
+
+def set_continuation(event, continuation):
+    """
+    Return a copy of `event` with `continuation` set; re-invoking the step
+    with it resumes from the saved checkpoint.
+    """
+    output = dict(event)
+    output[KEY_CONTINUATION] = continuation
+    return output
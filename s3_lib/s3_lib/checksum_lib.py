@@ -4,6 +4,9 @@ import requests
 import os
 import boto3  # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/index.html
 import hashlib  # https://docs.python.org/3/library/hashlib.html
+import codecs
+from s3_lib import spill_lib
+from s3_lib import cache_lib
 
 # Set global logging options; AWS environment may override this though
 logging.basicConfig(
@@ -54,26 +57,36 @@ def get_manifest_url(url):
     logger.info('get_manifest_url end')
     return checksums
 
-def get_manifest_s3(bucket_name, object_name):
+def parse_manifest(stream):
+    """
+    Return a list of dictionary items (with each item having a filename,
+    basename and checksum) from manifest file content in binary `stream`.
+    """
+    checksums = []
+    reader = codecs.getreader(ENCODING_UTF8)
+    for line_decoded in reader(stream):
+        checksum = line_decoded[0:64]
+        file = line_decoded[64:].strip()
+        basename = os.path.basename(file)
+        checksums.append(checksum_item(file, basename, checksum))
+    return checksums
+
+def get_manifest_s3(bucket_name, object_name, use_cache=True):
     """
     Return a list of dictionary items from an AWS s3 object (with each item
     having a filename, basename and checksum).
+
+    Small manifests are cached; set `use_cache` to `False` to force a re-read.
     """
     logger.info(
         f'get_manifest_object start: bucket_name={bucket_name} '
         f'object_name={object_name}')
 
     s3_client = boto3.client('s3')
-    s3_object = s3_client.get_object(Bucket=bucket_name, Key=object_name)
-    checksums = []
+    checksums = cache_lib.s3_object_cache.get(
+        s3_client, bucket_name, object_name, parse_manifest,
+        parser_name='manifest', use_cache=use_cache)
 
-    for line in s3_object['Body'].iter_lines():
-        line_decoded = line.decode(ENCODING_UTF8)
-        checksum = line_decoded[0:64]
-        file = line_decoded[64:].strip()
-        basename = os.path.basename(file)
-        checksums.append(checksum_item(file, basename, checksum))
-    
     logger.debug(f'checksums={checksums}')
     logger.info('get_manifest_object end')
     return checksums
@@ -118,6 +131,34 @@ def get_s3_object_checksum(bucket_name, object_name):
     logger.info('get_checksum end')
     return hex_digest
 
+def get_buffer_checksum(buffer):
+    """
+    Returns the SHA 256 checksum of `buffer` (any object supporting the buffer
+    protocol, such as a memory map), hashed in bounded slices without copying.
+    """
+    hashlib_sha256 = hashlib.sha256()
+    view = memoryview(buffer)
+    try:
+        for offset in range(0, len(view), READ_BLOCK_SIZE):
+            hashlib_sha256.update(view[offset:offset + READ_BLOCK_SIZE])
+    finally:
+        view.release()
+    return hashlib_sha256.hexdigest()
+
+def get_file_checksum(path):
+    """
+    Returns the SHA 256 checksum of local file `path` (e.g. a file spilled to
+    ephemeral storage); the file is memory-mapped rather than read into RAM.
+    """
+    logger.info(f'get_file_checksum start: path={path}')
+    if os.path.getsize(path) == 0:
+        return hashlib.sha256().hexdigest()  # empty files can't be mapped
+
+    with spill_lib.open_mmap(path) as mm:
+        hex_digest = get_buffer_checksum(mm)
+    logger.info(f'get_file_checksum return: hex_digest={hex_digest}')
+    return hex_digest
+
 def verify_s3_manifest_checksums(bucket_name, bagit_name):
     """
     Load the expected checksums from the manifest files located in
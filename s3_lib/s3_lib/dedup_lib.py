@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Content-addressed deduplication for BagIt extraction.
+
+A `ContentIndex` maps SHA-256 digests to s3 objects that already hold that
+content: files extracted by earlier attempts of the same consignment (found
+from their consignment summaries; see `summary_lib`) and files already
+extracted from the current BagIt. Extraction can then make a server-side
+copy of an existing object instead of uploading the same bytes again.
+"""
+import logging
+import botocore.exceptions
+from s3_lib import object_lib
+from s3_lib import summary_lib
+
+# Set global logging options; AWS environment may override this though
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+MAX_COPY_OBJECT_BYTES = 5 * 1024 * 1024 * 1024  # larger needs multipart copy
+
+
+class ContentSource:
+    """
+    An s3 object holding some content; `future` is set if the object is
+    still being written.
+    """
+    def __init__(self, bucket, key, size, future=None):
+        self.bucket = bucket
+        self.key = key
+        self.size = size
+        self.future = future
+
+    def wait(self):
+        if self.future is not None:
+            self.future.result()
+
+    def __repr__(self):
+        return f'ContentSource(bucket={self.bucket} key={self.key} size={self.size})'
+
+
+class ContentIndex:
+    """
+    SHA-256 digest to `ContentSource`; the first source added for a digest
+    is kept.
+    """
+    def __init__(self):
+        self.sources = {}
+
+    def __len__(self):
+        return len(self.sources)
+
+    def add(self, digest, bucket, key, size, future=None):
+        if digest is not None and digest not in self.sources:
+            self.sources[digest] = ContentSource(bucket, key, size, future)
+
+    def get(self, digest):
+        return self.sources.get(digest)
+
+    def add_summary(self, summary):
+        """
+        Add the files listed in the manifests of consignment `summary`.
+        """
+        bucket = summary[summary_lib.KEY_S3_BUCKET]
+        root = summary[summary_lib.KEY_S3_OBJECT_ROOT].rstrip(object_lib.S3_PATH_SEPARATOR)
+        sizes = summary[summary_lib.KEY_SIZES]
+        for manifest_key in (summary_lib.KEY_TAG_MANIFEST, summary_lib.KEY_MANIFEST):
+            for file, checksum in summary[manifest_key].items():
+                self.add(
+                    checksum, bucket, f'{root}{object_lib.S3_PATH_SEPARATOR}{file}',
+                    sizes.get(file))
+
+
+def find_prior_summaries(s3_client, bucket, consignment_prefix, exclude_root=None):
+    """
+    Return the consignment summaries of earlier attempts saved under
+    `consignment_prefix` (e.g. `consignments/<type>/<reference>/`), which
+    holds one folder per attempt, excluding the one for `exclude_root`.
+    """
+    logger.info(
+        f'find_prior_summaries start: bucket={bucket} '
+        f'consignment_prefix={consignment_prefix} exclude_root={exclude_root}')
+    paginator = s3_client.get_paginator('list_objects_v2')
+    attempt_prefixes = [
+        common_prefix['Prefix']
+        for page in paginator.paginate(
+            Bucket=bucket, Prefix=consignment_prefix,
+            Delimiter=object_lib.S3_PATH_SEPARATOR)
+        for common_prefix in page.get('CommonPrefixes', [])
+    ]
+
+    exclude_key = None if exclude_root is None else summary_lib.get_summary_key(exclude_root)
+    summaries = []
+    for attempt_prefix in attempt_prefixes:
+        for page in paginator.paginate(
+                Bucket=bucket, Prefix=attempt_prefix,
+                Delimiter=object_lib.S3_PATH_SEPARATOR):
+            for s3_object in page.get('Contents', []):
+                key = s3_object['Key']
+                if key.endswith(summary_lib.SUMMARY_OBJECT_SUFFIX) and key != exclude_key:
+                    summary = summary_lib.read_consignment_summary(bucket, key=key)
+                    if summary is not None:
+                        summaries.append(summary)
+
+    logger.info(f'find_prior_summaries return: {len(summaries)} summaries')
+    return summaries
+
+
+def build_prior_index(s3_client, bucket, consignment_prefix, exclude_root=None):
+    """
+    Return a `ContentIndex` of the files extracted by earlier attempts saved
+    under `consignment_prefix`.
+    """
+    content_index = ContentIndex()
+    for summary in find_prior_summaries(
+            s3_client, bucket, consignment_prefix, exclude_root=exclude_root):
+        content_index.add_summary(summary)
+    logger.info(f'build_prior_index: {len(content_index)} digests')
+    return content_index
+
+
+def copy_s3_object(s3_client, source, bucket, key):
+    """
+    Copy `source` (a `ContentSource`) to `key` in `bucket` server-side.
+    Returns False (rather than raising) if the source object no longer
+    exists, so the caller can upload the content instead.
+    """
+    source.wait()
+    copy_source = {'Bucket': source.bucket, 'Key': source.key}
+    logger.info(f'copy_s3_object: {source} to bucket={bucket} key={key}')
+    try:
+        if source.size is not None and source.size <= MAX_COPY_OBJECT_BYTES:
+            s3_client.copy_object(CopySource=copy_source, Bucket=bucket, Key=key)
+        else:
+            s3_client.copy(copy_source, bucket, key)
+    except botocore.exceptions.ClientError as e:
+        error_code = e.response.get('Error', {}).get('Code')
+        if error_code in ('NoSuchKey', '404'):
+            logger.info(f'Copy source {source} not found; uploading instead')
+            return False
+        raise
+    return True
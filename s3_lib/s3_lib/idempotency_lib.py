@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""
+Idempotency index for repeated input events.
+
+The same BagIt can be sent more than once: by a parallel resend, or by
+at-least-once SQS delivery. The index is keyed on the consignment reference
+and the source checksum, and records the result of the first successful
+run. A step can then look up a duplicate in O(1) and reuse the prior result
+(e.g. copy its output server-side) instead of fetching and hashing the
+BagIt again.
+
+The record store is pluggable (environment variable `TRE_IDEMPOTENCY_STORE`):
+
+* `s3`     : one marker object per key under `TRE_IDEMPOTENCY_PREFIX`
+             (default); written with a conditional PUT, so the first
+             writer wins
+* `sqlite` : a local SQLite database at `TRE_IDEMPOTENCY_SQLITE_PATH`
+             (for running locally)
+* `none`   : disabled
+"""
+import logging
+import json
+import sqlite3
+import time
+import boto3  # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/index.html
+import botocore.exceptions
+from s3_lib import common_lib
+from s3_lib import object_lib
+
+# Set global logging options; AWS environment may override this though
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+STORE_S3 = 's3'
+STORE_SQLITE = 'sqlite'
+STORE_NONE = 'none'
+
+DEFAULT_MARKER_PREFIX = 'idempotency/'
+DEFAULT_SQLITE_PATH = '/tmp/tre-idempotency.sqlite3'
+MARKER_OBJECT_SUFFIX = '.json'
+
+KEY_RECORDED_AT = 'recorded-at'
+KEY_RESULT = 'result'
+
+
+def get_idempotency_key(consignment_reference, checksum):
+    """
+    Return the index key for `consignment_reference` with source `checksum`.
+    """
+    if not consignment_reference or not checksum:
+        raise common_lib.S3LibError(
+            f'Invalid idempotency key: consignment_reference='
+            f'"{consignment_reference}" checksum="{checksum}"')
+    return f'{consignment_reference}{object_lib.S3_PATH_SEPARATOR}{checksum.lower()}'
+
+
+class S3MarkerStore:
+    """
+    Records held as JSON marker objects `<prefix><key>.json` in `bucket`.
+    """
+    def __init__(self, bucket, prefix=DEFAULT_MARKER_PREFIX):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.s3_client = boto3.client('s3')
+
+    def get_marker_key(self, key):
+        return f'{self.prefix}{key}{MARKER_OBJECT_SUFFIX}'
+
+    def get(self, key):
+        try:
+            s3_object = self.s3_client.get_object(
+                Bucket=self.bucket, Key=self.get_marker_key(key))
+        except self.s3_client.exceptions.NoSuchKey:
+            return None
+        return json.load(s3_object['Body'])
+
+    def put(self, key, record):
+        """
+        Save `record` for `key` unless one exists; return the stored record
+        (which is the existing one if another writer got there first).
+        """
+        try:
+            self.s3_client.put_object(
+                Bucket=self.bucket, Key=self.get_marker_key(key),
+                Body=json.dumps(record, separators=(',', ':')).encode('utf-8'),
+                IfNoneMatch='*')
+        except botocore.exceptions.ClientError as e:
+            error_code = e.response.get('Error', {}).get('Code')
+            if error_code not in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                raise
+            logger.info(f'Idempotency record {key} already exists')
+            existing = self.get(key)
+            return record if existing is None else existing
+        return record
+
+    def delete(self, key):
+        self.s3_client.delete_object(Bucket=self.bucket, Key=self.get_marker_key(key))
+
+    def __repr__(self):
+        return f'S3MarkerStore(bucket={self.bucket} prefix={self.prefix})'
+
+
+class SqliteStore:
+    """
+    Records held in table `idempotency` of SQLite database `path`.
+    """
+    def __init__(self, path=DEFAULT_SQLITE_PATH):
+        self.path = path
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS idempotency '
+                '(key TEXT PRIMARY KEY, record TEXT NOT NULL)')
+
+    def get(self, key):
+        row = self.connection.execute(
+            'SELECT record FROM idempotency WHERE key = ?', (key,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def put(self, key, record):
+        with self.connection:
+            self.connection.execute(
+                'INSERT OR IGNORE INTO idempotency (key, record) VALUES (?, ?)',
+                (key, json.dumps(record, separators=(',', ':'))))
+        return self.get(key)
+
+    def delete(self, key):
+        with self.connection:
+            self.connection.execute('DELETE FROM idempotency WHERE key = ?', (key,))
+
+    def __repr__(self):
+        return f'SqliteStore(path={self.path})'
+
+
+def get_store(bucket=None):
+    """
+    Return the record store selected by environment variable
+    `TRE_IDEMPOTENCY_STORE` (default `s3`, in `bucket`), or `None` if it is
+    disabled.
+    """
+    store_type = (common_lib.get_env_var(
+        'TRE_IDEMPOTENCY_STORE', must_exist=False, must_have_value=False)
+        or STORE_S3).lower()
+
+    if store_type == STORE_NONE:
+        store = None
+    elif store_type == STORE_SQLITE:
+        store = SqliteStore(common_lib.get_env_var(
+            'TRE_IDEMPOTENCY_SQLITE_PATH', must_exist=False, must_have_value=False)
+            or DEFAULT_SQLITE_PATH)
+    elif store_type == STORE_S3:
+        if not bucket:
+            raise common_lib.S3LibError('An s3 idempotency store needs a bucket')
+        store = S3MarkerStore(bucket, common_lib.get_env_var(
+            'TRE_IDEMPOTENCY_PREFIX', must_exist=False, must_have_value=False)
+            or DEFAULT_MARKER_PREFIX)
+    else:
+        raise common_lib.S3LibError(f'Unknown idempotency store "{store_type}"')
+
+    logger.info(f'get_store: {store}')
+    return store
+
+
+class IdempotencyIndex:
+    """
+    Prior results by consignment reference and source checksum.
+    """
+    def __init__(self, store):
+        self.store = store
+
+    def lookup(self, consignment_reference, checksum, is_available=None):
+        """
+        Return the prior result for the key, or `None`. If `is_available` is
+        given it is called with the prior result; if it returns False (e.g.
+        the result's output has gone) the result is forgotten and `None` is
+        returned.
+        """
+        key = get_idempotency_key(consignment_reference, checksum)
+        record = self.store.get(key)
+        if record is None:
+            logger.info(f'Idempotency miss: {key}')
+            return None
+        logger.info(f'Idempotency hit: {key} recorded at {record[KEY_RECORDED_AT]}')
+        if is_available is not None and not is_available(record[KEY_RESULT]):
+            logger.info(f'Idempotency result no longer available: {record[KEY_RESULT]}')
+            self.forget(consignment_reference, checksum)
+            return None
+        return record[KEY_RESULT]
+
+    def record(self, consignment_reference, checksum, result):
+        """
+        Record `result` for the key if there is no prior result; return the
+        result that is kept.
+        """
+        key = get_idempotency_key(consignment_reference, checksum)
+        stored = self.store.put(
+            key, {KEY_RECORDED_AT: int(time.time()), KEY_RESULT: result})
+        return stored[KEY_RESULT]
+
+    def forget(self, consignment_reference, checksum):
+        """
+        Remove the prior result for the key (e.g. if its output has gone).
+        """
+        key = get_idempotency_key(consignment_reference, checksum)
+        logger.info(f'Idempotency forget: {key}')
+        self.store.delete(key)
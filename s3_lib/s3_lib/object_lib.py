@@ -4,8 +4,13 @@ import logging
 import requests  # https://docs.python-requests.org/en/master/api/
 import hashlib  # https://docs.python.org/3/library/hashlib.html
 import boto3  # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/index.html
+import botocore.exceptions
 import codecs
+import json
+import collections
+import concurrent.futures
 from s3_lib import common_lib
+from s3_lib import cache_lib
 
 # Set global logging options; AWS environment may override this though
 logging.basicConfig(
@@ -19,6 +24,8 @@ logger.setLevel(logging.INFO)
 READ_BLOCK_SIZE = 5 * 1024 * 1024  # s3 multipart min=5MB, except "last" part
 ENCODING_UTF8 = 'utf-8'
 S3_PATH_SEPARATOR = '/'
+MAX_PARTS_IN_FLIGHT = 2  # bounds memory use to about 3 x READ_BLOCK_SIZE
+CONDITIONAL_WRITE_ERROR_CODES = ('PreconditionFailed', 'ConditionalRequestConflict')
 
 def s3_object_exists(bucket_name, object_filter):
     """
@@ -51,6 +58,24 @@ def s3_ls(bucket_name, object_filter):
     logger.info(f's3_object_ls return: s3_bucket_list={s3_object_list}')
     return s3_object_list
 
+def s3_ls_with_size(bucket_name, object_filter):
+    """
+    Return dictionary of object name to size (bytes) for the objects in
+    `bucket_name` that match `object_filter`.
+    """
+    logger.info(
+            f's3_ls_with_size start: bucket_name="{bucket_name}" '
+            f'object_filter="{object_filter}"')
+
+    s3_resource = boto3.resource('s3')
+    s3_bucket = s3_resource.Bucket(bucket_name)
+    s3_object_sizes = {
+        s3_object.key: s3_object.size
+        for s3_object in s3_bucket.objects.filter(Prefix=object_filter)
+    }
+    logger.info(f's3_ls_with_size return: s3_object_sizes={s3_object_sizes}')
+    return s3_object_sizes
+
 def get_max_s3_subfolder_number(bucket_name, object_filter):
     """
     Return the max numeric folder name below path `s3_object_prefix` in
@@ -94,8 +119,11 @@ def url_to_s3_object(
     Copy the content of the supplied `source_url` into an object with name
     `target_object_name` in bucket `target_bucket_name'.
 
-    The `expected_checksum` can be validated during or the copy
-    process; checksum validation failure will raise a `ValueException`.
+    The content is streamed into a multipart upload; parts are uploaded in
+    the background (up to `MAX_PARTS_IN_FLIGHT` at a time) while the next
+    part is downloaded. If `expected_checksum` is given the content is hashed
+    inline and checked before the upload is completed; on a mismatch the
+    upload is aborted (so no object is created) and a `ValueError` is raised.
     """
     logger.info(
             f'copy_url_data_to_bucket start: source_url="{source_url}" '
@@ -117,54 +145,80 @@ def url_to_s3_object(
 
     hashlib_sha256 = hashlib.sha256()
 
-    # Initiate s3 session
-    s3_session = boto3.session.Session()
-    s3_session_resource = s3_session.resource('s3')
-    s3_target_object = s3_session_resource.Object(target_bucket_name, target_object_name)
-    s3_uploader = s3_target_object.initiate_multipart_upload()
+    # Clients (unlike resources) are thread safe, so one is shared by the
+    # part upload threads
+    s3_client = boto3.session.Session().client('s3')
+    upload_id = s3_client.create_multipart_upload(
+        Bucket=target_bucket_name, Key=target_object_name)['UploadId']
 
     S3_KEY_PARTS = 'Parts'
     S3_KEY_PART_NUMBER = 'PartNumber'
     S3_KEY_ETAG = 'ETag'
-    s3_parts = {S3_KEY_PARTS: []}
-    s3_part_count = 0
-    
+
+    def upload_part(part_number, body):
+        s3_part_response = s3_client.upload_part(
+            Bucket=target_bucket_name, Key=target_object_name,
+            UploadId=upload_id, PartNumber=part_number, Body=body)
+        logger.debug(
+            f'Multipart upload part {part_number} sent, '
+            f'ETag={s3_part_response[S3_KEY_ETAG]}')
+        return {
+            S3_KEY_PART_NUMBER: part_number,
+            S3_KEY_ETAG: s3_part_response[S3_KEY_ETAG]
+        }
+
     logger.info('Starting multipart upload and checksum validation')
+    in_flight = collections.deque()
+    s3_parts = {S3_KEY_PARTS: []}
+    buffer = bytearray()
     try:
-        for chunk in response.iter_content(chunk_size=READ_BLOCK_SIZE):
-            s3_part_count += 1
-            s3_uploader_part = s3_uploader.Part(s3_part_count)
-            s3_part_response = s3_uploader_part.upload(Body=chunk)
-            s3_parts[S3_KEY_PARTS].append(
-                {
-                    S3_KEY_PART_NUMBER: s3_part_count,
-                    S3_KEY_ETAG: s3_part_response[S3_KEY_ETAG]
-                })
-            
-            logger.debug(
-                f'Multipart upload part {s3_part_count} sent, '
-                f'ETag={s3_part_response[S3_KEY_ETAG]}')
-            
-            if expected_checksum is not None:
-                hashlib_sha256.update(chunk)
-                logger.debug(f'Hash updated')
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=MAX_PARTS_IN_FLIGHT) as executor:
+            def submit_part(body):
+                # Bound memory use; wait for the oldest part before adding more
+                if len(in_flight) >= MAX_PARTS_IN_FLIGHT:
+                    s3_parts[S3_KEY_PARTS].append(in_flight.popleft().result())
+                part_number = len(s3_parts[S3_KEY_PARTS]) + len(in_flight) + 1
+                in_flight.append(executor.submit(upload_part, part_number, body))
+
+            for chunk in response.iter_content(chunk_size=READ_BLOCK_SIZE):
+                if expected_checksum is not None:
+                    hashlib_sha256.update(chunk)
+                # Parts other than the last must be at least READ_BLOCK_SIZE
+                buffer += chunk
+                if len(buffer) >= READ_BLOCK_SIZE:
+                    submit_part(bytes(buffer))
+                    buffer = bytearray()
+
+            # The last (or only) part may be smaller; it may also be empty
+            if len(buffer) > 0 or (len(in_flight) + len(s3_parts[S3_KEY_PARTS])) == 0:
+                submit_part(bytes(buffer))
+
+            while in_flight:
+                s3_parts[S3_KEY_PARTS].append(in_flight.popleft().result())
 
-        logger.info(f'Send multipart upload complete notification')
-        s3_uploader_result = s3_uploader.complete(MultipartUpload=s3_parts)
-        logger.debug(f's3_uploader_result={s3_uploader_result}')
         if expected_checksum is not None:
             hex_digest = hashlib_sha256.hexdigest()
             logger.info(f'hexdigest         : "{hex_digest}"')
             logger.info(f'expected_checksum : "{expected_checksum}"')
             if hex_digest != expected_checksum:
                 raise ValueError(
-                    f'Invalid checksum; calculated "{hex_digest}" but '
-                    f'expected "{expected_checksum}" for URL {source_url}')        
+                    f'Calculated checksum "{hex_digest}" does not match expected '
+                    f'checksum "{expected_checksum}" for object '
+                    f'"{target_object_name}" in bucket "{target_bucket_name}"')
+
+        logger.info(f'Send multipart upload complete notification')
+        s3_uploader_result = s3_client.complete_multipart_upload(
+            Bucket=target_bucket_name, Key=target_object_name,
+            UploadId=upload_id, MultipartUpload=s3_parts)
+        logger.debug(f's3_uploader_result={s3_uploader_result}')
     except Exception as e:
         logger.error(f'Error in copy_url_data_to_bucket: {e}')
         logger.exception(e)
         logger.info('Abort multipart upload...')
-        s3_uploader.abort()
+        s3_client.abort_multipart_upload(
+            Bucket=target_bucket_name, Key=target_object_name,
+            UploadId=upload_id)
         logger.debug('Multipart upload abort complete')
         raise e
 
@@ -174,25 +228,168 @@ def string_to_s3_object(
         string,
         target_bucket_name,
         target_object_name,
-        allow_overwrite=False):
+        allow_overwrite=False,
+        conditional_put=False):
     """
     Copy the content of the supplied `string` into an object with name
     `target_object_name` in bucket `target_bucket_name'.
+
+    If `conditional_put` is `True` (and `allow_overwrite` is not), s3 checks
+    the object does not exist as part of the PUT (`If-None-Match`), instead
+    of a separate listing beforehand.
     """
     logger.info(
             f'string_to_s3_object start: string="{string}" '
             f'target_bucket_name="{target_bucket_name}" '
             f'target_object_name="{target_object_name}" '
-            f'allow_overwrite="{allow_overwrite}"')
+            f'allow_overwrite="{allow_overwrite}" '
+            f'conditional_put="{conditional_put}"')
 
+    put_arguments = {}
     # Unless allow_overwrite is True, don't copy object if it already exists 
     if not allow_overwrite:
-        raise_error_if_object_exists(target_bucket_name, target_object_name)
+        if conditional_put:
+            put_arguments['IfNoneMatch'] = '*'
+        else:
+            raise_error_if_object_exists(target_bucket_name, target_object_name)
 
     s3r = boto3.resource('s3')
-    s3r.Object(target_bucket_name, target_object_name).put(Body=string)
+    try:
+        s3r.Object(target_bucket_name, target_object_name).put(Body=string, **put_arguments)
+    except botocore.exceptions.ClientError as e:
+        raise_error_if_conditional_write_failed(e, target_bucket_name, target_object_name)
+        raise
     logger.info('string_to_s3_object end')
 
+class HashingS3Writer:
+    """
+    Writable file-like object that streams its content into s3 object
+    `target_object_name` in `target_bucket_name` while hashing it, so the
+    object's SHA 256 checksum is known without reading it back.
+
+    Content (`str` is encoded as UTF-8) is buffered; each full
+    `READ_BLOCK_SIZE` block is sent as a multipart upload part in the
+    background (up to `MAX_PARTS_IN_FLIGHT` at a time). Content that never
+    fills a block is sent with a single PUT on `close`. Used as a context
+    manager, the upload is completed on exit, or aborted if an error is
+    raised.
+
+    With `conditional_put`, s3 checks the object does not exist when the
+    upload is completed (as for `string_to_s3_object`).
+    """
+    def __init__(self, target_bucket_name, target_object_name, allow_overwrite=False, conditional_put=False):
+        logger.info(
+                f'HashingS3Writer start: target_bucket_name="{target_bucket_name}" '
+                f'target_object_name="{target_object_name}" '
+                f'allow_overwrite="{allow_overwrite}" '
+                f'conditional_put="{conditional_put}"')
+        self.complete_arguments = {}
+        # Unless allow_overwrite is True, don't write object if it already exists
+        if not allow_overwrite:
+            if conditional_put:
+                self.complete_arguments['IfNoneMatch'] = '*'
+            else:
+                raise_error_if_object_exists(target_bucket_name, target_object_name)
+
+        self.bucket = target_bucket_name
+        self.key = target_object_name
+        self.s3_client = boto3.session.Session().client('s3')
+        self.hashlib_sha256 = hashlib.sha256()
+        self.buffer = bytearray()
+        self.size = 0
+        self.upload_id = None
+        self.executor = None
+        self.in_flight = collections.deque()
+        self.parts = []
+        self.hex_digest = None
+
+    def write(self, content):
+        if isinstance(content, str):
+            content = content.encode(ENCODING_UTF8)
+        self.hashlib_sha256.update(content)
+        self.size += len(content)
+        self.buffer += content
+        # Parts other than the last must be at least READ_BLOCK_SIZE
+        if len(self.buffer) >= READ_BLOCK_SIZE:
+            self.submit_part(bytes(self.buffer))
+            self.buffer = bytearray()
+        return len(content)
+
+    def upload_part(self, part_number, body):
+        s3_part_response = self.s3_client.upload_part(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+            PartNumber=part_number, Body=body)
+        return {'PartNumber': part_number, 'ETag': s3_part_response['ETag']}
+
+    def submit_part(self, body):
+        if self.upload_id is None:
+            self.upload_id = self.s3_client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key)['UploadId']
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=MAX_PARTS_IN_FLIGHT)
+        # Bound memory use; wait for the oldest part before adding more
+        if len(self.in_flight) >= MAX_PARTS_IN_FLIGHT:
+            self.parts.append(self.in_flight.popleft().result())
+        part_number = len(self.parts) + len(self.in_flight) + 1
+        self.in_flight.append(
+            self.executor.submit(self.upload_part, part_number, body))
+
+    def close(self):
+        """
+        Complete the upload and return the content's SHA 256 checksum.
+        """
+        if self.hex_digest is not None:
+            return self.hex_digest
+
+        try:
+            if self.upload_id is None:
+                self.s3_client.put_object(
+                    Bucket=self.bucket, Key=self.key, Body=bytes(self.buffer),
+                    **self.complete_arguments)
+            else:
+                if len(self.buffer) > 0:
+                    self.submit_part(bytes(self.buffer))
+                while self.in_flight:
+                    self.parts.append(self.in_flight.popleft().result())
+                self.executor.shutdown()
+                self.s3_client.complete_multipart_upload(
+                    Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                    MultipartUpload={'Parts': self.parts},
+                    **self.complete_arguments)
+        except botocore.exceptions.ClientError as e:
+            # A failed completion leaves the upload's parts stored
+            if self.upload_id is not None:
+                self.s3_client.abort_multipart_upload(
+                    Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+            raise_error_if_conditional_write_failed(e, self.bucket, self.key)
+            raise
+
+        self.buffer = bytearray()
+        self.hex_digest = self.hashlib_sha256.hexdigest()
+        logger.info(
+                f'HashingS3Writer end: key="{self.key}" size={self.size} '
+                f'checksum="{self.hex_digest}"')
+        return self.hex_digest
+
+    def abort(self):
+        logger.info(f'HashingS3Writer abort: key="{self.key}"')
+        if self.upload_id is not None:
+            for future in self.in_flight:
+                future.cancel()
+            self.executor.shutdown()
+            self.s3_client.abort_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
 def raise_error_if_object_exists(bucket, object):
     """
     Raise a ValueError if `object` exists in `bucket`.
@@ -208,35 +405,73 @@ def raise_error_if_object_exists(bucket, object):
 
     logger.info('raise_error_if_object_exists end')
 
-def s3_object_to_dictionary(s3_bucket, s3_key, separator=':'):
+def raise_error_if_conditional_write_failed(error, bucket, object):
     """
-    Split each line in s3 object `s3_key' in `s3_bucket` using the left-most
-    `separator`.
+    Raise the same ValueError as `raise_error_if_object_exists` if
+    `botocore.exceptions.ClientError` `error` is from a conditional write of
+    `object` in `bucket` that failed because the object already exists.
+    """
+    if error.response.get('Error', {}).get('Code') in CONDITIONAL_WRITE_ERROR_CODES:
+        raise ValueError(
+                f'Copy not allowed; "{object}" already exists in bucket '
+                f'"{bucket}"') from error
+
+def parse_dictionary(stream, separator=':'):
+    """
+    Return a dictionary from binary `stream`, splitting each line using the
+    left-most `separator`.
     """
-    logger.info(f's3_object_to_dictionary start: s3_bucket={s3_bucket} s3_key={s3_key}')
     dictionary = {}
-    s3_client = boto3.client('s3')
-    s3o = s3_client.get_object(Bucket=s3_bucket, Key=s3_key)
     reader = codecs.getreader(ENCODING_UTF8)
-    for line in reader(s3o['Body']):
+    for line in reader(stream):
         columns = line.rstrip().split(separator, 1)
         if len(columns) > 0:
             key = columns[0].strip()
             value = None if len(columns) < 2 else columns[1].strip()
             dictionary[key] = value
+    return dictionary
+
+def parse_csv(stream):
+    """
+    Return csv content in binary `stream` as a list with a dictionary for each
+    row, keyed by column name.
+    """
+    reader = codecs.getreader(ENCODING_UTF8)
+    return list(csv.DictReader(reader(stream)))
+
+def s3_object_to_dictionary(s3_bucket, s3_key, separator=':', use_cache=True):
+    """
+    Split each line in s3 object `s3_key' in `s3_bucket` using the left-most
+    `separator`.
+
+    Small objects are cached; set `use_cache` to `False` to force a re-read.
+    """
+    logger.info(f's3_object_to_dictionary start: s3_bucket={s3_bucket} s3_key={s3_key}')
+
+    def parser(stream):
+        return parse_dictionary(stream, separator=separator)
+
+    s3_client = boto3.client('s3')
+    dictionary = cache_lib.s3_object_cache.get(
+        s3_client, s3_bucket, s3_key, parser,
+        parser_name=f'dictionary{separator}', use_cache=use_cache)
     logger.info('s3_object_to_dictionary return')
     return dictionary
 
 
-def s3_object_to_csv(s3_bucket, s3_key):
+def s3_object_to_csv(s3_bucket, s3_key, use_cache=True):
     """
-    Get s3 object `s3_key' in `s3_bucket` as csv.
+    Get s3 object `s3_key' in `s3_bucket` as csv; i.e. a list with a
+    dictionary for each row, keyed by column name.
+
+    Small objects are cached; set `use_cache` to `False` to force a re-read.
     """
     logger.info(f's3_object_to_csv start: s3_bucket={s3_bucket} s3_key={s3_key}')
+
     s3_client = boto3.client('s3')
-    s3o = s3_client.get_object(Bucket=s3_bucket, Key=s3_key)
-    reader = codecs.getreader(ENCODING_UTF8)
-    csv_data = csv.DictReader(reader(s3o['Body']))
+    csv_data = cache_lib.s3_object_cache.get(
+        s3_client, s3_bucket, s3_key, parse_csv,
+        parser_name='csv', use_cache=use_cache)
     logger.info('s3_object_to_csv return')
     return csv_data
 
@@ -272,3 +507,67 @@ def get_object(bucket, key):
         raise common_lib.S3LibError(
                 f'Unable to find key "{key}" in '
                 f'bucket "{bucket}". {str(e)}')
+
+def get_object_json(bucket, key, use_cache=True):
+    """
+    Return S3 object `key` from `bucket` parsed as JSON, or raise error with
+    object context.
+
+    Small objects are cached; set `use_cache` to `False` to force a re-read.
+    """
+    logger.info(f'get_object_json bucket={bucket} key={key} use_cache={use_cache}')
+    s3c = boto3.client('s3')
+
+    try:
+        parsed = cache_lib.s3_object_cache.get(
+            s3c, bucket, key, json.load, parser_name='json', use_cache=use_cache)
+        logger.info('get_object_json return')
+        return parsed
+    except s3c.exceptions.NoSuchKey as e:
+        logger.error(str(e))
+        raise common_lib.S3LibError(
+                f'Unable to find key "{key}" in '
+                f'bucket "{bucket}". {str(e)}')
+
+def get_object_json_and_etag(bucket, key):
+    """
+    Return `(dictionary, etag)` for JSON S3 object `key` in `bucket`, or
+    `(None, None)` if it does not exist. Not cached, as the ETag is for a
+    subsequent `put_object_json_if_unchanged`.
+    """
+    logger.info(f'get_object_json_and_etag bucket={bucket} key={key}')
+    s3c = boto3.client('s3')
+
+    try:
+        response = s3c.get_object(Bucket=bucket, Key=key)
+    except s3c.exceptions.NoSuchKey:
+        logger.info('get_object_json_and_etag return: not found')
+        return None, None
+    logger.info(f'get_object_json_and_etag return: etag={response["ETag"]}')
+    return json.load(response['Body']), response['ETag']
+
+def put_object_json_if_unchanged(dictionary, bucket, key, etag):
+    """
+    Write `dictionary` as JSON to S3 object `key` in `bucket` with a
+    conditional PUT; it must still have `etag` (as read with
+    `get_object_json_and_etag`) or, if `etag` is `None`, must not exist. A
+    ValueError is raised if another writer got there first. Return the new
+    object's ETag.
+    """
+    logger.info(f'put_object_json_if_unchanged bucket={bucket} key={key} etag={etag}')
+    condition = {'IfNoneMatch': '*'} if etag is None else {'IfMatch': etag}
+    s3c = boto3.client('s3')
+
+    try:
+        response = s3c.put_object(
+            Bucket=bucket, Key=key,
+            Body=json.dumps(dictionary).encode(ENCODING_UTF8),
+            **condition)
+    except botocore.exceptions.ClientError as e:
+        if e.response.get('Error', {}).get('Code') in CONDITIONAL_WRITE_ERROR_CODES:
+            raise ValueError(
+                    f'Update not allowed; "{key}" in bucket "{bucket}" was '
+                    f'changed by another writer') from e
+        raise
+    logger.info(f'put_object_json_if_unchanged return: etag={response["ETag"]}')
+    return response['ETag']
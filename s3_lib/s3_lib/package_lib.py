@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+"""
+Single-pass tar.gz packages of s3 objects and in-memory content.
+
+The members' s3 objects are fetched concurrently (a bounded number ahead of
+the one being written) and added to a tar.gz that is streamed into the
+output object as it is compressed. Each member and the package itself are
+hashed on the way through, so nothing is read back to calculate checksums.
+The package is written with a conditional PUT, so an existing object is
+never overwritten.
+
+Packages are reproducible: members are sorted by name, with fixed tar
+header values (including mtime) and a fixed gzip header. So a package can
+be identified by a hash of its inputs (member names and s3 ETags or content
+digests); with a `reuse_prefix`, an index record is kept for each such hash
+and a package already built from the same inputs is copied server-side
+instead of being built again.
+"""
+import logging
+import tarfile  # https://docs.python.org/3/library/tarfile.html
+import gzip
+import io
+import collections
+import concurrent.futures
+import hashlib
+import json
+import boto3  # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/index.html
+import botocore.exceptions
+from s3_lib import common_lib
+from s3_lib import dedup_lib
+from s3_lib import object_lib
+from s3_lib import spill_lib
+from s3_lib import tar_lib
+
+# Set global logging options; AWS environment may override this though
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+MAX_FETCHES_IN_FLIGHT = 8
+PACKAGE_FORMAT_VERSION = 1  # change if package content changes for the same inputs
+
+KEY_BUCKET = 'bucket'
+KEY_KEY = 'key'
+KEY_SIZE = 'size'
+KEY_SHA256 = 'sha256'
+KEY_ITEMS = 'items'
+
+
+class PackageMember:
+    """
+    A package member named `name`, with the content of s3 object
+    `s3_object_name` or (if that is `None`) the bytes in `content`. Once
+    `etag` is set (by `get_package_content_hash`), the object is only read
+    if it still has that ETag.
+    """
+    def __init__(self, name, s3_object_name=None, content=None):
+        self.name = name
+        self.s3_object_name = s3_object_name
+        self.content = content
+        self.etag = None
+
+    def __repr__(self):
+        return f'PackageMember(name={self.name} s3_object_name={self.s3_object_name})'
+
+
+def fetch_member(s3_client, s3_bucket_in, member):
+    """
+    Return `(size, body)` for `member`; small s3 objects are read into
+    memory, large ones are returned as a stream to be read when written.
+    """
+    if member.s3_object_name is None:
+        return len(member.content), io.BytesIO(member.content)
+    condition = {} if member.etag is None else {'IfMatch': member.etag}
+    try:
+        s3_object = s3_client.get_object(
+            Bucket=s3_bucket_in, Key=member.s3_object_name, **condition)
+    except s3_client.exceptions.NoSuchKey as e:
+        logger.error(str(e))
+        raise common_lib.S3LibError(
+            f'Unable to find key "{member.s3_object_name}" in '
+            f'bucket "{s3_bucket_in}". {str(e)}')
+    except botocore.exceptions.ClientError as e:
+        # e.g. PreconditionFailed: changed since its ETag was recorded
+        logger.error(str(e))
+        raise common_lib.S3LibError(
+            f'Unable to read key "{member.s3_object_name}" in '
+            f'bucket "{s3_bucket_in}". {str(e)}')
+    size = s3_object['ContentLength']
+    if spill_lib.should_stream_member(size):
+        return size, s3_object['Body']
+    return size, io.BytesIO(s3_object['Body'].read())
+
+
+def fetch_members(s3_client, s3_bucket_in, members):
+    """
+    Yield `(member, size, body)` for each of `members` in order, with up to
+    `MAX_FETCHES_IN_FLIGHT` fetched concurrently ahead of the caller.
+    """
+    def fetch(member):
+        return (member,) + fetch_member(s3_client, s3_bucket_in, member)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_FETCHES_IN_FLIGHT) as executor:
+        in_flight = collections.deque()
+        try:
+            for member in members:
+                # Bound memory use; hand over the oldest before fetching more
+                if len(in_flight) >= MAX_FETCHES_IN_FLIGHT:
+                    yield in_flight.popleft().result()
+                in_flight.append(executor.submit(fetch, member))
+            while in_flight:
+                yield in_flight.popleft().result()
+        finally:
+            for future in in_flight:
+                future.cancel()
+
+
+def get_package_content_hash(s3_client, s3_bucket_in, members):
+    """
+    Return a SHA 256 checksum identifying the package of `members` (sorted
+    by name): over each member's name and its s3 object's ETag (from a HEAD
+    request, run concurrently) or its content's SHA 256 checksum. Each
+    member's `etag` is set, so a package is only built from those versions.
+    """
+    def identify(member):
+        if member.s3_object_name is None:
+            return hashlib.sha256(member.content).hexdigest()
+        try:
+            response = s3_client.head_object(Bucket=s3_bucket_in, Key=member.s3_object_name)
+        except botocore.exceptions.ClientError as e:
+            logger.error(str(e))
+            raise common_lib.S3LibError(
+                f'Unable to find key "{member.s3_object_name}" in '
+                f'bucket "{s3_bucket_in}". {str(e)}')
+        member.etag = response['ETag']
+        return member.etag
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_FETCHES_IN_FLIGHT) as executor:
+        identities = list(executor.map(identify, members))
+    inputs = [PACKAGE_FORMAT_VERSION] + [
+        [member.name, identity] for member, identity in zip(members, identities)]
+    return hashlib.sha256(json.dumps(inputs).encode('utf-8')).hexdigest()
+
+
+def s3_objects_to_s3_tar_gz_package(
+        s3_bucket_in,
+        members,
+        tar_gz_object,
+        s3_bucket_out=None,
+        reuse_prefix=None):
+    """
+    Write `members` (`PackageMember` instances) to `tar_gz_object` in
+    `s3_bucket_out`, or `s3_bucket_in` if `s3_bucket_out` is not specified,
+    in a single pass; a `ValueError` is raised if `tar_gz_object` exists.
+
+    If `reuse_prefix` is given, a package built from the same inputs (as
+    recorded in `<reuse_prefix><content hash>.json`) is copied to
+    `tar_gz_object` instead (also raising a `ValueError` if `tar_gz_object`
+    exists), if it still exists; otherwise the new package is recorded
+    there.
+
+    Return `(tar_items, checksum)`: the items (with `name`, `size` and
+    `sha256`) sorted by name, and the package's SHA 256 checksum.
+    """
+    s3_bucket_out = s3_bucket_in if s3_bucket_out is None else s3_bucket_out
+    logger.info(
+        f's3_objects_to_s3_tar_gz_package start: s3_bucket_in={s3_bucket_in} '
+        f'members={members} tar_gz_object={tar_gz_object} '
+        f's3_bucket_out={s3_bucket_out} reuse_prefix={reuse_prefix}')
+    s3_client = boto3.client('s3')
+    members = sorted(members, key=lambda member: member.name)
+
+    if reuse_prefix is not None:
+        record_key = f'{reuse_prefix}{get_package_content_hash(s3_client, s3_bucket_in, members)}.json'
+        record, record_etag = object_lib.get_object_json_and_etag(s3_bucket_out, record_key)
+        if record is not None:
+            source = dedup_lib.ContentSource(record[KEY_BUCKET], record[KEY_KEY], record[KEY_SIZE])
+            # CopyObject overwrites, so check first as the build path would fail
+            object_lib.raise_error_if_object_exists(s3_bucket_out, tar_gz_object)
+            if dedup_lib.copy_s3_object(s3_client, source, s3_bucket_out, tar_gz_object):
+                logger.info(f's3_objects_to_s3_tar_gz_package return: reused {source}')
+                return record[KEY_ITEMS], record[KEY_SHA256]
+
+    tar_items = []
+    with object_lib.HashingS3Writer(s3_bucket_out, tar_gz_object, conditional_put=True) as writer:
+        # Fixed gzip header (no name, zero mtime) so packages are reproducible
+        with gzip.GzipFile(filename='', mode='wb', fileobj=writer, mtime=0) as gzip_stream, \
+                tarfile.open(mode='w|', fileobj=gzip_stream) as tar:
+            for member, size, body in fetch_members(s3_client, s3_bucket_in, members):
+                logger.info(f'member={member} size={size}')
+                tar_info = tarfile.TarInfo(member.name)
+                tar_info.size = size
+                reader = tar_lib.HashingReader(body)
+                tar.addfile(tar_info, reader)
+                tar_items.append({'name': member.name, 'size': size, 'sha256': reader.hexdigest()})
+
+    if reuse_prefix is not None:
+        record = {
+            KEY_BUCKET: s3_bucket_out,
+            KEY_KEY: tar_gz_object,
+            KEY_SIZE: writer.size,
+            KEY_SHA256: writer.hex_digest,
+            KEY_ITEMS: tar_items
+        }
+        try:
+            object_lib.put_object_json_if_unchanged(record, s3_bucket_out, record_key, record_etag)
+        except ValueError as e:
+            # Another build of the same inputs was recorded first; either will do
+            logger.info(f'Package record not saved: {e}')
+
+    logger.info(
+        f's3_objects_to_s3_tar_gz_package return: members={len(tar_items)} '
+        f'size={writer.size} checksum={writer.hex_digest}')
+    return tar_items, writer.hex_digest
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""
+Size-aware execution planning for bag processing.
+
+A plan is chosen per archive from its size (s3 `ContentLength`), the member
+count and sizes from its tar headers (if known) and the Lambda's memory
+(`AWS_LAMBDA_FUNCTION_MEMORY_SIZE`). The plan's strategy is one of:
+
+* `in-memory` : archive and every member held in memory (fast path)
+* `streaming` : archive in memory, large members streamed
+* `spill`     : archive spilled to ephemeral storage (`/tmp`), large
+                members streamed
+* `parallel`  : as above, but members are written to s3 by a worker pool
+
+Derived limits can be overridden with environment variables:
+
+* `TRE_SPILL_THRESHOLD_BYTES`        : archive size above which to spill
+* `TRE_SPILL_MEMBER_THRESHOLD_BYTES` : member size above which to stream
+* `TRE_PLAN_MEMORY_FRACTION`         : share of Lambda memory to plan for
+* `TRE_PLAN_PARALLEL_MIN_MEMBERS`    : member count for parallel fan-out
+* `TRE_PLAN_MAX_WORKERS`             : upper limit on the worker pool size
+"""
+import logging
+import os
+from s3_lib import spill_lib
+
+# Set global logging options; AWS environment may override this though
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+STRATEGY_IN_MEMORY = 'in-memory'
+STRATEGY_STREAMING = 'streaming'
+STRATEGY_SPILL = 'spill'
+STRATEGY_PARALLEL = 'parallel'
+
+MEBIBYTE = 1024 * 1024
+DEFAULT_MEMORY_MB = 512  # used when not running in Lambda
+DEFAULT_MEMORY_FRACTION = 0.5  # leave the rest for the runtime and clients
+DEFAULT_PARALLEL_MIN_MEMBERS = 32
+DEFAULT_MAX_WORKERS = 8
+MEMORY_MB_PER_WORKER = 128
+MAX_IN_FLIGHT_PER_WORKER = 2
+
+
+def get_env_number(name, default=None, cast=int):
+    """
+    Return environment variable `name` as `cast` type, or `default` if it is
+    not set.
+    """
+    value = os.environ.get(name)
+    return default if value in (None, '') else cast(value)
+
+
+def get_memory_mb():
+    """
+    Return the Lambda function's memory size in MB (or `DEFAULT_MEMORY_MB`).
+    """
+    return get_env_number('AWS_LAMBDA_FUNCTION_MEMORY_SIZE', DEFAULT_MEMORY_MB)
+
+
+def get_memory_budget_bytes(memory_mb=None):
+    """
+    Return the number of bytes of memory a plan may use for archive and
+    member data.
+    """
+    memory_mb = get_memory_mb() if memory_mb is None else memory_mb
+    fraction = get_env_number(
+        'TRE_PLAN_MEMORY_FRACTION', DEFAULT_MEMORY_FRACTION, cast=float)
+    return int(memory_mb * MEBIBYTE * fraction)
+
+
+def get_spill_threshold_bytes(memory_mb=None):
+    """
+    Return the size above which an archive (or archive being built) is held
+    in ephemeral storage rather than memory.
+    """
+    return get_env_number(
+        'TRE_SPILL_THRESHOLD_BYTES', get_memory_budget_bytes(memory_mb) // 2)
+
+
+class ExecutionPlan:
+    """
+    How to process one archive, with the inputs the plan was derived from.
+    """
+    def __init__(
+            self,
+            strategy,
+            spill_archive,
+            member_stream_threshold,
+            workers,
+            inputs):
+        self.strategy = strategy
+        self.spill_archive = spill_archive
+        self.member_stream_threshold = member_stream_threshold
+        self.workers = workers
+        self.inputs = inputs
+
+    @property
+    def max_in_flight(self):
+        return self.workers * MAX_IN_FLIGHT_PER_WORKER
+
+    def should_stream_member(self, size):
+        return size is not None and size > self.member_stream_threshold
+
+    def __repr__(self):
+        return (
+            f'ExecutionPlan(strategy={self.strategy} '
+            f'spill_archive={self.spill_archive} '
+            f'member_stream_threshold={self.member_stream_threshold} '
+            f'workers={self.workers} inputs={self.inputs})')
+
+
+def get_worker_count(member_count, memory_mb):
+    """
+    Return the worker pool size for `member_count` members; 1 (no pool) for
+    small or unknown member counts.
+    """
+    min_members = get_env_number(
+        'TRE_PLAN_PARALLEL_MIN_MEMBERS', DEFAULT_PARALLEL_MIN_MEMBERS)
+    if member_count is None or member_count < min_members:
+        return 1
+
+    max_workers = get_env_number('TRE_PLAN_MAX_WORKERS', DEFAULT_MAX_WORKERS)
+    by_members = member_count // min_members + 1
+    by_memory = max(memory_mb // MEMORY_MB_PER_WORKER, 1)
+    return max(min(by_members, by_memory, max_workers), 1)
+
+
+def plan_execution(
+        content_length,
+        member_count=None,
+        total_bytes=None,
+        largest_member_bytes=None,
+        memory_mb=None):
+    """
+    Return an `ExecutionPlan` for an archive of `content_length` bytes. The
+    member values (e.g. from a pre-flight `BagProfile`) are optional; if
+    omitted the plan only decides where the archive is held.
+
+    The archive is kept in memory if it fits in half of the memory budget;
+    the rest of the budget is shared by the members being written (up to
+    `max_in_flight` at once), which sets the size above which members are
+    streamed rather than read into memory.
+    """
+    memory_mb = get_memory_mb() if memory_mb is None else memory_mb
+    budget = get_memory_budget_bytes(memory_mb)
+    workers = get_worker_count(member_count, memory_mb)
+
+    spill_archive = spill_lib.should_spill(
+        content_length, threshold=get_spill_threshold_bytes(memory_mb))
+
+    archive_in_memory = 0 if spill_archive else (content_length or 0)
+    member_budget = max(budget - archive_in_memory, 0)
+    member_stream_threshold = get_env_number(
+        'TRE_SPILL_MEMBER_THRESHOLD_BYTES',
+        member_budget // (workers * MAX_IN_FLIGHT_PER_WORKER))
+
+    if workers > 1:
+        strategy = STRATEGY_PARALLEL
+    elif spill_archive:
+        strategy = STRATEGY_SPILL
+    elif (largest_member_bytes or 0) > member_stream_threshold:
+        strategy = STRATEGY_STREAMING
+    else:
+        strategy = STRATEGY_IN_MEMORY
+
+    plan = ExecutionPlan(
+        strategy=strategy,
+        spill_archive=spill_archive,
+        member_stream_threshold=member_stream_threshold,
+        workers=workers,
+        inputs={
+            'content-length': content_length,
+            'member-count': member_count,
+            'total-bytes': total_bytes,
+            'largest-member-bytes': largest_member_bytes,
+            'memory-mb': memory_mb,
+            'memory-budget-bytes': budget
+        })
+
+    logger.info(f'plan_execution: {plan}')
+    return plan
+
+
+def plan_for_profile(profile, memory_mb=None):
+    """
+    Return an `ExecutionPlan` from a pre-flight `BagProfile`.
+    """
+    return plan_execution(
+        content_length=profile.archive_size,
+        member_count=profile.member_count,
+        total_bytes=profile.total_bytes,
+        largest_member_bytes=profile.largest_member_bytes,
+        memory_mb=memory_mb)
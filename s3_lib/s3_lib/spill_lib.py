@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""
+Support for spilling large objects to Lambda ephemeral storage (`/tmp`) so
+RAM use stays bounded regardless of bag or member size.
+
+Spill mode is selected automatically by size; objects at or below the
+threshold are kept in memory as before. Thresholds and location can be
+overridden with environment variables:
+
+* `TRE_SPILL_DIR`             : directory to spill to (default: system temp dir)
+* `TRE_SPILL_THRESHOLD_BYTES` : object size above which to spill to disk
+* `TRE_SPILL_MEMBER_THRESHOLD_BYTES` : tar member size above which to stream
+                                       rather than read into memory
+"""
+import logging
+import os
+import io
+import mmap
+import shutil
+import tempfile
+import contextlib
+from s3_lib import common_lib
+
+# Set global logging options; AWS environment may override this though
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+READ_BLOCK_SIZE = 5 * 1024 * 1024  # bounded buffer size for spill I/O
+DEFAULT_SPILL_THRESHOLD_BYTES = 64 * 1024 * 1024
+DEFAULT_SPILL_MEMBER_THRESHOLD_BYTES = 16 * 1024 * 1024
+SPILL_FILE_PREFIX = 'tre-spill-'
+
+SPILL_DIR = os.environ.get('TRE_SPILL_DIR', tempfile.gettempdir())
+SPILL_THRESHOLD_BYTES = int(os.environ.get(
+    'TRE_SPILL_THRESHOLD_BYTES', DEFAULT_SPILL_THRESHOLD_BYTES))
+SPILL_MEMBER_THRESHOLD_BYTES = int(os.environ.get(
+    'TRE_SPILL_MEMBER_THRESHOLD_BYTES', DEFAULT_SPILL_MEMBER_THRESHOLD_BYTES))
+
+
+def should_spill(size, threshold=None):
+    """
+    Return `True` if an object of `size` bytes should be spilled to disk.
+    """
+    threshold = SPILL_THRESHOLD_BYTES if threshold is None else threshold
+    return size is not None and size > threshold
+
+
+def should_stream_member(size):
+    """
+    Return `True` if a tar member of `size` bytes should be streamed rather
+    than read into memory.
+    """
+    return should_spill(size, threshold=SPILL_MEMBER_THRESHOLD_BYTES)
+
+
+def has_free_space(size, spill_dir=None):
+    """
+    Return `True` if `spill_dir` has `size` bytes free.
+    """
+    spill_dir = SPILL_DIR if spill_dir is None else spill_dir
+    free_bytes = shutil.disk_usage(spill_dir).free
+    logger.info(f'spill_dir={spill_dir} free_bytes={free_bytes} size={size}')
+    return size is None or size <= free_bytes
+
+
+def raise_error_if_insufficient_space(size, spill_dir=None):
+    """
+    Raise an S3LibError if `spill_dir` does not have `size` bytes free.
+    """
+    spill_dir = SPILL_DIR if spill_dir is None else spill_dir
+    if not has_free_space(size, spill_dir):
+        free_bytes = shutil.disk_usage(spill_dir).free
+        raise common_lib.S3LibError(
+            f'Insufficient ephemeral storage to spill {size} bytes to '
+            f'"{spill_dir}"; {free_bytes} bytes free')
+
+
+class TeeReader:
+    """
+    Wraps readable `stream`, writing everything read to writable `sink`.
+    """
+    def __init__(self, stream, sink):
+        self.stream = stream
+        self.sink = sink
+
+    def read(self, size=-1):
+        chunk = self.stream.read(size)
+        self.sink.write(chunk)
+        return chunk
+
+    def seekable(self):
+        return False
+
+
+def copy_stream(stream, sink, inspect=None):
+    """
+    Copy readable `stream` to writable `sink` using a bounded buffer. If
+    `inspect` is given, it is first called with a non-seekable reader of
+    `stream` (the content it reads is copied as it is read); if it returns
+    False the rest of `stream` is not read and False is returned.
+    """
+    reader = TeeReader(stream, sink)
+    if inspect is not None and not inspect(reader):
+        logger.info('copy_stream: abandoned after inspection')
+        return False
+    for _ in iter(lambda: reader.read(READ_BLOCK_SIZE), b''):
+        pass
+    return True
+
+
+def stream_to_spill_file(stream, size=None, spill_dir=None, inspect=None):
+    """
+    Copy readable `stream` to a new file in `spill_dir` using a bounded
+    buffer and return the file's path. The caller must remove the file; see
+    `spill_file`. If `inspect` is given it reads `stream` as it is copied;
+    if it returns False the copy is abandoned and `None` is returned (see
+    `copy_stream`).
+    """
+    spill_dir = SPILL_DIR if spill_dir is None else spill_dir
+    raise_error_if_insufficient_space(size, spill_dir)
+    fd, path = tempfile.mkstemp(prefix=SPILL_FILE_PREFIX, dir=spill_dir)
+    logger.info(f'stream_to_spill_file start: path={path} size={size}')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            copied = copy_stream(stream, f, inspect=inspect)
+    except Exception:
+        os.remove(path)
+        raise
+
+    if not copied:
+        os.remove(path)
+        logger.info('stream_to_spill_file return: abandoned')
+        return None
+
+    logger.info(f'stream_to_spill_file return: bytes={os.path.getsize(path)}')
+    return path
+
+
+@contextlib.contextmanager
+def spill_file(stream, size=None, spill_dir=None, inspect=None):
+    """
+    Context manager that spills `stream` to disk and yields a read-only
+    memory map of the spilled file; the file is removed on exit. If
+    `inspect` is given and returns False, `None` is yielded instead (see
+    `stream_to_spill_file`).
+    """
+    path = stream_to_spill_file(stream, size=size, spill_dir=spill_dir, inspect=inspect)
+    if path is None:
+        yield None
+        return
+
+    try:
+        with open_mmap(path) as mm:
+            yield mm
+    finally:
+        logger.info(f'Removing spill file {path}')
+        os.remove(path)
+
+
+@contextlib.contextmanager
+def open_mmap(path):
+    """
+    Context manager yielding a read-only memory map of the file at `path`.
+    Empty files cannot be mapped, so an empty buffer is yielded instead.
+    """
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield io.BytesIO()
+            return
+
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            yield mm
+        finally:
+            mm.close()
+
+
+def spooled_buffer(max_size=None, spill_dir=None):
+    """
+    Return a writable buffer that is held in memory until it exceeds
+    `max_size` bytes, at which point it is transparently moved to disk.
+    """
+    max_size = SPILL_THRESHOLD_BYTES if max_size is None else max_size
+    spill_dir = SPILL_DIR if spill_dir is None else spill_dir
+    return tempfile.SpooledTemporaryFile(
+        max_size=max_size, prefix=SPILL_FILE_PREFIX, dir=spill_dir)
+
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""
+Consignment summary object; written once when a bag is validated so that
+downstream steps can load bag-info, manifests, file sizes and file metadata
+with a single GET instead of re-reading and re-parsing the extracted bag.
+
+The summary is stored next to the extracted bag, at `<s3-object-root>` with
+suffix `.summary.json`, so its location can be derived from existing event
+fields.
+"""
+import logging
+import os
+import json
+import botocore.exceptions
+from s3_lib import common_lib
+from s3_lib import object_lib
+from s3_lib import checksum_lib
+
+# Set global logging options; AWS environment may override this though
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+SUMMARY_VERSION = 1
+SUMMARY_OBJECT_SUFFIX = '.summary.json'
+BAG_INFO_TEXT = 'bag-info.txt'
+TAG_MANIFEST = 'tagmanifest-sha256.txt'
+DATA_MANIFEST = 'manifest-sha256.txt'
+FILE_METADATA = 'file-metadata.csv'
+DATA_PREFIX = 'data/'
+
+KEY_VERSION = 'version'
+KEY_S3_BUCKET = 's3-bucket'
+KEY_S3_OBJECT_ROOT = 's3-object-root'
+KEY_BAG_INFO = 'bag-info'
+KEY_TAG_MANIFEST = 'tag-manifest'
+KEY_MANIFEST = 'manifest'
+KEY_SIZES = 'sizes'
+KEY_METADATA = 'metadata'
+
+# Without s3:ListBucket a missing object gives AccessDenied, not NoSuchKey
+MISSING_OBJECT_ERROR_CODES = ('NoSuchKey', '404', 'AccessDenied', '403')
+
+
+def get_summary_key(s3_object_root):
+    """
+    Return the summary object name for the bag extracted at `s3_object_root`.
+    """
+    return s3_object_root.rstrip(object_lib.S3_PATH_SEPARATOR) + SUMMARY_OBJECT_SUFFIX
+
+
+def build_consignment_summary(
+        s3_bucket,
+        s3_object_root,
+        object_sizes,
+        tag_manifest=None,
+        data_manifest=None,
+        bag_info=None,
+        metadata=None):
+    """
+    Return a summary dictionary for the bag extracted to `s3_object_root` in
+    `s3_bucket`. `object_sizes` is a dictionary of extracted object name to
+    size in bytes. Paths in the summary are relative to the bag's root.
+
+    Already parsed manifests (lists of `checksum_lib` items), bag-info and
+    file metadata rows can be passed in; any that are `None` are read from
+    the extracted bag.
+    """
+    logger.info(
+        f'build_consignment_summary start: s3_bucket={s3_bucket} '
+        f's3_object_root={s3_object_root}')
+    root = s3_object_root.rstrip(object_lib.S3_PATH_SEPARATOR) + object_lib.S3_PATH_SEPARATOR
+    if tag_manifest is None:
+        tag_manifest = checksum_lib.get_manifest_s3(s3_bucket, root + TAG_MANIFEST)
+    if data_manifest is None:
+        data_manifest = checksum_lib.get_manifest_s3(s3_bucket, root + DATA_MANIFEST)
+    tag_files = [item[checksum_lib.ITEM_FILE] for item in tag_manifest]
+    if bag_info is None:
+        bag_info = object_lib.s3_object_to_dictionary(s3_bucket, root + BAG_INFO_TEXT)
+    if metadata is None:
+        metadata = (
+            object_lib.s3_object_to_csv(s3_bucket, root + FILE_METADATA)
+            if FILE_METADATA in tag_files else [])
+
+    summary = {
+        KEY_VERSION: SUMMARY_VERSION,
+        KEY_S3_BUCKET: s3_bucket,
+        KEY_S3_OBJECT_ROOT: s3_object_root,
+        KEY_BAG_INFO: bag_info,
+        KEY_TAG_MANIFEST: {
+            item[checksum_lib.ITEM_FILE]: item[checksum_lib.ITEM_CHECKSUM]
+            for item in tag_manifest
+        },
+        KEY_MANIFEST: {
+            item[checksum_lib.ITEM_FILE]: item[checksum_lib.ITEM_CHECKSUM]
+            for item in data_manifest
+        },
+        KEY_SIZES: {
+            name[len(root):]: size
+            for name, size in object_sizes.items()
+            if name.startswith(root)
+        },
+        KEY_METADATA: list(metadata)
+    }
+
+    logger.info('build_consignment_summary return')
+    return summary
+
+
+def write_consignment_summary(summary):
+    """
+    Save `summary` as compact JSON and return the object name used.
+    """
+    key = get_summary_key(summary[KEY_S3_OBJECT_ROOT])
+    logger.info(f'write_consignment_summary: bucket={summary[KEY_S3_BUCKET]} key={key}')
+    object_lib.string_to_s3_object(
+        json.dumps(summary, separators=(',', ':')),
+        summary[KEY_S3_BUCKET],
+        key,
+        allow_overwrite=True)
+    return key
+
+
+def read_consignment_summary(s3_bucket, s3_object_root=None, key=None):
+    """
+    Return the summary for the bag extracted to `s3_object_root` (or at
+    summary object `key`) in `s3_bucket`, or `None` if there isn't one (e.g.
+    for bags validated before summaries were introduced). A missing object
+    reported as access denied (as it is without `s3:ListBucket`) is treated
+    the same as one reported as not found.
+    """
+    key = get_summary_key(s3_object_root) if key is None else key
+    logger.info(f'read_consignment_summary: s3_bucket={s3_bucket} key={key}')
+    try:
+        return object_lib.get_object_json(s3_bucket, key)
+    except common_lib.S3LibError as e:
+        logger.info(f'No consignment summary found: {e}')
+        return None
+    except botocore.exceptions.ClientError as e:
+        if e.response.get('Error', {}).get('Code') not in MISSING_OBJECT_ERROR_CODES:
+            raise
+        logger.info(f'No consignment summary found: {e}')
+        return None
+
+
+def get_manifest_items(summary):
+    """
+    Return the summary's data manifest as a list of `checksum_lib` items.
+    """
+    return [
+        checksum_lib.checksum_item(file, os.path.basename(file), checksum)
+        for file, checksum in summary[KEY_MANIFEST].items()
+    ]
+
+
+def get_data_object_sizes(summary):
+    """
+    Return a dictionary of full s3 object name to size in bytes for the
+    bag's data directory files.
+    """
+    root = summary[KEY_S3_OBJECT_ROOT].rstrip(object_lib.S3_PATH_SEPARATOR) + object_lib.S3_PATH_SEPARATOR
+    return {
+        root + name: size
+        for name, size in summary[KEY_SIZES].items()
+        if name.startswith(DATA_PREFIX)
+    }
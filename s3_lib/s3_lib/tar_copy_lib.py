@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+"""
+Zero-copy assembly of an uncompressed tar archive from s3 objects.
+
+An uncompressed tar is each member's 512 byte header, its content padded to
+a 512 byte block, then an end-of-archive marker. The archive is written as
+an s3 multipart upload in which the content of large members is added with
+`UploadPartCopy` (copied server-side, never downloaded), while headers,
+padding and small members are uploaded as ordinary parts.
+
+Every part except the last must be at least `MIN_PART_BYTES` (5 MB). Small
+pieces are merged into one uploaded part until it is large enough; when a
+large member follows a part that is still too small, just enough of the
+member's start is read (a ranged GET) to fill it, and the rest is copied.
+
+The archive's SHA 256 checksum is calculated as it is assembled, in order:
+uploaded bytes are hashed as they are written and each copied range is
+streamed (a ranged GET) through the hash while it is copied. SHA 256 can't
+be combined from per-part checksums, so every byte has to pass through the
+hash once; this replaces reading the finished archive back. The same pass
+gives each member's checksum, so copied members are verified too. Reads and
+copies of a member are conditional on the ETag from its HEAD request, so
+the bytes hashed are the bytes copied.
+"""
+import logging
+import tarfile  # https://docs.python.org/3/library/tarfile.html
+import collections
+import concurrent.futures
+import datetime
+import hashlib
+import boto3  # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/index.html
+import botocore.exceptions
+from s3_lib import common_lib
+from s3_lib import plan_lib
+from s3_lib import tar_lib
+
+# Set global logging options; AWS environment may override this though
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+MIN_PART_BYTES = 5 * 1024 * 1024
+MAX_PART_BYTES = 5 * 1024 * 1024 * 1024
+MAX_PART_COUNT = 10000
+MAX_PARTS_IN_FLIGHT = 8
+HASH_CHUNK_BYTES = 1024 * 1024
+
+
+class TarMember:
+    """
+    An s3 object to add to the archive as `name`.
+    """
+    def __init__(self, key, name, size, mtime, etag=None):
+        self.key = key
+        self.name = name
+        self.size = size
+        self.mtime = mtime
+        self.etag = etag
+
+    def to_header(self):
+        tar_info = tarfile.TarInfo(self.name)
+        tar_info.size = self.size
+        tar_info.mtime = self.mtime
+        return tar_info.tobuf(tarfile.DEFAULT_FORMAT, tarfile.ENCODING, 'surrogateescape')
+
+    def __repr__(self):
+        return f'TarMember(key={self.key} name={self.name} size={self.size})'
+
+
+def get_tar_members(s3_client, s3_bucket_in, s3_objects_with_prefix_subs):
+    """
+    Return a `TarMember` for each object in `s3_objects_with_prefix_subs`
+    (`tar_lib.S3objectsToZip` instances), with the size and last modified
+    time from a HEAD request (run concurrently).
+    """
+    names = []
+    for s3_objects_to_zip in tar_lib.get_iterable(s3_objects_with_prefix_subs):
+        tar_drop_prefix = '' if s3_objects_to_zip.prefix_to_remove is None else s3_objects_to_zip.prefix_to_remove
+        tar_add_prefix = '' if s3_objects_to_zip.prefix_to_add is None else s3_objects_to_zip.prefix_to_add
+        for key in s3_objects_to_zip.objects:
+            names.append((key, f'{tar_add_prefix}{key.replace(tar_drop_prefix, "", 1)}'))
+
+    def head(key_and_name):
+        key, name = key_and_name
+        try:
+            response = s3_client.head_object(Bucket=s3_bucket_in, Key=key)
+        except botocore.exceptions.ClientError as e:
+            logger.error(str(e))
+            raise common_lib.S3LibError(
+                f'Unable to find key "{key}" in bucket "{s3_bucket_in}". {str(e)}')
+        return TarMember(
+            key=key,
+            name=name,
+            size=response['ContentLength'],
+            mtime=datetime.datetime.timestamp(response['LastModified']),
+            etag=response['ETag'])
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=plan_lib.DEFAULT_MAX_WORKERS) as executor:
+        return list(executor.map(head, names))
+
+
+def split_copy_range(start, end):
+    """
+    Return `(start, end)` ranges (end exclusive) covering `start` to `end`
+    in near-equal pieces of at most `MAX_PART_BYTES`.
+    """
+    length = end - start
+    count = -(-length // MAX_PART_BYTES)
+    piece = -(-length // count)
+    return [(offset, min(offset + piece, end)) for offset in range(start, end, piece)]
+
+
+class TarPartWriter:
+    """
+    Writes a multipart upload from uploaded byte parts and copied ranges,
+    merging bytes until a part reaches `MIN_PART_BYTES`; `hashlib_sha256`
+    is the SHA 256 of everything written so far.
+    """
+    def __init__(self, s3_client, s3_bucket_in, s3_bucket_out, key):
+        self.s3_client = s3_client
+        self.s3_bucket_in = s3_bucket_in
+        self.s3_bucket_out = s3_bucket_out
+        self.key = key
+        self.buffer = bytearray()
+        self.part_count = 0
+        self.copied_bytes = 0
+        self.uploaded_bytes = 0
+        self.hashlib_sha256 = hashlib.sha256()
+        self.in_flight = collections.deque()
+        self.parts = []
+        self.upload_id = s3_client.create_multipart_upload(
+            Bucket=s3_bucket_out, Key=key)['UploadId']
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_PARTS_IN_FLIGHT)
+
+    def submit(self, function, *args):
+        # Bound memory use; wait for the oldest part before adding more
+        if len(self.in_flight) >= MAX_PARTS_IN_FLIGHT:
+            self.parts.append(self.in_flight.popleft().result())
+        self.part_count += 1
+        if self.part_count > MAX_PART_COUNT:
+            raise common_lib.S3LibError(
+                f'Archive "{self.key}" needs more than {MAX_PART_COUNT} parts')
+        self.in_flight.append(self.executor.submit(function, self.part_count, *args))
+
+    def upload_part(self, part_number, body):
+        response = self.s3_client.upload_part(
+            Bucket=self.s3_bucket_out, Key=self.key, UploadId=self.upload_id,
+            PartNumber=part_number, Body=body)
+        return {'PartNumber': part_number, 'ETag': response['ETag']}
+
+    def copy_part(self, part_number, member, start, end):
+        try:
+            response = self.s3_client.upload_part_copy(
+                Bucket=self.s3_bucket_out, Key=self.key, UploadId=self.upload_id,
+                PartNumber=part_number,
+                CopySource={'Bucket': self.s3_bucket_in, 'Key': member.key},
+                CopySourceRange=f'bytes={start}-{end - 1}',
+                CopySourceIfMatch=member.etag)
+        except botocore.exceptions.ClientError as e:
+            raise common_lib.S3LibError(
+                f'Unable to copy "{member.key}" in bucket "{self.s3_bucket_in}". {str(e)}')
+        return {'PartNumber': part_number, 'ETag': response['CopyPartResult']['ETag']}
+
+    def flush(self):
+        if len(self.buffer) > 0:
+            self.uploaded_bytes += len(self.buffer)
+            self.submit(self.upload_part, bytes(self.buffer))
+            self.buffer = bytearray()
+
+    def write(self, content):
+        self.hashlib_sha256.update(content)
+        self.buffer += content
+        if len(self.buffer) >= MIN_PART_BYTES:
+            self.flush()
+
+    def get_range(self, member, start, end):
+        """
+        Return the body of a GET of `member` from `start` to `end` (end
+        exclusive), failing if the object has changed since its HEAD.
+        """
+        try:
+            return self.s3_client.get_object(
+                Bucket=self.s3_bucket_in, Key=member.key,
+                Range=f'bytes={start}-{end - 1}', IfMatch=member.etag)['Body']
+        except botocore.exceptions.ClientError as e:
+            raise common_lib.S3LibError(
+                f'Unable to read "{member.key}" in bucket "{self.s3_bucket_in}". {str(e)}')
+
+    def hash_range(self, member, start, end, member_sha256):
+        """
+        Stream `member` from `start` to `end` through the archive's hash and
+        `member_sha256` (without adding it to the upload, as it is copied).
+        """
+        size = 0
+        for chunk in self.get_range(member, start, end).iter_chunks(HASH_CHUNK_BYTES):
+            self.hashlib_sha256.update(chunk)
+            member_sha256.update(chunk)
+            size += len(chunk)
+        if size != end - start:
+            raise common_lib.S3LibError(
+                f'Read {size} bytes of "{member.key}" from {start} but expected {end - start}')
+
+    def write_object(self, member):
+        """
+        Add the content of `member`; copied server-side unless it is too
+        small to make a part of its own. Returns the content's SHA 256
+        checksum.
+        """
+        if member.size == 0:
+            return hashlib.sha256().hexdigest()
+
+        # Bytes needed from the object's start to fill the pending part
+        # (`write` never leaves a full part pending)
+        fill = MIN_PART_BYTES - len(self.buffer) if len(self.buffer) > 0 else 0
+
+        if member.size - fill < MIN_PART_BYTES:
+            content = self.get_range(member, 0, member.size).read()
+            self.write(content)
+            return hashlib.sha256(content).hexdigest()
+
+        member_sha256 = hashlib.sha256()
+        if fill > 0:
+            content = self.get_range(member, 0, fill).read()
+            member_sha256.update(content)
+            self.write(content)
+        for start, end in split_copy_range(fill, member.size):
+            self.copied_bytes += end - start
+            self.submit(self.copy_part, member, start, end)
+        # Hash the copied bytes (in order) while the copies run
+        self.hash_range(member, fill, member.size, member_sha256)
+        return member_sha256.hexdigest()
+
+    def complete(self):
+        """
+        Complete the upload; return the archive's SHA 256 checksum.
+        """
+        self.flush()
+        while self.in_flight:
+            self.parts.append(self.in_flight.popleft().result())
+        self.executor.shutdown()
+        self.s3_client.complete_multipart_upload(
+            Bucket=self.s3_bucket_out, Key=self.key, UploadId=self.upload_id,
+            MultipartUpload={'Parts': self.parts})
+        return self.hashlib_sha256.hexdigest()
+
+    def abort(self):
+        for future in self.in_flight:
+            future.cancel()
+        self.executor.shutdown()
+        self.s3_client.abort_multipart_upload(
+            Bucket=self.s3_bucket_out, Key=self.key, UploadId=self.upload_id)
+
+
+def s3_objects_to_s3_tar_file_with_checksum(
+        s3_bucket_in,
+        s3_objects_with_prefix_subs,
+        tar_object,
+        s3_bucket_out=None,
+        expected_checksums=None):
+    """
+    Write `s3_objects_with_prefix_subs` (s3 objects + a prefix to remove and
+    a prefix to add) from bucket `s3_bucket_in` to uncompressed tar
+    `tar_object` in `s3_bucket_out`, or `s3_bucket_in` if `s3_bucket_out` is
+    not specified; the same inputs and output as
+    `tar_lib.s3_objects_to_s3_tar_gz_file_with_checksum`, but member content
+    is copied server-side where possible. Returns the archive's items and
+    its SHA 256 checksum, calculated as it is assembled.
+
+    Each member is hashed as it is added (copied members as they are
+    copied) and checked against `expected_checksums` (s3 object name to
+    checksum), with its SHA 256 checksum in the returned items.
+    """
+    expected_checksums = {} if expected_checksums is None else expected_checksums
+    s3_bucket_out = s3_bucket_in if s3_bucket_out is None else s3_bucket_out
+    logger.info(
+        f's3_objects_to_s3_tar_file_with_checksum start: '
+        f's3_bucket_in={s3_bucket_in} tar_object={tar_object} '
+        f's3_bucket_out={s3_bucket_out}')
+    s3_client = boto3.client('s3')
+    members = get_tar_members(s3_client, s3_bucket_in, s3_objects_with_prefix_subs)
+
+    writer = TarPartWriter(s3_client, s3_bucket_in, s3_bucket_out, tar_object)
+    tar_items = []
+    checksum_errors = []
+    offset = 0
+    try:
+        for member in members:
+            logger.info(f'member={member}')
+            header = member.to_header()
+            writer.write(header)
+            checksum = writer.write_object(member)
+            padding = -member.size % tarfile.BLOCKSIZE
+            writer.write(tarfile.NUL * padding)
+            offset += len(header) + member.size + padding
+            tar_items.append({'name': member.name, 'size': member.size, 'sha256': checksum})
+            expected_checksum = expected_checksums.get(member.key)
+            if expected_checksum is not None and checksum != expected_checksum.lower():
+                checksum_errors.append(
+                    f'"{member.key}" has checksum "{checksum}" but '
+                    f'"{expected_checksum}" was expected')
+
+        if checksum_errors:
+            raise ValueError(
+                f'{len(checksum_errors)} file(s) changed since validation: '
+                + '; '.join(checksum_errors))
+
+        # End-of-archive marker, padded to a whole record (as tarfile does)
+        end = tarfile.NUL * (tarfile.BLOCKSIZE * 2)
+        offset += len(end)
+        end += tarfile.NUL * (-offset % tarfile.RECORDSIZE)
+        writer.write(end)
+        tar_checksum = writer.complete()
+    except Exception as e:
+        logger.error(f'Error writing tar "{tar_object}": {e}')
+        writer.abort()
+        raise
+
+    logger.info(
+        f's3_objects_to_s3_tar_file_with_checksum return: '
+        f'members={len(tar_items)} parts={writer.part_count} '
+        f'copied_bytes={writer.copied_bytes} uploaded_bytes={writer.uploaded_bytes} '
+        f'tar_checksum={tar_checksum}')
+    return tar_items, tar_checksum
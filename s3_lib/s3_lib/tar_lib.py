@@ -5,8 +5,12 @@ import tarfile  # https://docs.python.org/3/library/tarfile.html
 import io
 import os
 import collections.abc
+import contextlib
 import datetime
+import hashlib
 from s3_lib import common_lib
+from s3_lib import spill_lib
+from s3_lib import plan_lib
 
 # Set global logging options; AWS environment may override this though
 logging.basicConfig(
@@ -41,27 +45,82 @@ def untar_s3_object(
 
     output_bucket_name = input_bucket_name if output_bucket_name is None else output_bucket_name
     s3_client = boto3.client('s3')
-    s3_input_object = s3_client.get_object(Bucket=input_bucket_name, Key=object_name)
-    tar_stream = io.BytesIO(s3_input_object['Body'].read())
+    with open_s3_tar_stream(s3_client, input_bucket_name, object_name) as tar_stream:
+        extracted_object_names = untar_stream_to_s3(
+            s3_client, tar_stream, output_bucket_name, output_prefix)
+
+    logger.info('untar_s3_object return')
+    return extracted_object_names
+
+@contextlib.contextmanager
+def open_s3_tar_stream(s3_client, bucket_name, object_name, plan=None, inspect=None):
+    """
+    Context manager that yields a seekable stream of s3 `object_name` in
+    `bucket_name`; archives the execution `plan` says to spill (by default
+    planned from the object's size) are spilled to ephemeral storage and
+    read via mmap, others are read into memory.
+
+    If `inspect` is given, it is called with a non-seekable stream of the
+    object as it is downloaded (e.g. to read the tar headers with
+    `tarfile.open(mode='r|*')`); if it returns False the download is
+    abandoned and `None` is yielded.
+    """
+    s3_input_object = s3_client.get_object(Bucket=bucket_name, Key=object_name)
+    content_length = s3_input_object['ContentLength']
+    body = s3_input_object['Body']
+    if plan is None:
+        plan = plan_lib.plan_execution(content_length)
+
+    try:
+        if plan.spill_archive:
+            logger.info(f'Spilling {content_length} byte archive to ephemeral storage')
+            with spill_lib.spill_file(body, size=content_length, inspect=inspect) as tar_stream:
+                yield tar_stream
+        elif inspect is None:
+            yield io.BytesIO(body.read())
+        else:
+            tar_stream = io.BytesIO()
+            copied = spill_lib.copy_stream(body, tar_stream, inspect=inspect)
+            tar_stream.seek(0)
+            yield tar_stream if copied else None
+    finally:
+        # Stops the download if the body was not read to the end
+        body.close()
+
+def get_member_object_name(item, output_prefix=''):
+    """
+    Return the s3 object name for tar member `item`; i.e. its name without
+    any leading `./`, prefixed with `output_prefix`.
+    """
+    # No .removeprefix method in Python 3.8; check with if instead
+    member_name = item.name[2:] if item.name.startswith('./') else item.name
+    return output_prefix + member_name
+
+def untar_stream_to_s3(s3_client, tar_stream, output_bucket_name, output_prefix):
+    """
+    Write each file in the tar archive `tar_stream` to `output_bucket_name`
+    with name prefix `output_prefix`; return the list of object names written.
+    Large members are streamed to s3 instead of being read into memory.
+    """
     extracted_object_names = []
 
     with tarfile.open(fileobj=tar_stream) as tar_content:
         for item in tar_content:
             logger.info(f'item.isdir()={item.isdir()} item.isFile()={item.isfile()} item.name={item.name} item={item}')
             if item.isfile():
-                # No .removeprefix method in Python 3.8; check with if instead
-                output_object_name = item.name[2:] if item.name.startswith('./') else item.name
-                output_object_name = output_prefix + output_object_name
+                output_object_name = get_member_object_name(item, output_prefix)
                 logger.info(f'output_object_name={output_object_name}')
-                item_stream = tar_content.extractfile(item).read()
+                if spill_lib.should_stream_member(item.size):
+                    item_stream = tar_content.extractfile(item)
+                else:
+                    item_stream = io.BytesIO(tar_content.extractfile(item).read())
                 s3_client.upload_fileobj(
-                    io.BytesIO(item_stream),
+                    item_stream,
                     Bucket=output_bucket_name,
                     Key=output_object_name)
                 # Add extracted object's name to output summary
                 extracted_object_names.append(output_object_name)
 
-    logger.info('untar_s3_object return')
     return extracted_object_names
 
 def s3_objects_to_s3_tar_gz_file(
@@ -83,8 +142,9 @@ def s3_objects_to_s3_tar_gz_file(
     # Track the tar.gz archive's objects
     tar_items = []
 
-    # Initialise for tar.gz
-    tar_stream = io.BytesIO()
+    # Initialise for tar.gz; moves to ephemeral storage if it grows too large
+    tar_stream = spill_lib.spooled_buffer(
+        max_size=plan_lib.get_spill_threshold_bytes())
     tar = tarfile.open(mode='w:gz', fileobj=tar_stream)
 
     # Get each s3 object, write it to tar.gz with required name and size info
@@ -104,7 +164,7 @@ def s3_objects_to_s3_tar_gz_file(
             # Determine file name inside tar, and its size
             tar_info = tarfile.TarInfo(object_name)
             tar_info.size = s3_object['ContentLength']
-            tar.addfile(tar_info, io.BytesIO(s3_object['Body'].read()))
+            add_s3_object_to_tar(tar, tar_info, s3_object)
             tar_items.append({'name': object_name, 'size': tar_info.size})
     finally:
         logger.info('tar.close()')
@@ -116,10 +176,7 @@ def s3_objects_to_s3_tar_gz_file(
         f's3_client.put_object s3_bucket_out={s3_bucket_out} '
         f'tar_gz_object={tar_gz_object}')
 
-    s3_client.put_object(
-        Body=tar_stream.getvalue(),
-        Bucket=s3_bucket_out,
-        Key=tar_gz_object)
+    upload_buffer_to_s3(s3_client, tar_stream, s3_bucket_out, tar_gz_object)
 
     logger.info('s3_objects_to_s3_tar_gz_file: return')
     return tar_items
@@ -129,18 +186,47 @@ def s3_objects_to_s3_tar_gz_file_with_prefix_substitution(
         s3_bucket_in,
         s3_objects_with_prefix_subs,
         tar_gz_object,
-        s3_bucket_out=None):
+        s3_bucket_out=None,
+        expected_checksums=None):
     """
     Write `s3_objects_with_prefix_subs`  (s3 objects + a prefix to remove and a prefix to add)
     from bucket `s3_bucket_in` to `tar_gz_object` in `s3_bucket_out`,
     or `s3_bucket_in` if `s3_bucket_out` is not specified.
+
+    Each object is hashed as it is added; the returned items include its
+    SHA 256 checksum. If `expected_checksums` (s3 object name to checksum)
+    is given, any listed object whose checksum differs is reported in a
+    `ValueError` and the archive is not written.
     """
+    tar_items, _ = s3_objects_to_s3_tar_gz_file_with_checksum(
+        s3_bucket_in=s3_bucket_in,
+        s3_objects_with_prefix_subs=s3_objects_with_prefix_subs,
+        tar_gz_object=tar_gz_object,
+        s3_bucket_out=s3_bucket_out,
+        expected_checksums=expected_checksums)
+    return tar_items
 
-    # Track the tar.gz archive's objects
+
+def s3_objects_to_s3_tar_gz_file_with_checksum(
+        s3_bucket_in,
+        s3_objects_with_prefix_subs,
+        tar_gz_object,
+        s3_bucket_out=None,
+        expected_checksums=None):
+    """
+    As `s3_objects_to_s3_tar_gz_file_with_prefix_substitution`, but return
+    the archive's items and its SHA 256 checksum, calculated as it is
+    uploaded (so the archive doesn't need to be read back).
+    """
+    expected_checksums = {} if expected_checksums is None else expected_checksums
+
+    # Track the tar.gz archive's objects, and any that fail verification
     tar_items = []
+    checksum_errors = []
 
-    # Initialise for tar.gz
-    tar_stream = io.BytesIO()
+    # Initialise for tar.gz; moves to ephemeral storage if it grows too large
+    tar_stream = spill_lib.spooled_buffer(
+        max_size=plan_lib.get_spill_threshold_bytes())
     tar = tarfile.open(mode='w:gz', fileobj=tar_stream)
 
     # Get each s3 object, write it to tar.gz with required name and size info
@@ -155,40 +241,107 @@ def s3_objects_to_s3_tar_gz_file_with_prefix_substitution(
                 f's3_objects_to_s3_tar_gz_file: start: s3_bucket_in={s3_bucket_in} '
                 f's3_object_names={s3_objects_to_zip} tar_gz_object={tar_gz_object} '
                 f's3_bucket_out={s3_bucket_out} tar_drop_prefix-{tar_drop_prefix} tar_add_prefix={tar_add_prefix}')
-            for s3_object in s3_objects_to_zip.objects:
-                object_name_without_prefix = s3_object.replace(tar_drop_prefix, "", 1)
+            for s3_object_name in s3_objects_to_zip.objects:
+                object_name_without_prefix = s3_object_name.replace(tar_drop_prefix, "", 1)
                 object_name = f'{tar_add_prefix}{object_name_without_prefix}'
-                logger.info(f's3_object_name={s3_object} object_name={object_name}')
+                logger.info(f's3_object_name={s3_object_name} object_name={object_name}')
                 try:
-                    s3_object = s3_client.get_object(Bucket=s3_bucket_in, Key=s3_object)
+                    s3_object = s3_client.get_object(Bucket=s3_bucket_in, Key=s3_object_name)
                 except s3_client.exceptions.NoSuchKey as e:
                     logger.error(str(e))
                     raise common_lib.S3LibError(
-                        f'Unable to find key "{s3_object}" in '
+                        f'Unable to find key "{s3_object_name}" in '
                         f'bucket "{s3_bucket_in}". {str(e)}')
                 # Determine file name inside tar, and its size + last modified
                 tar_info = tarfile.TarInfo(object_name)
                 tar_info.size = s3_object['ContentLength']
                 tar_info.mtime = datetime.datetime.timestamp(s3_object['LastModified'])
-                tar.addfile(tar_info, io.BytesIO(s3_object['Body'].read()))
-                tar_items.append({'name': object_name, 'size': tar_info.size})
+                checksum = add_s3_object_to_tar(tar, tar_info, s3_object)
+                tar_items.append({'name': object_name, 'size': tar_info.size, 'sha256': checksum})
+                expected_checksum = expected_checksums.get(s3_object_name)
+                if expected_checksum is not None and checksum != expected_checksum.lower():
+                    checksum_errors.append(
+                        f'"{s3_object_name}" has checksum "{checksum}" but '
+                        f'"{expected_checksum}" was expected')
     finally:
         logger.info('tar.close()')
         tar.close()
 
+    if checksum_errors:
+        tar_stream.close()
+        raise ValueError(
+            f'{len(checksum_errors)} file(s) changed since validation: '
+            + '; '.join(checksum_errors))
+
     # Write the tar object to s3
     s3_bucket_out = s3_bucket_in if s3_bucket_out is None else s3_bucket_out
     logger.info(
         f's3_client.put_object s3_bucket_out={s3_bucket_out} '
         f'tar_gz_object={tar_gz_object}')
 
-    s3_client.put_object(
-        Body=tar_stream.getvalue(),
-        Bucket=s3_bucket_out,
-        Key=tar_gz_object)
+    tar_checksum = upload_buffer_to_s3(s3_client, tar_stream, s3_bucket_out, tar_gz_object)
 
-    logger.info('s3_objects_to_s3_tar_gz_file: return')
-    return tar_items
+    logger.info(f's3_objects_to_s3_tar_gz_file: return: tar_checksum={tar_checksum}')
+    return tar_items, tar_checksum
+
+
+def add_s3_object_to_tar(tar, tar_info, s3_object):
+    """
+    Add the body of `s3_object` (a `get_object` response) to `tar` using
+    `tar_info` and return its SHA 256 checksum, calculated as it is added;
+    large bodies are streamed rather than read into memory.
+    """
+    if spill_lib.should_stream_member(tar_info.size):
+        body = HashingReader(s3_object['Body'])
+        tar.addfile(tar_info, body)
+        return body.hexdigest()
+    else:
+        content = s3_object['Body'].read()
+        tar.addfile(tar_info, io.BytesIO(content))
+        return hashlib.sha256(content).hexdigest()
+
+
+class HashingReader:
+    """
+    Wraps readable `stream`, hashing (SHA-256) and counting the content as it
+    is read. Being non-seekable ensures s3 uploads read it in order.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.hashlib_sha256 = hashlib.sha256()
+        self.size = 0
+
+    def read(self, size=-1):
+        chunk = self.stream.read(size)
+        self.hashlib_sha256.update(chunk)
+        self.size += len(chunk)
+        return chunk
+
+    def seekable(self):
+        return False
+
+    def hexdigest(self):
+        return self.hashlib_sha256.hexdigest()
+
+
+def upload_buffer_to_s3(s3_client, buffer, bucket, key):
+    """
+    Upload the content of `buffer` (in memory or spilled to disk) to `key` in
+    `bucket`, then close the buffer; return the SHA 256 checksum of the
+    content, calculated as it is uploaded.
+    """
+    size = buffer.tell()
+    logger.info(f'upload_buffer_to_s3: bucket={bucket} key={key} size={size}')
+    try:
+        buffer.seek(0)
+        reader = HashingReader(buffer)
+        s3_client.upload_fileobj(reader, Bucket=bucket, Key=key)
+    finally:
+        buffer.close()
+    if reader.size != size:
+        raise common_lib.S3LibError(
+            f'Uploaded {reader.size} bytes to "{key}" in bucket "{bucket}" but expected {size}')
+    return reader.hexdigest()
 
 
 class S3objectsToZip:
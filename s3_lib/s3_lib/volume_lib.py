@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Multi-volume archive output.
+
+A large set of s3 objects is split into size-bounded volumes, which are
+built in parallel (each by a caller-supplied function, e.g. a `tar_lib`
+builder); each volume is a separate object a consumer can fetch (and
+retry) on its own.
+
+The volume size limit is set with environment variable
+`TRE_SIP_VOLUME_MAX_BYTES`; if unset, everything goes in one volume.
+"""
+import logging
+import threading
+import concurrent.futures
+from s3_lib import common_lib
+from s3_lib import plan_lib
+
+# Set global logging options; AWS environment may override this though
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def get_volume_max_bytes():
+    """
+    Return the volume size limit, or `None` for a single volume.
+    """
+    return plan_lib.get_env_number('TRE_SIP_VOLUME_MAX_BYTES')
+
+
+def split_into_volumes(object_sizes, max_volume_bytes=None):
+    """
+    Return lists of object names from `object_sizes` (a dictionary of object
+    name to size in bytes) with at most `max_volume_bytes` in each list; the
+    input order is kept, so objects from the same folder stay together. An
+    object larger than the limit gets a volume of its own.
+    """
+    if max_volume_bytes is None:
+        return [list(object_sizes)]
+    if max_volume_bytes <= 0:
+        raise common_lib.S3LibError(f'Invalid volume size limit {max_volume_bytes}')
+
+    volumes = []
+    volume = []
+    volume_bytes = 0
+    for name, size in object_sizes.items():
+        if volume and volume_bytes + size > max_volume_bytes:
+            volumes.append(volume)
+            volume = []
+            volume_bytes = 0
+        volume.append(name)
+        volume_bytes += size
+    if volume or not volumes:
+        volumes.append(volume)
+
+    logger.info(
+        f'split_into_volumes: {len(object_sizes)} objects in {len(volumes)} '
+        f'volumes of at most {max_volume_bytes} bytes')
+    return volumes
+
+
+def get_volume_name(base_name, number, count, extension):
+    """
+    Return the object name for volume `number` (from 1) of `count`; a single
+    volume keeps the plain `<base_name>.<extension>` name.
+    """
+    if count == 1:
+        return f'{base_name}.{extension}'
+    return f'{base_name}.{number:03d}.{extension}'
+
+
+def get_volume_worker_count(volume_count):
+    """
+    Return how many volumes to build at once; each builder may hold up to
+    the spill threshold in memory, so this is bounded by the memory budget
+    as well as `TRE_PLAN_MAX_WORKERS`.
+    """
+    by_memory = plan_lib.get_memory_budget_bytes() // max(plan_lib.get_spill_threshold_bytes(), 1)
+    max_workers = plan_lib.get_env_number('TRE_PLAN_MAX_WORKERS', plan_lib.DEFAULT_MAX_WORKERS)
+    return max(min(volume_count, by_memory, max_workers), 1)
+
+
+def build_volumes(volumes, build_volume, max_workers=None):
+    """
+    Call `build_volume(number, object_names)` for each volume in `volumes`
+    in parallel (by at most `max_workers`, if given) and return the results
+    in volume order. If any volume fails, volumes not yet started are
+    skipped and the first error (in volume order) is raised once the others
+    have stopped.
+    """
+    workers = get_volume_worker_count(len(volumes))
+    workers = workers if max_workers is None else max(min(workers, max_workers), 1)
+    logger.info(f'build_volumes start: volumes={len(volumes)} workers={workers}')
+    failed = threading.Event()
+
+    def build(number, object_names):
+        # Volumes start in order, so a skipped volume follows a failed one
+        if failed.is_set():
+            return None
+        try:
+            return build_volume(number, object_names)
+        except Exception:
+            failed.set()
+            raise
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(build, number, object_names)
+            for number, object_names in enumerate(volumes, start=1)
+        ]
+        concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_EXCEPTION)
+        for future in futures:
+            future.cancel()
+        results = [future.result() for future in futures]
+    logger.info('build_volumes return')
+    return results
@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+"""
+Test fixtures for s3_lib: an in-memory stand-in for the boto3 s3 client
+calls s3_lib makes, and in-memory BagIt tar archives.
+
+Use `InMemoryS3Client.patch()` so code calling `boto3.client('s3')` (or
+`boto3.session.Session().client('s3')`) gets the in-memory client, and
+`boto3.resource('s3')` a resource over it.
+"""
+import io
+import types
+import tarfile
+import hashlib
+import datetime
+import itertools
+import threading
+import unittest.mock
+import boto3
+import botocore.exceptions
+
+BAG_ROOT = 'consignments/ABC-123/bag'
+LAST_MODIFIED = datetime.datetime(2026, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def client_error(code, operation_name):
+    return botocore.exceptions.ClientError(
+        {'Error': {'Code': code, 'Message': code}}, operation_name)
+
+
+class NoSuchKey(Exception):
+    pass
+
+
+class Body(io.BytesIO):
+    """
+    `get_object` response body.
+    """
+    def iter_chunks(self, chunk_size=1024):
+        return iter(lambda: self.read(chunk_size), b'')
+
+
+def get_range(content, range_header):
+    """
+    Return the part of `content` selected by `range_header` (`bytes=a-b`).
+    """
+    if range_header is None:
+        return content
+    start, end = range_header[len('bytes='):].split('-')
+    return content[int(start):int(end) + 1]
+
+
+class Paginator:
+    def __init__(self, client):
+        self.client = client
+
+    def paginate(self, Bucket, Prefix='', Delimiter=None):
+        yield self.client.list_objects_v2(Bucket=Bucket, Prefix=Prefix, Delimiter=Delimiter)
+
+
+class Resource:
+    """
+    The parts of `boto3.resource('s3')` s3_lib uses, over an
+    `InMemoryS3Client`.
+    """
+    def __init__(self, client):
+        self.client = client
+
+    def Bucket(self, name):
+        def object_filter(Prefix=''):
+            return [
+                types.SimpleNamespace(key=item['Key'], size=item['Size'])
+                for item in self.client.list_objects_v2(Bucket=name, Prefix=Prefix)['Contents']
+            ]
+        return types.SimpleNamespace(name=name, objects=types.SimpleNamespace(filter=object_filter))
+
+    def Object(self, bucket_name, key):
+        def put(**kwargs):
+            return self.client.put_object(Bucket=bucket_name, Key=key, **kwargs)
+        return types.SimpleNamespace(bucket_name=bucket_name, key=key, put=put)
+
+
+class InMemoryS3Client:
+    """
+    Holds objects in `objects`, keyed by (bucket, key); `requests` records
+    (operation, key) for each call, e.g. to check what was read. Multipart
+    uploads in progress are in `uploads`; as in s3, every part but the last
+    must be at least `min_part_bytes`.
+    """
+    class exceptions:
+        NoSuchKey = NoSuchKey
+
+    def __init__(self):
+        self.objects = {}
+        self.requests = []
+        self.uploads = {}
+        self.upload_ids = itertools.count(1)
+        self.min_part_bytes = 5 * 1024 * 1024
+        self.lock = threading.Lock()
+
+    def patch(self):
+        # `boto3.client` and `boto3.resource` use the default session's too
+        return unittest.mock.patch.multiple(
+            boto3.session.Session,
+            client=unittest.mock.Mock(return_value=self),
+            resource=unittest.mock.Mock(return_value=Resource(self)))
+
+    def get_etag(self, bucket, key):
+        return '"' + hashlib.md5(self.objects[(bucket, key)]).hexdigest() + '"'
+
+    def get_source(self, copy_source, operation_name, if_match=None):
+        source = (copy_source['Bucket'], copy_source['Key'])
+        if source not in self.objects:
+            raise client_error('NoSuchKey', operation_name)
+        if if_match is not None and self.get_etag(*source) != if_match:
+            raise client_error('PreconditionFailed', operation_name)
+        return self.objects[source]
+
+    def record(self, operation, key):
+        with self.lock:
+            self.requests.append((operation, key))
+
+    def get_requests(self, operation):
+        return [key for recorded, key in self.requests if recorded == operation]
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None, IfMatch=None, Range=None):
+        self.record('get_object', Key)
+        if (Bucket, Key) not in self.objects:
+            raise NoSuchKey(Key)
+        etag = self.get_etag(Bucket, Key)
+        if IfNoneMatch == etag:
+            raise client_error('304', 'GetObject')
+        if IfMatch is not None and IfMatch != etag:
+            raise client_error('PreconditionFailed', 'GetObject')
+        content = get_range(self.objects[(Bucket, Key)], Range)
+        return {
+            'Body': Body(content), 'ContentLength': len(content), 'ETag': etag,
+            'LastModified': LAST_MODIFIED
+        }
+
+    def head_object(self, Bucket, Key):
+        self.record('head_object', Key)
+        if (Bucket, Key) not in self.objects:
+            raise client_error('404', 'HeadObject')
+        return {
+            'ContentLength': len(self.objects[(Bucket, Key)]),
+            'ETag': self.get_etag(Bucket, Key), 'LastModified': LAST_MODIFIED
+        }
+
+    def put_object(self, Bucket, Key, Body, IfNoneMatch=None, IfMatch=None):
+        self.record('put_object', Key)
+        content = Body.read() if hasattr(Body, 'read') else Body
+        content = content.encode('utf-8') if isinstance(content, str) else bytes(content)
+        with self.lock:
+            exists = (Bucket, Key) in self.objects
+            if IfNoneMatch == '*' and exists:
+                raise client_error('PreconditionFailed', 'PutObject')
+            if IfMatch is not None and (not exists or self.get_etag(Bucket, Key) != IfMatch):
+                raise client_error('PreconditionFailed', 'PutObject')
+            self.objects[(Bucket, Key)] = content
+        return {'ETag': self.get_etag(Bucket, Key)}
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, ExtraArgs=None, Config=None):
+        self.record('upload_fileobj', Key)
+        content = b''.join(iter(lambda: Fileobj.read(8192), b''))
+        with self.lock:
+            self.objects[(Bucket, Key)] = content
+
+    def copy_object(self, CopySource, Bucket, Key):
+        self.record('copy_object', Key)
+        with self.lock:
+            self.objects[(Bucket, Key)] = self.get_source(CopySource, 'CopyObject')
+        return {}
+
+    def create_multipart_upload(self, Bucket, Key):
+        self.record('create_multipart_upload', Key)
+        with self.lock:
+            upload_id = f'upload-{next(self.upload_ids)}'
+            self.uploads[upload_id] = {}
+        return {'UploadId': upload_id}
+
+    def add_part(self, upload_id, part_number, content):
+        with self.lock:
+            self.uploads[upload_id][part_number] = content
+        return '"' + hashlib.md5(content).hexdigest() + '"'
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self.record('upload_part', Key)
+        content = Body.read() if hasattr(Body, 'read') else bytes(Body)
+        return {'ETag': self.add_part(UploadId, PartNumber, content)}
+
+    def upload_part_copy(
+            self, Bucket, Key, UploadId, PartNumber, CopySource,
+            CopySourceRange=None, CopySourceIfMatch=None):
+        self.record('upload_part_copy', CopySource['Key'])
+        content = get_range(
+            self.get_source(CopySource, 'UploadPartCopy', CopySourceIfMatch), CopySourceRange)
+        return {'CopyPartResult': {'ETag': self.add_part(UploadId, PartNumber, content)}}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload, IfNoneMatch=None):
+        self.record('complete_multipart_upload', Key)
+        with self.lock:
+            uploaded = self.uploads[UploadId]
+            parts = MultipartUpload['Parts']
+            numbers = [part['PartNumber'] for part in parts]
+            if numbers != sorted(set(numbers)):
+                raise client_error('InvalidPartOrder', 'CompleteMultipartUpload')
+            for part in parts:
+                content = uploaded.get(part['PartNumber'])
+                if content is None or part['ETag'] != '"' + hashlib.md5(content).hexdigest() + '"':
+                    raise client_error('InvalidPart', 'CompleteMultipartUpload')
+            if any(len(uploaded[number]) < self.min_part_bytes for number in numbers[:-1]):
+                raise client_error('EntityTooSmall', 'CompleteMultipartUpload')
+            if IfNoneMatch == '*' and (Bucket, Key) in self.objects:
+                raise client_error('PreconditionFailed', 'CompleteMultipartUpload')
+            self.objects[(Bucket, Key)] = b''.join(uploaded[number] for number in numbers)
+            del self.uploads[UploadId]
+        return {'ETag': self.get_etag(Bucket, Key)}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.record('abort_multipart_upload', Key)
+        with self.lock:
+            self.uploads.pop(UploadId, None)
+        return {}
+
+    def delete_object(self, Bucket, Key):
+        self.record('delete_object', Key)
+        with self.lock:
+            self.objects.pop((Bucket, Key), None)
+        return {}
+
+    def list_objects_v2(self, Bucket, Prefix='', Delimiter=None):
+        self.record('list_objects_v2', Prefix)
+        contents = []
+        common_prefixes = set()
+        for bucket, key in sorted(self.objects):
+            if bucket != Bucket or not key.startswith(Prefix):
+                continue
+            rest = key[len(Prefix):]
+            if Delimiter is not None and Delimiter in rest:
+                common_prefixes.add(Prefix + rest[:rest.index(Delimiter) + 1])
+            else:
+                contents.append({'Key': key, 'Size': len(self.objects[(bucket, key)])})
+        return {
+            'Contents': contents,
+            'CommonPrefixes': [{'Prefix': prefix} for prefix in sorted(common_prefixes)]
+        }
+
+    def get_paginator(self, operation_name):
+        return Paginator(self)
+
+    def generate_presigned_url(self, ClientMethod, Params, ExpiresIn):
+        return f'https://{Params["Bucket"]}/{Params["Key"]}?expires={ExpiresIn}'
+
+
+def sha256(content):
+    return hashlib.sha256(content).hexdigest()
+
+
+def build_manifest(files):
+    """
+    Return manifest content listing the checksum of each of `files` (a
+    dictionary of relative name to content).
+    """
+    return ''.join(
+        f'{sha256(content)}  {name}\n' for name, content in files.items()
+    ).encode('utf-8')
+
+
+def build_bag_files(data_files):
+    """
+    Return a valid BagIt's files (a dictionary of relative name to content)
+    with the given `data_files` (relative to the BagIt's `data/` folder).
+    """
+    payload = {f'data/{name}': content for name, content in data_files.items()}
+    octets = sum(len(content) for content in payload.values())
+    tag_files = {
+        'bagit.txt': b'BagIt-Version: 1.0\nTag-File-Character-Encoding: UTF-8\n',
+        'bag-info.txt': f'Payload-Oxum: {octets}.{len(payload)}\n'.encode('utf-8'),
+        'manifest-sha256.txt': build_manifest(payload)
+    }
+    tag_files['tagmanifest-sha256.txt'] = build_manifest(tag_files)
+    return dict(tag_files, **payload)
+
+
+def build_tar(files, root='bag', mode='w:gz'):
+    """
+    Return a tar archive (gzip compressed by default) of `files` (a list of
+    (name, content) pairs, or a dictionary) with names prefixed `root/`.
+    """
+    items = files.items() if isinstance(files, dict) else files
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode=mode) as tar:
+        for name, content in items:
+            info = tarfile.TarInfo(f'{root}/{name}' if root else name)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+    return buffer.getvalue()
+
+
+class FakeContext:
+    """
+    Lambda context with a fixed amount of time remaining.
+    """
+    def __init__(self, remaining_ms):
+        self.remaining_ms = remaining_ms
+
+    def get_remaining_time_in_millis(self):
+        return self.remaining_ms
+
+
+class FakeDeadline:
+    """
+    Stand-in for `checkpoint_lib.Deadline` that expires once it has been
+    checked `checks` times.
+    """
+    def __init__(self, checks):
+        self.checks = checks
+
+    @property
+    def expired(self):
+        self.checks -= 1
+        return self.checks < 0
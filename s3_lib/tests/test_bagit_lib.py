@@ -0,0 +1,353 @@
+#!/usr/bin/env python3
+"""
+Module to test single-pass BagIt validation.
+
+Run from the parent directory with: python3 -m unittest discover ./tests
+"""
+import io
+import os
+import json
+import tarfile
+import unittest
+import unittest.mock
+from s3_lib import bagit_lib
+from s3_lib import checkpoint_lib
+from s3_lib import summary_lib
+from fixtures import (
+    BAG_ROOT, InMemoryS3Client, FakeDeadline, build_bag_files, build_tar, sha256)
+
+BUCKET = 'test-bucket'
+BAGIT_NAME = 'consignments/ABC-123/bag.tar.gz'
+OUTPUT_PREFIX = 'consignments/ABC-123/'
+DATA_FILES = {
+    'a.docx': b'a' * 100,
+    'b.docx': b'b' * 200,
+    'c.docx': b'a' * 100
+}
+
+
+class TestCompareSorted(unittest.TestCase):
+    def test_equal(self):
+        self.assertEqual(
+            bagit_lib.compare_sorted({'a': '1', 'b': '2'}, {'b': '2', 'a': '1'}),
+            ([], [], []))
+
+    def test_missing_extra_and_mismatched(self):
+        missing, extra, mismatched = bagit_lib.compare_sorted(
+            {'a': '1', 'b': '2', 'd': '4', 'f': '6'},
+            {'b': '2', 'c': '3', 'd': '0', 'g': '7'})
+        self.assertEqual(missing, ['a', 'f'])
+        self.assertEqual(extra, ['c', 'g'])
+        self.assertEqual(mismatched, ['d'])
+
+    def test_empty(self):
+        self.assertEqual(bagit_lib.compare_sorted({}, {'a': '1'}), ([], ['a'], []))
+        self.assertEqual(bagit_lib.compare_sorted({'a': '1'}, {}), (['a'], [], []))
+
+
+class TestBagValidation(unittest.TestCase):
+    def build_validation(self, files):
+        """
+        Return a `BagValidation` as if `files` had been extracted.
+        """
+        validation = bagit_lib.BagValidation(BAG_ROOT + '/', BUCKET)
+        for name, content in files.items():
+            validation.add_member(
+                name, sha256(content), len(content),
+                content=content if bagit_lib.is_tag_file(name) else None)
+        return validation
+
+    def test_valid(self):
+        validation = self.build_validation(build_bag_files(DATA_FILES)).verify()
+        self.assertTrue(validation.is_valid)
+        self.assertEqual(validation.get_errors(), [])
+        self.assertEqual(
+            sorted(validation.get_validated_files()[bagit_lib.KEY_DATA]),
+            [f'{BAG_ROOT}/data/{name}' for name in sorted(DATA_FILES)])
+
+    def test_missing(self):
+        files = build_bag_files(DATA_FILES)
+        del files['data/b.docx']
+        validation = self.build_validation(files).verify()
+        self.assertFalse(validation.is_valid)
+        self.assertEqual(validation.missing, ['data/b.docx'])
+        self.assertEqual(
+            validation.get_errors(),
+            ['1 file(s) in manifest but not in BagIt: "data/b.docx"'])
+
+    def test_extra(self):
+        files = build_bag_files(DATA_FILES)
+        files['data/z.docx'] = b'z'
+        validation = self.build_validation(files).verify()
+        self.assertFalse(validation.is_valid)
+        self.assertEqual(validation.extra, ['data/z.docx'])
+        self.assertEqual(
+            validation.get_errors(),
+            ['1 file(s) in BagIt but not in manifest: "data/z.docx"'])
+
+    def test_mismatched(self):
+        files = build_bag_files(DATA_FILES)
+        expected = sha256(files['data/b.docx'])
+        files['data/b.docx'] = b'changed'
+        validation = self.build_validation(files).verify()
+        self.assertFalse(validation.is_valid)
+        self.assertEqual(validation.mismatched, ['data/b.docx'])
+        self.assertEqual(
+            validation.get_errors(),
+            ['1 file(s) with incorrect checksum: "data/b.docx": calculated checksum '
+             f'"{sha256(b"changed")}" does not match expected checksum "{expected}"'])
+
+    def test_duplicate(self):
+        files = build_bag_files(DATA_FILES)
+        validation = self.build_validation(files)
+        validation.add_member('data/a.docx', sha256(files['data/a.docx']), 100)
+        validation.verify()
+        self.assertFalse(validation.is_valid)
+        self.assertEqual(
+            validation.get_errors(), ['1 file(s) repeated in BagIt: "data/a.docx"'])
+
+    def test_outside_root(self):
+        validation = self.build_validation(build_bag_files(DATA_FILES))
+        validation.outside_root.append('consignments/ABC-123/other.txt')
+        validation.verify()
+        self.assertFalse(validation.is_valid)
+        self.assertEqual(
+            validation.get_errors(),
+            [f'1 file(s) outside BagIt root "{BAG_ROOT}": '
+             '"consignments/ABC-123/other.txt"'])
+
+    def test_no_tag_manifest(self):
+        files = build_bag_files(DATA_FILES)
+        del files[bagit_lib.TAG_MANIFEST]
+        validation = self.build_validation(files).verify()
+        self.assertFalse(validation.is_valid)
+        self.assertIn(
+            f'File "{bagit_lib.TAG_MANIFEST}" not found in BagIt', validation.get_errors())
+
+    def test_error_file_list_truncated(self):
+        names = [f'data/{i:03d}' for i in range(bagit_lib.MAX_ERROR_FILES + 5)]
+        self.assertTrue(bagit_lib.format_file_list(names).endswith('(and 5 more)'))
+
+    def test_state_round_trip(self):
+        validation = self.build_validation(build_bag_files(DATA_FILES))
+        restored = bagit_lib.BagValidation(BAG_ROOT, BUCKET)
+        self.assertEqual(restored.restore_state(validation.to_state(7)), 7)
+        self.assertEqual(restored.digests, validation.digests)
+        self.assertEqual(restored.tag_files, validation.tag_files)
+        self.assertTrue(restored.verify().is_valid)
+
+
+class TestPreflight(unittest.TestCase):
+    def preflight(self, files):
+        return bagit_lib.preflight_tar_stream(
+            io.BytesIO(build_tar(files)), BAG_ROOT, output_prefix=OUTPUT_PREFIX)
+
+    def test_valid(self):
+        files = build_bag_files(DATA_FILES)
+        profile = self.preflight(files)
+        self.assertEqual(profile.errors, [])
+        self.assertEqual(profile.member_count, len(files))
+        self.assertEqual(profile.total_bytes, sum(len(c) for c in files.values()))
+
+    def test_payload_oxum_mismatch(self):
+        files = build_bag_files(DATA_FILES)
+        files['bag-info.txt'] = b'Payload-Oxum: 1.1\n'
+        self.assertIn(
+            'Payload-Oxum "1.1" does not match BagIt data: 400 bytes in 3 file(s)',
+            self.preflight(files).errors)
+
+    def test_file_not_in_manifest(self):
+        files = build_bag_files(DATA_FILES)
+        files['data/z.docx'] = b''
+        files['bag-info.txt'] = b''
+        self.assertEqual(
+            self.preflight(files).errors,
+            ['1 file(s) in BagIt but not in manifest-sha256.txt: "data/z.docx"'])
+
+    def test_truncated(self):
+        archive = build_tar(build_bag_files(DATA_FILES))
+        profile = bagit_lib.preflight_tar_stream(
+            io.BytesIO(archive[:len(archive) // 2]), BAG_ROOT, output_prefix=OUTPUT_PREFIX)
+        self.assertEqual(len(profile.errors), 1)
+        self.assertTrue(profile.errors[0].startswith('BagIt archive is corrupt or truncated'))
+
+
+class TestUntarAndValidate(unittest.TestCase):
+    def setUp(self):
+        self.s3_client = InMemoryS3Client()
+        patcher = self.s3_client.patch()
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def validate(self, files, **kwargs):
+        self.s3_client.objects[(BUCKET, BAGIT_NAME)] = build_tar(files)
+        return bagit_lib.untar_and_validate_s3_object(
+            BUCKET, BAGIT_NAME, BAG_ROOT, output_prefix=OUTPUT_PREFIX, **kwargs)
+
+    def test_valid(self):
+        files = build_bag_files(DATA_FILES)
+        validation = self.validate(files)
+        self.assertTrue(validation.is_valid)
+        for name, content in files.items():
+            self.assertEqual(self.s3_client.objects[(BUCKET, f'{BAG_ROOT}/{name}')], content)
+        # Nothing extracted is read back to validate it
+        self.assertEqual(self.s3_client.get_requests('get_object'), [BAGIT_NAME])
+
+    def test_mismatched(self):
+        files = build_bag_files(DATA_FILES)
+        files['data/b.docx'] = b'b' * 199 + b'x'
+        validation = self.validate(files)
+        self.assertFalse(validation.is_valid)
+        self.assertEqual(validation.mismatched, ['data/b.docx'])
+
+    def test_failed_preflight_extracts_nothing(self):
+        files = build_bag_files(DATA_FILES)
+        del files['data/b.docx']
+        validation = self.validate(files)
+        self.assertTrue(validation.failed_preflight)
+        self.assertEqual(self.s3_client.get_requests('put_object'), [])
+        self.assertEqual(self.s3_client.get_requests('upload_fileobj'), [])
+
+    def test_duplicate_content_copied(self):
+        validation = self.validate(build_bag_files(DATA_FILES), deduplicate=True)
+        self.assertTrue(validation.is_valid)
+        self.assertEqual(
+            validation.copied, {f'{BAG_ROOT}/data/c.docx': f'{BAG_ROOT}/data/a.docx'})
+        self.assertEqual(
+            self.s3_client.objects[(BUCKET, f'{BAG_ROOT}/data/c.docx')], DATA_FILES['c.docx'])
+
+    def test_large_manifest_read_from_s3(self):
+        files = build_bag_files(DATA_FILES)
+        validation = self.validate(files)
+        del validation.tag_files[bagit_lib.DATA_MANIFEST]
+        self.assertEqual(
+            len(validation.get_manifest(bagit_lib.DATA_MANIFEST)), len(DATA_FILES))
+
+
+class TestCheckpointResume(unittest.TestCase):
+    def setUp(self):
+        self.s3_client = InMemoryS3Client()
+        patcher = self.s3_client.patch()
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.files = build_bag_files(DATA_FILES)
+        self.s3_client.objects[(BUCKET, BAGIT_NAME)] = build_tar(self.files)
+        self.checkpoint = checkpoint_lib.Checkpoint(
+            BUCKET, checkpoint_lib.get_checkpoint_key(BAG_ROOT))
+
+    def validate(self, deadline, resume):
+        return bagit_lib.untar_and_validate_s3_object(
+            BUCKET, BAGIT_NAME, BAG_ROOT, output_prefix=OUTPUT_PREFIX,
+            deadline=deadline, checkpoint=self.checkpoint, resume=resume)
+
+    def get_written(self):
+        return [
+            key for key in (
+                self.s3_client.get_requests('put_object')
+                + self.s3_client.get_requests('upload_fileobj'))
+            if key.startswith(BAG_ROOT + '/')
+        ]
+
+    def test_resume_skips_extracted_members(self):
+        # The first member is always extracted, then two more checks pass
+        validation = self.validate(FakeDeadline(checks=2), resume=False)
+        self.assertFalse(validation.is_complete)
+        self.assertEqual(
+            validation.continuation, self.checkpoint.get_continuation())
+        first_written = self.get_written()
+        self.assertEqual(len(first_written), 3)
+
+        validation = self.validate(FakeDeadline(checks=100), resume=True)
+        self.assertTrue(validation.is_complete)
+        self.assertTrue(validation.is_valid)
+        resumed_written = self.get_written()[len(first_written):]
+        self.assertEqual(set(first_written) & set(resumed_written), set())
+        self.assertEqual(
+            sorted(first_written + resumed_written),
+            sorted(f'{BAG_ROOT}/{name}' for name in self.files))
+        self.assertEqual(len(validation.extracted_object_names), len(self.files))
+        self.assertIsNone(self.checkpoint.load())
+
+    def test_expired_deadline_still_progresses(self):
+        invocations = 0
+        validation = None
+        while validation is None or not validation.is_complete:
+            validation = self.validate(FakeDeadline(checks=0), resume=invocations > 0)
+            invocations += 1
+        self.assertEqual(invocations, len(self.files))
+        self.assertTrue(validation.is_valid)
+        self.assertEqual(len(self.get_written()), len(self.files))
+
+
+class TestStreamedMemberDeduplication(unittest.TestCase):
+    """
+    Members above the stream threshold are looked up by manifest digest in
+    the files extracted by an earlier attempt.
+    """
+    PRIOR_ROOT = 'consignments/ABC-122/bag'
+    PRIOR_CONTENT = b'b' * 200
+
+    def setUp(self):
+        self.s3_client = InMemoryS3Client()
+        for patcher in (
+                self.s3_client.patch(),
+                unittest.mock.patch.dict(
+                    os.environ, {'TRE_SPILL_MEMBER_THRESHOLD_BYTES': '150'}),
+                unittest.mock.patch.object(
+                    tarfile.TarFile, 'extractfile', autospec=True,
+                    side_effect=tarfile.TarFile.extractfile)):
+            self.extractfile = patcher.start()
+            self.addCleanup(patcher.stop)
+        self.s3_client.put_object(
+            Bucket=BUCKET, Key=summary_lib.get_summary_key(self.PRIOR_ROOT),
+            Body=json.dumps({
+                summary_lib.KEY_S3_BUCKET: BUCKET,
+                summary_lib.KEY_S3_OBJECT_ROOT: self.PRIOR_ROOT,
+                summary_lib.KEY_TAG_MANIFEST: {},
+                summary_lib.KEY_MANIFEST: {'data/b.docx': sha256(self.PRIOR_CONTENT)},
+                summary_lib.KEY_SIZES: {'data/b.docx': len(self.PRIOR_CONTENT)}
+            }))
+
+    def validate(self, files):
+        self.s3_client.objects[(BUCKET, BAGIT_NAME)] = build_tar(files)
+        return bagit_lib.untar_and_validate_s3_object(
+            BUCKET, BAGIT_NAME, BAG_ROOT, output_prefix=OUTPUT_PREFIX,
+            deduplicate=True, prior_prefix='consignments/')
+
+    def get_extract_count(self, name):
+        return sum(
+            1 for call in self.extractfile.call_args_list
+            if call.args[1].name.endswith(name))
+
+    def test_copied(self):
+        self.s3_client.objects[(BUCKET, f'{self.PRIOR_ROOT}/data/b.docx')] = self.PRIOR_CONTENT
+        validation = self.validate(build_bag_files(DATA_FILES))
+        self.assertTrue(validation.is_valid)
+        self.assertEqual(
+            validation.copied[f'{BAG_ROOT}/data/b.docx'], f'{self.PRIOR_ROOT}/data/b.docx')
+        self.assertNotIn(
+            f'{BAG_ROOT}/data/b.docx', self.s3_client.get_requests('upload_fileobj'))
+        self.assertEqual(self.get_extract_count('b.docx'), 1)
+
+    def test_uploaded_once_if_source_deleted(self):
+        validation = self.validate(build_bag_files(DATA_FILES))
+        self.assertTrue(validation.is_valid)
+        self.assertNotIn(f'{BAG_ROOT}/data/b.docx', validation.copied)
+        self.assertEqual(
+            self.s3_client.objects[(BUCKET, f'{BAG_ROOT}/data/b.docx')], self.PRIOR_CONTENT)
+        self.assertEqual(self.get_extract_count('b.docx'), 1)
+
+    def test_uploaded_once_if_content_differs(self):
+        self.s3_client.objects[(BUCKET, f'{self.PRIOR_ROOT}/data/b.docx')] = self.PRIOR_CONTENT
+        files = build_bag_files(DATA_FILES)
+        files['data/b.docx'] = b'x' * 200
+        validation = self.validate(files)
+        self.assertEqual(validation.mismatched, ['data/b.docx'])
+        self.assertNotIn(f'{BAG_ROOT}/data/b.docx', validation.copied)
+        self.assertEqual(
+            self.s3_client.objects[(BUCKET, f'{BAG_ROOT}/data/b.docx')], b'x' * 200)
+        self.assertEqual(self.get_extract_count('b.docx'), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+Module to test cooperative checkpointing.
+
+Run from the parent directory with: python3 -m unittest discover ./tests
+"""
+import unittest
+from s3_lib import checkpoint_lib
+from s3_lib import common_lib
+from fixtures import InMemoryS3Client, FakeContext
+
+BUCKET = 'test-bucket'
+
+
+class TestDeadline(unittest.TestCase):
+    def test_no_context_never_expires(self):
+        deadline = checkpoint_lib.Deadline(margin_ms=1000)
+        self.assertIsNone(deadline.get_remaining_ms())
+        self.assertFalse(deadline.expired)
+
+    def test_expires_within_margin(self):
+        self.assertFalse(checkpoint_lib.Deadline(FakeContext(1001), margin_ms=1000).expired)
+        self.assertTrue(checkpoint_lib.Deadline(FakeContext(1000), margin_ms=1000).expired)
+
+
+class TestCheckpoint(unittest.TestCase):
+    def setUp(self):
+        self.s3_client = InMemoryS3Client()
+        patcher = self.s3_client.patch()
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_checkpoint_key(self):
+        self.assertEqual(
+            checkpoint_lib.get_checkpoint_key('consignments/bag/'),
+            'consignments/bag.checkpoint.json')
+
+    def test_save_load_delete(self):
+        checkpoint = checkpoint_lib.Checkpoint(BUCKET, 'bag.checkpoint.json')
+        self.assertIsNone(checkpoint.load())
+        continuation = checkpoint.save({'cursor': 3})
+        resumed = checkpoint_lib.Checkpoint.from_continuation(continuation)
+        self.assertEqual(resumed.load(), {'cursor': 3})
+        resumed.delete()
+        self.assertIsNone(checkpoint.load())
+
+    def test_invalid_continuation(self):
+        with self.assertRaises(common_lib.S3LibError):
+            checkpoint_lib.Checkpoint.from_continuation({})
+
+    def test_set_and_pop_continuation(self):
+        event = {'a': 1}
+        output = checkpoint_lib.set_continuation(event, {'checkpoint-key': 'k'})
+        self.assertNotIn(checkpoint_lib.KEY_CONTINUATION, event)
+        self.assertEqual(checkpoint_lib.pop_continuation(output), {'checkpoint-key': 'k'})
+        self.assertEqual(output, event)
+        self.assertIsNone(checkpoint_lib.pop_continuation(output))
+
+
+if __name__ == '__main__':
+    unittest.main()
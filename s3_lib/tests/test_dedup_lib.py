@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Module to test content-addressed deduplication.
+
+Run from the parent directory with: python3 -m unittest discover ./tests
+"""
+import json
+import unittest
+from s3_lib import dedup_lib
+from s3_lib import summary_lib
+from fixtures import InMemoryS3Client
+
+BUCKET = 'test-bucket'
+PREFIX = 'consignments/judgment/ABC-123/'
+
+
+class TestDedupLib(unittest.TestCase):
+    def setUp(self):
+        self.s3_client = InMemoryS3Client()
+        patcher = self.s3_client.patch()
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def put_summary(self, attempt, tag_manifest, manifest):
+        root = f'{PREFIX}{attempt}/bag'
+        summary = {
+            summary_lib.KEY_S3_BUCKET: BUCKET,
+            summary_lib.KEY_S3_OBJECT_ROOT: root,
+            summary_lib.KEY_TAG_MANIFEST: tag_manifest,
+            summary_lib.KEY_MANIFEST: manifest,
+            summary_lib.KEY_SIZES: {
+                name: 10 for name in list(tag_manifest) + list(manifest)
+            }
+        }
+        self.s3_client.put_object(
+            Bucket=BUCKET, Key=summary_lib.get_summary_key(root),
+            Body=json.dumps(summary))
+        return root
+
+    def test_index_keeps_first_source(self):
+        content_index = dedup_lib.ContentIndex()
+        content_index.add('d1', BUCKET, 'first', 1)
+        content_index.add('d1', BUCKET, 'second', 1)
+        content_index.add(None, BUCKET, 'no-digest', 1)
+        self.assertEqual(len(content_index), 1)
+        self.assertEqual(content_index.get('d1').key, 'first')
+        self.assertIsNone(content_index.get('d2'))
+
+    def test_build_prior_index_excludes_current_attempt(self):
+        prior_root = self.put_summary('attempt-1', {'bag-info.txt': 'd1'}, {'data/a': 'd2'})
+        current_root = self.put_summary('attempt-2', {}, {'data/b': 'd3'})
+        content_index = dedup_lib.build_prior_index(
+            self.s3_client, BUCKET, PREFIX, exclude_root=current_root)
+        self.assertEqual(len(content_index), 2)
+        self.assertEqual(content_index.get('d2').key, f'{prior_root}/data/a')
+        self.assertEqual(content_index.get('d2').size, 10)
+        self.assertIsNone(content_index.get('d3'))
+
+    def test_copy(self):
+        self.s3_client.objects[(BUCKET, 'source')] = b'content'
+        source = dedup_lib.ContentSource(BUCKET, 'source', 7)
+        self.assertTrue(dedup_lib.copy_s3_object(self.s3_client, source, BUCKET, 'target'))
+        self.assertEqual(self.s3_client.objects[(BUCKET, 'target')], b'content')
+
+    def test_copy_of_missing_source(self):
+        source = dedup_lib.ContentSource(BUCKET, 'deleted', 7)
+        self.assertFalse(dedup_lib.copy_s3_object(self.s3_client, source, BUCKET, 'target'))
+        self.assertNotIn((BUCKET, 'target'), self.s3_client.objects)
+
+
+if __name__ == '__main__':
+    unittest.main()
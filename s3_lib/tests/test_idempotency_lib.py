@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+Module to test the idempotency index for repeated input events.
+
+Run from the parent directory with: python3 -m unittest discover ./tests
+"""
+import os
+import tempfile
+import unittest
+import unittest.mock
+import concurrent.futures
+from s3_lib import common_lib
+from s3_lib import idempotency_lib
+from fixtures import InMemoryS3Client
+
+BUCKET = 'test-bucket'
+REFERENCE = 'ABC-123'
+CHECKSUM = 'AB12'
+
+
+def result(name):
+    return {'s3-bucket': BUCKET, 's3-bagit-name': name}
+
+
+class TestIdempotencyKey(unittest.TestCase):
+    def test_key(self):
+        self.assertEqual(idempotency_lib.get_idempotency_key(REFERENCE, CHECKSUM), 'ABC-123/ab12')
+
+    def test_invalid_key(self):
+        for reference, checksum in ((REFERENCE, ''), (None, CHECKSUM)):
+            with self.assertRaises(common_lib.S3LibError):
+                idempotency_lib.get_idempotency_key(reference, checksum)
+
+
+class StoreTests:
+    """
+    Tests run against each store; `create_store` returns a new store
+    instance over the same records.
+    """
+    def test_miss(self):
+        index = idempotency_lib.IdempotencyIndex(self.create_store())
+        self.assertIsNone(index.lookup(REFERENCE, CHECKSUM))
+
+    def test_first_record_kept(self):
+        index = idempotency_lib.IdempotencyIndex(self.create_store())
+        self.assertEqual(index.record(REFERENCE, CHECKSUM, result('a')), result('a'))
+        self.assertEqual(index.record(REFERENCE, CHECKSUM, result('b')), result('a'))
+        other = idempotency_lib.IdempotencyIndex(self.create_store())
+        self.assertEqual(other.lookup(REFERENCE, CHECKSUM.lower()), result('a'))
+
+    def test_unavailable_result_forgotten(self):
+        index = idempotency_lib.IdempotencyIndex(self.create_store())
+        index.record(REFERENCE, CHECKSUM, result('a'))
+        checked = []
+
+        def is_available(prior_result):
+            checked.append(prior_result)
+            return False
+
+        self.assertIsNone(index.lookup(REFERENCE, CHECKSUM, is_available=is_available))
+        self.assertEqual(checked, [result('a')])
+        self.assertIsNone(index.lookup(REFERENCE, CHECKSUM))
+        self.assertEqual(index.record(REFERENCE, CHECKSUM, result('b')), result('b'))
+
+    def test_available_result_kept(self):
+        index = idempotency_lib.IdempotencyIndex(self.create_store())
+        index.record(REFERENCE, CHECKSUM, result('a'))
+        self.assertEqual(
+            index.lookup(REFERENCE, CHECKSUM, is_available=lambda r: True), result('a'))
+
+
+class TestS3MarkerStore(StoreTests, unittest.TestCase):
+    def setUp(self):
+        self.s3_client = InMemoryS3Client()
+        patcher = self.s3_client.patch()
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def create_store(self):
+        return idempotency_lib.S3MarkerStore(BUCKET)
+
+    def test_marker_key(self):
+        index = idempotency_lib.IdempotencyIndex(self.create_store())
+        index.record(REFERENCE, CHECKSUM, result('a'))
+        self.assertIn((BUCKET, 'idempotency/ABC-123/ab12.json'), self.s3_client.objects)
+
+    def test_race(self):
+        # Every concurrent writer gets the one result that was stored
+        names = [f'run-{i}' for i in range(20)]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(names)) as executor:
+            kept = list(executor.map(
+                lambda name: idempotency_lib.IdempotencyIndex(self.create_store()).record(
+                    REFERENCE, CHECKSUM, result(name)),
+                names))
+        self.assertEqual(len(set(r['s3-bagit-name'] for r in kept)), 1)
+        self.assertEqual(
+            idempotency_lib.IdempotencyIndex(self.create_store()).lookup(REFERENCE, CHECKSUM),
+            kept[0])
+        self.assertEqual(len(self.s3_client.get_requests('put_object')), len(names))
+
+    def test_other_put_errors_raised(self):
+        store = self.create_store()
+        error = common_lib.S3LibError('failed')
+        with unittest.mock.patch.object(self.s3_client, 'put_object', side_effect=error):
+            with self.assertRaises(common_lib.S3LibError):
+                store.put('key', {})
+
+
+class TestSqliteStore(StoreTests, unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'idempotency.sqlite3')
+
+    def create_store(self):
+        store = idempotency_lib.SqliteStore(self.path)
+        self.addCleanup(store.connection.close)
+        return store
+
+
+class TestGetStore(unittest.TestCase):
+    def get_store(self, environment, bucket=BUCKET):
+        with unittest.mock.patch.dict(os.environ, environment, clear=True):
+            return idempotency_lib.get_store(bucket=bucket)
+
+    def test_default_s3(self):
+        with InMemoryS3Client().patch():
+            store = self.get_store({'TRE_IDEMPOTENCY_PREFIX': 'markers/'})
+        self.assertIsInstance(store, idempotency_lib.S3MarkerStore)
+        self.assertEqual(store.prefix, 'markers/')
+
+    def test_s3_needs_bucket(self):
+        with self.assertRaises(common_lib.S3LibError):
+            self.get_store({}, bucket=None)
+
+    def test_sqlite(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'index.sqlite3')
+            store = self.get_store({
+                'TRE_IDEMPOTENCY_STORE': 'SQLite', 'TRE_IDEMPOTENCY_SQLITE_PATH': path})
+            store.connection.close()
+        self.assertIsInstance(store, idempotency_lib.SqliteStore)
+        self.assertEqual(store.path, path)
+
+    def test_none(self):
+        self.assertIsNone(self.get_store({'TRE_IDEMPOTENCY_STORE': 'none'}, bucket=None))
+
+    def test_unknown(self):
+        with self.assertRaises(common_lib.S3LibError):
+            self.get_store({'TRE_IDEMPOTENCY_STORE': 'dynamodb'})
+
+
+if __name__ == '__main__':
+    unittest.main()
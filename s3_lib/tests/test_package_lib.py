@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+"""
+Module to test single-pass tar.gz packages.
+
+Run from the parent directory with: python3 -m unittest discover ./tests
+"""
+import io
+import gzip
+import random
+import tarfile
+import unittest
+import unittest.mock
+from s3_lib import common_lib
+from s3_lib import object_lib
+from s3_lib import package_lib
+from s3_lib import spill_lib
+from fixtures import InMemoryS3Client, sha256
+
+BUCKET_IN = 'in-bucket'
+BUCKET_OUT = 'out-bucket'
+PACKAGE = 'packages/package.tar.gz'
+OTHER_PACKAGE = 'packages/other.tar.gz'
+REUSE_PREFIX = 'packages/records/'
+PART_BYTES = 4096
+LARGE = bytes(random.Random(0).choices(range(256), k=PART_BYTES * 3))  # doesn't compress
+
+
+class PackageTestCase(unittest.TestCase):
+    def setUp(self):
+        self.s3_client = InMemoryS3Client()
+        self.s3_client.min_part_bytes = PART_BYTES
+        for patcher in (
+                self.s3_client.patch(),
+                unittest.mock.patch.object(package_lib, 'MAX_FETCHES_IN_FLIGHT', 3),
+                unittest.mock.patch.object(object_lib, 'READ_BLOCK_SIZE', PART_BYTES),
+                unittest.mock.patch.object(spill_lib, 'SPILL_MEMBER_THRESHOLD_BYTES', 100)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def put_members(self, files):
+        for name, content in files.items():
+            self.s3_client.objects[(BUCKET_IN, f'data/{name}')] = content
+        return [package_lib.PackageMember(name, f'data/{name}') for name in files]
+
+
+class TestFetchMembers(PackageTestCase):
+    def test_in_order(self):
+        files = {f'file-{i}': bytes([i]) * (i * 50) for i in range(10)}
+        members = self.put_members(files)
+        fetched = [
+            (member.name, size, body.read())
+            for member, size, body in package_lib.fetch_members(self.s3_client, BUCKET_IN, members)
+        ]
+        self.assertEqual(fetched, [(name, len(content), content) for name, content in files.items()])
+
+    def test_content_member(self):
+        member = package_lib.PackageMember('inline', content=b'inline content')
+        (fetched, size, body), = package_lib.fetch_members(self.s3_client, BUCKET_IN, [member])
+        self.assertEqual((fetched, size, body.read()), (member, 14, b'inline content'))
+        self.assertEqual(self.s3_client.requests, [])
+
+    def test_bounded_look_ahead(self):
+        # When the caller has a member, at most MAX_FETCHES_IN_FLIGHT - 1
+        # more have been fetched
+        members = self.put_members({f'file-{i}': b'x' for i in range(20)})
+        fetches = package_lib.fetch_members(self.s3_client, BUCKET_IN, members)
+        for consumed, _ in enumerate(fetches, start=1):
+            self.assertLessEqual(
+                len(self.s3_client.get_requests('get_object')),
+                consumed + package_lib.MAX_FETCHES_IN_FLIGHT - 1)
+
+    def test_stop_early(self):
+        # Closing the generator stops further fetches
+        members = self.put_members({f'file-{i}': b'x' for i in range(20)})
+        fetches = package_lib.fetch_members(self.s3_client, BUCKET_IN, members)
+        next(fetches)
+        fetches.close()
+        self.assertLessEqual(
+            len(self.s3_client.get_requests('get_object')), package_lib.MAX_FETCHES_IN_FLIGHT)
+
+    def test_error_stops_fetches(self):
+        # The error is raised when its member is reached; fetches not yet
+        # started are cancelled and no more are submitted
+        members = self.put_members({f'file-{i}': b'x' for i in range(20)})
+        members[1].s3_object_name = 'data/missing'
+        fetches = package_lib.fetch_members(self.s3_client, BUCKET_IN, members)
+        self.assertEqual(next(fetches)[0], members[0])
+        with self.assertRaises(common_lib.S3LibError):
+            next(fetches)
+        self.assertLessEqual(
+            len(self.s3_client.get_requests('get_object')), 1 + package_lib.MAX_FETCHES_IN_FLIGHT)
+
+
+class TestPackage(PackageTestCase):
+    def write_package(self, members, s3_bucket_out=BUCKET_OUT):
+        return package_lib.s3_objects_to_s3_tar_gz_package(
+            BUCKET_IN, members, PACKAGE, s3_bucket_out=s3_bucket_out)
+
+    def read_package(self):
+        content = self.s3_client.objects[(BUCKET_OUT, PACKAGE)]
+        with tarfile.open(fileobj=io.BytesIO(content), mode='r:gz') as tar:
+            return [(member.name, tar.extractfile(member).read()) for member in tar.getmembers()]
+
+    def test_package(self):
+        files = {'b.bin': LARGE, 'a.txt': b'small', 'c.txt': b''}
+        members = self.put_members(files) + [
+            package_lib.PackageMember('0-inline.json', content=b'{}')]
+        tar_items, checksum = self.write_package(members)
+
+        # Members sorted by name, with their digests and the package's
+        expected = sorted(dict(files, **{'0-inline.json': b'{}'}).items())
+        self.assertEqual(self.read_package(), expected)
+        self.assertEqual(tar_items, [
+            {'name': name, 'size': len(content), 'sha256': sha256(content)}
+            for name, content in expected])
+        self.assertEqual(checksum, sha256(self.s3_client.objects[(BUCKET_OUT, PACKAGE)]))
+
+        # Streamed as a conditional multipart upload, never read back
+        self.assertGreater(len(self.s3_client.get_requests('upload_part')), 1)
+        self.assertEqual(self.s3_client.get_requests('get_object'), [
+            f'data/{name}' for name in sorted(files)])
+        self.assertEqual(self.s3_client.uploads, {})
+
+    def test_conditional_put(self):
+        with unittest.mock.patch.object(
+                self.s3_client, 'complete_multipart_upload',
+                wraps=self.s3_client.complete_multipart_upload) as complete:
+            self.write_package(self.put_members({'large.bin': LARGE}))
+        self.assertEqual(complete.call_args.kwargs['IfNoneMatch'], '*')
+
+    def test_fixed_gzip_header(self):
+        self.write_package(self.put_members({'a.txt': b'a'}))
+        header = self.s3_client.objects[(BUCKET_OUT, PACKAGE)][:10]
+        # No file name flag, zero mtime
+        self.assertEqual(header[3] & 0x08, 0)
+        self.assertEqual(header[4:8], b'\0\0\0\0')
+        self.assertEqual(gzip.decompress(self.s3_client.objects[(BUCKET_OUT, PACKAGE)])[:5], b'a.txt')
+
+    def test_existing_object(self):
+        for files in ({'a.txt': b'a'}, {'large.bin': LARGE}):
+            self.s3_client.objects[(BUCKET_OUT, PACKAGE)] = b'existing'
+            with self.assertRaisesRegex(ValueError, 'already exists'):
+                self.write_package(self.put_members(files))
+            self.assertEqual(self.s3_client.objects[(BUCKET_OUT, PACKAGE)], b'existing')
+            self.assertEqual(self.s3_client.uploads, {})
+
+    def test_missing_member(self):
+        members = self.put_members({'large.bin': LARGE}) + [
+            package_lib.PackageMember('missing', 'data/missing')]
+        with self.assertRaises(common_lib.S3LibError):
+            self.write_package(members)
+        self.assertNotIn((BUCKET_OUT, PACKAGE), self.s3_client.objects)
+        self.assertEqual(self.s3_client.uploads, {})
+
+
+class TestReuse(PackageTestCase):
+    FILES = {'a.bin': LARGE, 'b.txt': b'small'}
+
+    def write_package(self, tar_gz_object, files=FILES, reuse_prefix=REUSE_PREFIX):
+        members = self.put_members(files) + [
+            package_lib.PackageMember('0-inline.json', content=b'{}')]
+        return package_lib.s3_objects_to_s3_tar_gz_package(
+            BUCKET_IN, members, tar_gz_object, s3_bucket_out=BUCKET_OUT,
+            reuse_prefix=reuse_prefix)
+
+    def get_records(self):
+        return [key for bucket, key in self.s3_client.objects if key.startswith(REUSE_PREFIX)]
+
+    def test_reproducible(self):
+        # Separate builds of the same inputs are byte-identical
+        first = self.write_package(PACKAGE, reuse_prefix=None)
+        second = self.write_package(OTHER_PACKAGE, reuse_prefix=None)
+        self.assertEqual(first, second)
+        self.assertEqual(
+            self.s3_client.objects[(BUCKET_OUT, PACKAGE)],
+            self.s3_client.objects[(BUCKET_OUT, OTHER_PACKAGE)])
+        self.assertEqual(len(self.s3_client.get_requests('create_multipart_upload')), 2)
+        self.assertEqual(self.get_records(), [])
+
+    def test_recorded_package_copied(self):
+        first = self.write_package(PACKAGE)
+        self.assertEqual(len(self.get_records()), 1)
+        self.s3_client.requests.clear()
+        second = self.write_package(OTHER_PACKAGE)
+        self.assertEqual(first, second)
+        self.assertEqual(
+            self.s3_client.objects[(BUCKET_OUT, OTHER_PACKAGE)],
+            self.s3_client.objects[(BUCKET_OUT, PACKAGE)])
+        # Members identified by HEAD, but not read; the package copied
+        self.assertEqual(
+            sorted(self.s3_client.get_requests('head_object')), ['data/a.bin', 'data/b.txt'])
+        self.assertEqual(self.s3_client.get_requests('get_object'), self.get_records())
+        self.assertEqual(self.s3_client.get_requests('copy_object'), [OTHER_PACKAGE])
+        self.assertEqual(self.s3_client.get_requests('create_multipart_upload'), [])
+
+    def test_changed_member_rebuilt(self):
+        self.write_package(PACKAGE)
+        self.write_package(OTHER_PACKAGE, files=dict(self.FILES, **{'b.txt': b'changed'}))
+        self.assertEqual(self.s3_client.get_requests('copy_object'), [])
+        self.assertEqual(len(self.get_records()), 2)
+        with tarfile.open(
+                fileobj=io.BytesIO(self.s3_client.objects[(BUCKET_OUT, OTHER_PACKAGE)]),
+                mode='r:gz') as tar:
+            self.assertEqual(tar.extractfile('b.txt').read(), b'changed')
+
+    def test_recorded_package_missing(self):
+        # Rebuilt if the recorded package has been deleted
+        first = self.write_package(PACKAGE)
+        del self.s3_client.objects[(BUCKET_OUT, PACKAGE)]
+        self.assertEqual(self.write_package(OTHER_PACKAGE), first)
+        self.assertEqual(len(self.s3_client.get_requests('create_multipart_upload')), 2)
+
+    def test_reused_target_exists(self):
+        self.write_package(PACKAGE)
+        self.s3_client.objects[(BUCKET_OUT, OTHER_PACKAGE)] = b'existing'
+        with self.assertRaisesRegex(ValueError, 'already exists'):
+            self.write_package(OTHER_PACKAGE)
+        self.assertEqual(self.s3_client.objects[(BUCKET_OUT, OTHER_PACKAGE)], b'existing')
+
+    def test_member_changed_after_head(self):
+        # The package is only built from the versions that were identified
+        get_package_content_hash = package_lib.get_package_content_hash
+
+        def change_after_head(*args):
+            content_hash = get_package_content_hash(*args)
+            self.s3_client.objects[(BUCKET_IN, 'data/b.txt')] = b'changed'
+            return content_hash
+
+        with unittest.mock.patch.object(
+                package_lib, 'get_package_content_hash', side_effect=change_after_head):
+            with self.assertRaises(common_lib.S3LibError):
+                self.write_package(PACKAGE)
+        self.assertNotIn((BUCKET_OUT, PACKAGE), self.s3_client.objects)
+        self.assertEqual(self.s3_client.uploads, {})
+        self.assertEqual(self.get_records(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
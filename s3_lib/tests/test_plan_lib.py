@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Module to test size-aware execution planning.
+
+Run from the parent directory with: python3 -m unittest discover ./tests
+"""
+import os
+import unittest
+import unittest.mock
+from s3_lib import plan_lib
+
+MEBIBYTE = plan_lib.MEBIBYTE
+
+
+class TestPlanLib(unittest.TestCase):
+    def setUp(self):
+        # Plans must not depend on the environment the tests run in
+        patcher = unittest.mock.patch.dict(os.environ, {}, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_get_env_number(self):
+        self.assertEqual(plan_lib.get_env_number('TRE_TEST_NUMBER', 3), 3)
+        os.environ['TRE_TEST_NUMBER'] = ''
+        self.assertEqual(plan_lib.get_env_number('TRE_TEST_NUMBER', 3), 3)
+        os.environ['TRE_TEST_NUMBER'] = '0.25'
+        self.assertEqual(plan_lib.get_env_number('TRE_TEST_NUMBER', cast=float), 0.25)
+
+    def test_memory_budget(self):
+        self.assertEqual(plan_lib.get_memory_budget_bytes(1024), 512 * MEBIBYTE)
+        os.environ['AWS_LAMBDA_FUNCTION_MEMORY_SIZE'] = '2048'
+        os.environ['TRE_PLAN_MEMORY_FRACTION'] = '0.25'
+        self.assertEqual(plan_lib.get_memory_budget_bytes(), 512 * MEBIBYTE)
+        self.assertEqual(plan_lib.get_spill_threshold_bytes(), 256 * MEBIBYTE)
+
+    def test_small_archive_in_memory(self):
+        plan = plan_lib.plan_execution(
+            MEBIBYTE, member_count=3, largest_member_bytes=1024, memory_mb=512)
+        self.assertEqual(plan.strategy, plan_lib.STRATEGY_IN_MEMORY)
+        self.assertFalse(plan.spill_archive)
+        self.assertEqual(plan.workers, 1)
+
+    def test_large_member_streamed(self):
+        plan = plan_lib.plan_execution(
+            100 * MEBIBYTE, member_count=3, largest_member_bytes=100 * MEBIBYTE,
+            memory_mb=512)
+        self.assertEqual(plan.strategy, plan_lib.STRATEGY_STREAMING)
+        self.assertTrue(plan.should_stream_member(100 * MEBIBYTE))
+        self.assertFalse(plan.should_stream_member(None))
+
+    def test_large_archive_spilled(self):
+        plan = plan_lib.plan_execution(1024 * MEBIBYTE, member_count=3, memory_mb=512)
+        self.assertEqual(plan.strategy, plan_lib.STRATEGY_SPILL)
+        self.assertTrue(plan.spill_archive)
+
+    def test_many_members_parallel(self):
+        plan = plan_lib.plan_execution(
+            MEBIBYTE, member_count=1000, largest_member_bytes=1024, memory_mb=1024)
+        self.assertEqual(plan.strategy, plan_lib.STRATEGY_PARALLEL)
+        self.assertEqual(plan.workers, plan_lib.DEFAULT_MAX_WORKERS)
+        self.assertEqual(plan.max_in_flight, plan.workers * plan_lib.MAX_IN_FLIGHT_PER_WORKER)
+
+    def test_workers_limited_by_memory(self):
+        self.assertEqual(plan_lib.get_worker_count(1000, memory_mb=256), 2)
+        self.assertEqual(plan_lib.get_worker_count(None, memory_mb=4096), 1)
+        os.environ['TRE_PLAN_MAX_WORKERS'] = '3'
+        self.assertEqual(plan_lib.get_worker_count(1000, memory_mb=4096), 3)
+
+    def test_member_threshold_override(self):
+        os.environ['TRE_SPILL_MEMBER_THRESHOLD_BYTES'] = '10'
+        plan = plan_lib.plan_execution(100, memory_mb=512)
+        self.assertEqual(plan.member_stream_threshold, 10)
+        self.assertTrue(plan.should_stream_member(11))
+
+
+if __name__ == '__main__':
+    unittest.main()
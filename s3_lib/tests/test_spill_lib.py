@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+Module to test spilling to ephemeral storage.
+
+Run from the parent directory with: python3 -m unittest discover ./tests
+"""
+import io
+import os
+import tempfile
+import unittest
+import unittest.mock
+from s3_lib import common_lib
+from s3_lib import checksum_lib
+from s3_lib import spill_lib
+from fixtures import sha256
+
+CONTENT = bytes(range(256)) * 1000
+
+
+class TestThresholds(unittest.TestCase):
+    def test_should_spill(self):
+        self.assertTrue(spill_lib.should_spill(11, threshold=10))
+        self.assertFalse(spill_lib.should_spill(10, threshold=10))
+        self.assertFalse(spill_lib.should_spill(None, threshold=10))
+
+    def test_should_stream_member(self):
+        with unittest.mock.patch.object(spill_lib, 'SPILL_MEMBER_THRESHOLD_BYTES', 10):
+            self.assertTrue(spill_lib.should_stream_member(11))
+            self.assertFalse(spill_lib.should_stream_member(10))
+
+
+class TestSpillFile(unittest.TestCase):
+    def setUp(self):
+        spill_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(spill_dir.cleanup)
+        self.spill_dir = spill_dir.name
+
+    def test_stream_to_spill_file(self):
+        path = spill_lib.stream_to_spill_file(
+            io.BytesIO(CONTENT), size=len(CONTENT), spill_dir=self.spill_dir)
+        try:
+            self.assertEqual(os.path.dirname(path), self.spill_dir)
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), CONTENT)
+            self.assertEqual(checksum_lib.get_file_checksum(path), sha256(CONTENT))
+        finally:
+            os.remove(path)
+
+    def test_spill_file_removed_on_exit(self):
+        with spill_lib.spill_file(io.BytesIO(CONTENT), spill_dir=self.spill_dir) as mm:
+            self.assertEqual(mm[:], CONTENT)
+            self.assertEqual(checksum_lib.get_buffer_checksum(mm), sha256(CONTENT))
+        self.assertEqual(os.listdir(self.spill_dir), [])
+
+    def test_empty(self):
+        with spill_lib.spill_file(io.BytesIO(b''), spill_dir=self.spill_dir) as mm:
+            self.assertEqual(checksum_lib.get_buffer_checksum(mm.getbuffer()), sha256(b''))
+        path = spill_lib.stream_to_spill_file(io.BytesIO(b''), spill_dir=self.spill_dir)
+        self.assertEqual(checksum_lib.get_file_checksum(path), sha256(b''))
+        os.remove(path)
+
+    def test_insufficient_space(self):
+        usage = unittest.mock.Mock(free=len(CONTENT) - 1)
+        with unittest.mock.patch('shutil.disk_usage', return_value=usage):
+            with self.assertRaises(common_lib.S3LibError):
+                spill_lib.stream_to_spill_file(
+                    io.BytesIO(CONTENT), size=len(CONTENT), spill_dir=self.spill_dir)
+        self.assertEqual(os.listdir(self.spill_dir), [])
+
+    def test_spooled_buffer_moves_to_disk(self):
+        with unittest.mock.patch(
+                'tempfile.TemporaryFile', wraps=tempfile.TemporaryFile) as temporary_file:
+            with spill_lib.spooled_buffer(max_size=100, spill_dir=self.spill_dir) as buffer:
+                buffer.write(b'x' * 100)
+                temporary_file.assert_not_called()
+                buffer.write(b'x')
+                self.assertEqual(temporary_file.call_args.kwargs['dir'], self.spill_dir)
+                buffer.seek(0)
+                self.assertEqual(buffer.read(), b'x' * 101)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""
+Module to test zero-copy assembly of tar archives from s3 objects.
+
+Run from the parent directory with: python3 -m unittest discover ./tests
+"""
+import io
+import time
+import tarfile
+import datetime
+import unittest
+import unittest.mock
+from s3_lib import common_lib
+from s3_lib import tar_lib
+from s3_lib import tar_copy_lib
+from fixtures import InMemoryS3Client, LAST_MODIFIED, sha256
+
+BUCKET_IN = 'in-bucket'
+BUCKET_OUT = 'out-bucket'
+PREFIX = 'bag/data/'
+TAR_OBJECT = 'sip/batch.tar'
+PART_BYTES = 8192
+
+
+def expected_tar(files):
+    """
+    Return the archive `tarfile` writes for `files` (name to content).
+    """
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w') as tar:
+        for name, content in files.items():
+            tar_info = tarfile.TarInfo(f'sip/{name}')
+            tar_info.size = len(content)
+            tar_info.mtime = datetime.datetime.timestamp(LAST_MODIFIED)
+            tar.addfile(tar_info, io.BytesIO(content))
+    return buffer.getvalue()
+
+
+class TestSplitCopyRange(unittest.TestCase):
+    def test_split(self):
+        with unittest.mock.patch.object(tar_copy_lib, 'MAX_PART_BYTES', 10):
+            self.assertEqual(tar_copy_lib.split_copy_range(5, 15), [(5, 15)])
+            self.assertEqual(tar_copy_lib.split_copy_range(0, 21), [(0, 7), (7, 14), (14, 21)])
+            self.assertEqual(tar_copy_lib.split_copy_range(3, 14), [(3, 9), (9, 14)])
+
+
+class TestTarCopy(unittest.TestCase):
+    def setUp(self):
+        self.s3_client = InMemoryS3Client()
+        self.s3_client.min_part_bytes = PART_BYTES
+        for patcher in (
+                self.s3_client.patch(),
+                unittest.mock.patch.object(tar_copy_lib, 'MIN_PART_BYTES', PART_BYTES),
+                unittest.mock.patch.object(tar_copy_lib, 'MAX_PART_BYTES', PART_BYTES * 2),
+                unittest.mock.patch.object(tar_copy_lib, 'HASH_CHUNK_BYTES', 100)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def write_tar(self, files, expected_checksums=None):
+        for name, content in files.items():
+            self.s3_client.objects[(BUCKET_IN, PREFIX + name)] = content
+        return tar_copy_lib.s3_objects_to_s3_tar_file_with_checksum(
+            s3_bucket_in=BUCKET_IN,
+            s3_objects_with_prefix_subs=tar_lib.S3objectsToZip(
+                [PREFIX + name for name in files], PREFIX, 'sip/'),
+            tar_object=TAR_OBJECT,
+            s3_bucket_out=BUCKET_OUT,
+            expected_checksums=expected_checksums)
+
+    def assert_tar(self, files, tar_checksum):
+        # Byte-for-byte what tarfile writes, which reads it back
+        tar_content = self.s3_client.objects[(BUCKET_OUT, TAR_OBJECT)]
+        self.assertEqual(tar_content, expected_tar(files))
+        self.assertEqual(tar_checksum, sha256(tar_content))
+        with tarfile.open(fileobj=io.BytesIO(tar_content), mode='r:') as tar:
+            self.assertEqual(
+                {member.name: tar.extractfile(member).read() for member in tar.getmembers()},
+                {f'sip/{name}': content for name, content in files.items()})
+        self.assertEqual(self.s3_client.uploads, {})
+
+    def test_small_members_merged(self):
+        files = {f'file-{i}.txt': bytes([i]) * 300 for i in range(20)}
+        tar_items, tar_checksum = self.write_tar(files)
+        self.assert_tar(files, tar_checksum)
+        self.assertEqual(self.s3_client.get_requests('upload_part_copy'), [])
+        # Headers, content and padding merged into parts of at least PART_BYTES
+        self.assertLess(len(self.s3_client.get_requests('upload_part')), len(files))
+        self.assertEqual(tar_items, [
+            {'name': f'sip/{name}', 'size': len(content), 'sha256': sha256(content)}
+            for name, content in files.items()])
+
+    def test_part_filled_then_copied(self):
+        large = bytes(range(256)) * 120
+        files = {'small.txt': b'small', 'large.bin': large}
+        with unittest.mock.patch.object(
+                self.s3_client, 'upload_part', wraps=self.s3_client.upload_part) as upload_part:
+            tar_items, tar_checksum = self.write_tar(files)
+        self.assert_tar(files, tar_checksum)
+        # The pending part (headers and the small member) is filled to
+        # PART_BYTES from the large member's start; the rest of the member is
+        # copied in ranges of at most MAX_PART_BYTES
+        self.assertEqual(len(upload_part.call_args_list[0].kwargs['Body']), PART_BYTES)
+        self.assertEqual(
+            self.s3_client.get_requests('upload_part_copy'), [PREFIX + 'large.bin'] * 2)
+        self.assertEqual(
+            tar_items[1], {'name': 'sip/large.bin', 'size': len(large), 'sha256': sha256(large)})
+
+    def test_copied_member_at_part_boundary(self):
+        large = b'x' * (PART_BYTES * 3)
+        files = {'large.bin': large}
+        tar_items, tar_checksum = self.write_tar(files)
+        self.assert_tar(files, tar_checksum)
+        self.assertEqual(len(self.s3_client.get_requests('upload_part_copy')), 2)
+
+    def test_zero_length_members(self):
+        files = {'empty-1': b'', 'large.bin': b'y' * (PART_BYTES * 2), 'empty-2': b''}
+        tar_items, tar_checksum = self.write_tar(files)
+        self.assert_tar(files, tar_checksum)
+        self.assertEqual(tar_items[0]['sha256'], sha256(b''))
+        self.assertEqual(tar_items[2]['sha256'], sha256(b''))
+
+    def test_parts_completed_in_order(self):
+        # Earlier parts finish last; the upload still lists them in order
+        files = {f'file-{i}.bin': bytes([i]) * (PART_BYTES * 2) for i in range(4)}
+        upload_part = self.s3_client.upload_part
+
+        def slow_upload_part(**kwargs):
+            time.sleep(0.01 * (10 - kwargs['PartNumber']))
+            return upload_part(**kwargs)
+
+        with unittest.mock.patch.object(
+                self.s3_client, 'upload_part', side_effect=slow_upload_part), \
+                unittest.mock.patch.object(
+                    self.s3_client, 'complete_multipart_upload',
+                    wraps=self.s3_client.complete_multipart_upload) as complete:
+            _, tar_checksum = self.write_tar(files)
+        self.assert_tar(files, tar_checksum)
+        numbers = [part['PartNumber'] for part in complete.call_args.kwargs['MultipartUpload']['Parts']]
+        self.assertEqual(numbers, list(range(1, len(numbers) + 1)))
+
+    def test_changed_member_aborts(self):
+        files = {'small.txt': b'small', 'large.bin': b'z' * (PART_BYTES * 2)}
+        get_tar_members = tar_copy_lib.get_tar_members
+
+        def change_after_head(*args):
+            members = get_tar_members(*args)
+            self.s3_client.objects[(BUCKET_IN, PREFIX + 'large.bin')] = b'changed'
+            return members
+
+        with unittest.mock.patch.object(
+                tar_copy_lib, 'get_tar_members', side_effect=change_after_head):
+            with self.assertRaises(common_lib.S3LibError):
+                self.write_tar(files)
+        self.assertEqual(self.s3_client.get_requests('abort_multipart_upload'), [TAR_OBJECT])
+        self.assertEqual(self.s3_client.uploads, {})
+        self.assertNotIn((BUCKET_OUT, TAR_OBJECT), self.s3_client.objects)
+
+    def test_checksum_mismatch_aborts(self):
+        files = {'a.txt': b'a', 'b.txt': b'b'}
+        with self.assertRaises(ValueError):
+            self.write_tar(files, expected_checksums={PREFIX + 'b.txt': sha256(b'other')})
+        self.assertEqual(self.s3_client.get_requests('abort_multipart_upload'), [TAR_OBJECT])
+        self.assertNotIn((BUCKET_OUT, TAR_OBJECT), self.s3_client.objects)
+
+    def test_copied_member_verified(self):
+        files = {'small.txt': b'small', 'large.bin': b'z' * (PART_BYTES * 2)}
+        with self.assertRaises(ValueError):
+            self.write_tar(files, expected_checksums={
+                PREFIX + 'small.txt': sha256(b'small'), PREFIX + 'large.bin': sha256(b'other')})
+        self.assertEqual(self.s3_client.get_requests('abort_multipart_upload'), [TAR_OBJECT])
+        self.assertNotIn((BUCKET_OUT, TAR_OBJECT), self.s3_client.objects)
+
+    def test_missing_member(self):
+        with unittest.mock.patch.object(self.s3_client, 'create_multipart_upload') as create:
+            with self.assertRaises(common_lib.S3LibError):
+                tar_copy_lib.s3_objects_to_s3_tar_file_with_checksum(
+                    BUCKET_IN, tar_lib.S3objectsToZip([PREFIX + 'missing'], PREFIX, 'sip/'),
+                    TAR_OBJECT, BUCKET_OUT)
+        create.assert_not_called()
+
+
+class TestTarGzChecksum(unittest.TestCase):
+    def test_checksum_of_uploaded_archive(self):
+        s3_client = InMemoryS3Client()
+        files = {'a.txt': b'a' * 1000, 'b.txt': b''}
+        for name, content in files.items():
+            s3_client.objects[(BUCKET_IN, PREFIX + name)] = content
+        with s3_client.patch():
+            tar_items, tar_checksum = tar_lib.s3_objects_to_s3_tar_gz_file_with_checksum(
+                BUCKET_IN, tar_lib.S3objectsToZip([PREFIX + name for name in files], PREFIX, 'sip/'),
+                'sip/batch.tar.gz', BUCKET_OUT)
+        self.assertEqual(tar_checksum, sha256(s3_client.objects[(BUCKET_OUT, 'sip/batch.tar.gz')]))
+        self.assertEqual([item['sha256'] for item in tar_items], [sha256(c) for c in files.values()])
+
+
+if __name__ == '__main__':
+    unittest.main()
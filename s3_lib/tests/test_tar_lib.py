@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Module to test tar extraction helpers.
+
+Run from the parent directory with: python3 -m unittest discover ./tests
+"""
+import io
+import unittest
+import unittest.mock
+from s3_lib import plan_lib
+from s3_lib import spill_lib
+from s3_lib import tar_lib
+from fixtures import InMemoryS3Client, build_tar, sha256
+
+BUCKET = 'test-bucket'
+
+
+class TestHashingReader(unittest.TestCase):
+    def test_hashes_and_counts_what_is_read(self):
+        content = bytes(range(256)) * 100
+        reader = tar_lib.HashingReader(io.BytesIO(content))
+        chunks = []
+        for chunk in iter(lambda: reader.read(1000), b''):
+            chunks.append(chunk)
+        self.assertEqual(b''.join(chunks), content)
+        self.assertEqual(reader.size, len(content))
+        self.assertEqual(reader.hexdigest(), sha256(content))
+
+    def test_read_all(self):
+        reader = tar_lib.HashingReader(io.BytesIO(b'abc'))
+        self.assertEqual(reader.read(), b'abc')
+        self.assertEqual(reader.hexdigest(), sha256(b'abc'))
+
+    def test_not_seekable(self):
+        self.assertFalse(tar_lib.HashingReader(io.BytesIO(b'')).seekable())
+
+    def test_empty(self):
+        reader = tar_lib.HashingReader(io.BytesIO(b''))
+        self.assertEqual(reader.read(), b'')
+        self.assertEqual(reader.size, 0)
+        self.assertEqual(reader.hexdigest(), sha256(b''))
+
+
+class TestUntar(unittest.TestCase):
+    def test_member_object_name(self):
+        item = tar_lib.tarfile.TarInfo('./bag/data/a.txt')
+        self.assertEqual(tar_lib.get_member_object_name(item, 'out/'), 'out/bag/data/a.txt')
+
+    def test_untar_stream_to_s3(self):
+        s3_client = InMemoryS3Client()
+        files = {'data/a.txt': b'a', 'data/b.txt': b'b' * 100}
+        # Members above the threshold are streamed rather than read whole
+        with unittest.mock.patch.object(spill_lib, 'SPILL_MEMBER_THRESHOLD_BYTES', 10):
+            names = tar_lib.untar_stream_to_s3(
+                s3_client, io.BytesIO(build_tar(files)), BUCKET, 'out/')
+        self.assertEqual(names, ['out/bag/data/a.txt', 'out/bag/data/b.txt'])
+        self.assertEqual(s3_client.objects[(BUCKET, 'out/bag/data/a.txt')], b'a')
+        self.assertEqual(s3_client.objects[(BUCKET, 'out/bag/data/b.txt')], b'b' * 100)
+
+
+class TestOpenS3TarStream(unittest.TestCase):
+    CONTENT = build_tar({'data/a.txt': b'a' * 1000})
+
+    def setUp(self):
+        self.s3_client = InMemoryS3Client()
+        self.s3_client.objects[(BUCKET, 'bag.tar.gz')] = self.CONTENT
+        self.inspected = []
+
+    def inspect(self, stream, passed=True):
+        self.assertFalse(stream.seekable())
+        self.inspected.append(stream.read(10))
+        return passed
+
+    def open(self, spill_archive, **kwargs):
+        plan = plan_lib.plan_execution(len(self.CONTENT), memory_mb=512)
+        plan.spill_archive = spill_archive
+        return tar_lib.open_s3_tar_stream(
+            self.s3_client, BUCKET, 'bag.tar.gz', plan=plan, **kwargs)
+
+    def test_inspected_as_downloaded(self):
+        for spill_archive in (False, True):
+            with self.open(spill_archive, inspect=self.inspect) as tar_stream:
+                self.assertEqual(tar_stream.read(), self.CONTENT)
+        self.assertEqual(self.inspected, [self.CONTENT[:10]] * 2)
+        self.assertEqual(len(self.s3_client.get_requests('get_object')), 2)
+
+    def test_download_abandoned_if_inspection_fails(self):
+        for spill_archive in (False, True):
+            with self.open(
+                    spill_archive,
+                    inspect=lambda stream: self.inspect(stream, passed=False)) as tar_stream:
+                self.assertIsNone(tar_stream)
+
+
+if __name__ == '__main__':
+    unittest.main()
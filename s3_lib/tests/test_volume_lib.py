@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Module to test multi-volume archive output.
+
+Run from the parent directory with: python3 -m unittest discover ./tests
+"""
+import os
+import time
+import threading
+import unittest
+import unittest.mock
+from s3_lib import common_lib
+from s3_lib import volume_lib
+
+
+class TestVolumeLib(unittest.TestCase):
+    def setUp(self):
+        # Worker counts must not depend on the environment the tests run in
+        patcher = unittest.mock.patch.dict(os.environ, {}, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_no_limit(self):
+        self.assertEqual(volume_lib.split_into_volumes({'a': 1, 'b': 2}), [['a', 'b']])
+        self.assertEqual(volume_lib.split_into_volumes({}), [[]])
+        os.environ['TRE_SIP_VOLUME_MAX_BYTES'] = '100'
+        self.assertEqual(volume_lib.get_volume_max_bytes(), 100)
+
+    def test_limit_edges(self):
+        # A volume may be exactly the limit; one more byte starts the next
+        self.assertEqual(
+            volume_lib.split_into_volumes({'a': 60, 'b': 40, 'c': 1}, 100),
+            [['a', 'b'], ['c']])
+        self.assertEqual(
+            volume_lib.split_into_volumes({'a': 60, 'b': 41}, 100), [['a'], ['b']])
+        self.assertEqual(volume_lib.split_into_volumes({}, 100), [[]])
+        for limit in (0, -1):
+            with self.assertRaises(common_lib.S3LibError):
+                volume_lib.split_into_volumes({'a': 1}, limit)
+
+    def test_object_larger_than_limit(self):
+        self.assertEqual(
+            volume_lib.split_into_volumes({'a': 10, 'big': 500, 'b': 10, 'c': 0}, 100),
+            [['a'], ['big'], ['b', 'c']])
+        self.assertEqual(volume_lib.split_into_volumes({'big': 500}, 100), [['big']])
+
+    def test_order_kept(self):
+        object_sizes = {f'folder-{i % 3}/file-{i}': 30 for i in range(10)}
+        volumes = volume_lib.split_into_volumes(object_sizes, 100)
+        self.assertEqual([len(volume) for volume in volumes], [3, 3, 3, 1])
+        self.assertEqual([name for volume in volumes for name in volume], list(object_sizes))
+
+    def test_volume_name(self):
+        self.assertEqual(volume_lib.get_volume_name('SIP', 1, 1, 'tar.gz'), 'SIP.tar.gz')
+        self.assertEqual(volume_lib.get_volume_name('SIP', 2, 12, 'tar'), 'SIP.002.tar')
+
+    def test_worker_count(self):
+        # 512 MB default memory: 256 MB budget, 128 MB spill threshold
+        self.assertEqual(volume_lib.get_volume_worker_count(10), 2)
+        self.assertEqual(volume_lib.get_volume_worker_count(0), 1)
+        os.environ['TRE_SPILL_THRESHOLD_BYTES'] = str(16 * 1024 * 1024)
+        self.assertEqual(volume_lib.get_volume_worker_count(20), 8)
+        self.assertEqual(volume_lib.get_volume_worker_count(3), 3)
+        os.environ['TRE_PLAN_MAX_WORKERS'] = '4'
+        self.assertEqual(volume_lib.get_volume_worker_count(20), 4)
+        os.environ['TRE_SPILL_THRESHOLD_BYTES'] = str(1024 * 1024 * 1024)
+        self.assertEqual(volume_lib.get_volume_worker_count(20), 1)
+
+    def test_build_volumes_in_order(self):
+        volumes = [['a'], ['b', 'c'], ['d']]
+
+        def build_volume(number, object_names):
+            # Later volumes finish first
+            time.sleep(0.01 * (len(volumes) - number))
+            return number, object_names
+
+        self.assertEqual(
+            volume_lib.build_volumes(volumes, build_volume),
+            [(1, ['a']), (2, ['b', 'c']), (3, ['d'])])
+
+    def test_build_volumes_max_workers(self):
+        os.environ['TRE_SPILL_THRESHOLD_BYTES'] = '1'
+        running = []
+        peak = []
+        lock = threading.Lock()
+
+        def build_volume(number, object_names):
+            with lock:
+                running.append(number)
+                peak.append(len(running))
+            time.sleep(0.01)
+            with lock:
+                running.remove(number)
+            return number
+
+        self.assertEqual(
+            volume_lib.build_volumes([[]] * 6, build_volume, max_workers=2), [1, 2, 3, 4, 5, 6])
+        self.assertEqual(max(peak), 2)
+
+    def test_first_error_raised(self):
+        # The first failed volume's error is raised; volumes not yet started
+        # are not built
+        built = []
+
+        def build_volume(number, object_names):
+            built.append(number)
+            if number == 2:
+                raise ValueError('volume 2')
+            return number
+
+        with self.assertRaisesRegex(ValueError, 'volume 2'):
+            volume_lib.build_volumes([['a']] * 6, build_volume, max_workers=1)
+        self.assertEqual(built, [1, 2])
+
+    def test_first_error_in_volume_order(self):
+        # Volume 3 fails first, but volume 2's error is raised
+        os.environ['TRE_SPILL_THRESHOLD_BYTES'] = '1'
+        started = threading.Barrier(2)
+
+        def build_volume(number, object_names):
+            if number == 2:
+                started.wait()
+                time.sleep(0.01)
+                raise ValueError('volume 2')
+            if number == 3:
+                started.wait()
+                raise common_lib.S3LibError('volume 3')
+            return number
+
+        with self.assertRaisesRegex(ValueError, 'volume 2'):
+            volume_lib.build_volumes([['a']] * 3, build_volume, max_workers=3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Benchmark `BagitData` metadata.csv and closure.csv generation (rows/second)
+for consignments of 1k, 10k and 100k files.
+
+Compares the indexed checksum lookup with the original per-row scan of the
+manifest (O(rows x manifest)); the scan is only run up to `SCAN_MAX_ROWS`
+as it takes minutes beyond that.
+
+Run from this folder with: python3 benchmark_bagit_data.py
+"""
+import sys
+sys.path.append("../../lambda_functions/tre-bagit-to-dri-sip")
+
+import time
+from tre_bagit import BagitData
+
+ROW_COUNTS = (1000, 10000, 100000)
+SCAN_MAX_ROWS = 10000
+
+info_dict = {
+    "Consignment-Series": "MOCKA 101",
+    "Internal-Sender-Identifier": "TDR-2022-AA1",
+    "Consignment-Export-Datetime": "2022-07-18T12:45:45Z",
+}
+dri_config = dict(
+    IDENTIFIER_PREFIX='file:/' + "MOCKA101Y22TBAA1" + '/' + "MOCKA_101" + '/'
+)
+
+
+class ScanBagitData(BagitData):
+    """
+    `BagitData` with the original manifest scan for each row's checksum.
+    """
+    def dri_checksum(self, row):
+        bagit_manifest_for_row = list(filter(lambda d: d.get('file') == row.get('Filepath'), self.manifest_dict))
+        return bagit_manifest_for_row[0].get('checksum') if(len(bagit_manifest_for_row) == 1) else ''
+
+    def checksums(self):
+        return [self.dri_checksum({'Filepath': filepath}) for filepath in self.column('Filepath')]
+
+
+def build_consignment(row_count):
+    rows = [{
+        'Filepath': 'data/content',
+        'FileName': 'content',
+        'FileType': 'Folder',
+        'Filesize': '',
+        'RightsCopyright': 'Crown Copyright',
+        'LegalStatus': 'Public Record(s)',
+        'HeldBy': 'The National Archives, Kew',
+        'Language': 'English',
+        'FoiExemptionCode': '',
+        'LastModified': '',
+        'OriginalFilePath': ''
+    }]
+    manifest = []
+    for i in range(row_count - 1):
+        filepath = f'data/content/file {i:06d}.docx'
+        rows.append({
+            'Filepath': filepath,
+            'FileName': f'file {i:06d}.docx',
+            'FileType': 'File',
+            'Filesize': '12825',
+            'RightsCopyright': 'Crown Copyright',
+            'LegalStatus': 'Public Record(s)',
+            'HeldBy': 'The National Archives, Kew',
+            'Language': 'English',
+            'FoiExemptionCode': '',
+            'LastModified': '2022-09-29T15:10:20',
+            'OriginalFilePath': ''
+        })
+        manifest.append({'file': filepath, 'basename': f'file {i:06d}.docx', 'checksum': f'{i:064x}'})
+    return rows, manifest
+
+
+def run(name, bagit_data_class, rows, manifest):
+    start = time.perf_counter()
+    bagit = bagit_data_class({}, info_dict, manifest, rows)
+    metadata = bagit.to_metadata(dri_config)
+    closure = bagit.to_closure(dri_config)
+    elapsed = time.perf_counter() - start
+    rate = len(rows) / elapsed
+    print(f'{len(rows):>8,} rows {name:<8} {elapsed:>9.3f}s {rate:>12,.0f} rows/second')
+    return metadata, closure, rate
+
+
+if __name__ == '__main__':
+    for row_count in ROW_COUNTS:
+        rows, manifest = build_consignment(row_count)
+        indexed_output = run('indexed', BagitData, rows, manifest)
+        if row_count <= SCAN_MAX_ROWS:
+            scan_output = run('scan', ScanBagitData, rows, manifest)
+            assert scan_output[:2] == indexed_output[:2], 'outputs differ'
+            print(f'{row_count:>8,} rows speed-up  {indexed_output[2] / scan_output[2]:>9.1f}x')
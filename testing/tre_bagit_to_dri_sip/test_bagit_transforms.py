@@ -77,6 +77,52 @@ class TestBagitMethods(unittest.TestCase):
         actual_closure = bagit.to_closure(dri_config)
         self.assertEqual(actual_closure, self.expected_closure)
 
+    def test_write_dri_csvs_single_pass(self):
+        bagit = make_bagit(csv_string_v_1_2)
+        metadata_output = io.StringIO()
+        closure_output = io.StringIO()
+        bagit.write_dri_csvs(dri_config, metadata_file=metadata_output, closure_file=closure_output)
+        self.assertEqual(metadata_output.getvalue(), self.expected_metadata)
+        self.assertEqual(closure_output.getvalue(), self.expected_closure)
+
+    def test_invalid_values_are_all_reported(self):
+        csv_string = csv_string_v_1_2 + \
+            """data/content/file-c2.txt,file-c2.txt,Link,36,Crown Copyright,Public Record(s),TNA,Welsh,,2022-09-29T15:10:20,\n"""
+        bagit = make_bagit(csv_string)
+        with self.assertRaises(ValueError) as context:
+            bagit.to_metadata(dri_config)
+        message = str(context.exception)
+        self.assertIn('(2 errors)', message)
+        self.assertIn('Unexpected value "Link" for "FileType" on line 4', message)
+        self.assertIn('Unexpected value "Welsh" for "Language" on line 4', message)
+
+    def test_unexpected_column_is_reported(self):
+        csv_string = csv_string_v_1_1.replace('LastModified\n', 'LastModified,Extra\n', 1)
+        bagit = make_bagit(csv_string)
+        with self.assertRaises(ValueError) as context:
+            bagit.to_closure(dri_config)
+        self.assertIn('Unexpected column "Extra"', str(context.exception))
+
+    def test_checksum_index(self):
+        duplicated = manifest_dict + [{"file": "data/content/twice.txt", "checksum": "aa"},
+                                      {"file": "data/content/twice.txt", "checksum": "bb"}]
+        bagit = BagitData(config_dict, info_dict, duplicated, [])
+        self.assertEqual(bagit.dri_checksum({'Filepath': 'data/content/file-c1.txt'}), manifest_dict[0]['checksum'])
+        self.assertEqual(bagit.dri_checksum({'Filepath': 'data/content/twice.txt'}), '')
+        self.assertEqual(bagit.dri_checksum({'Filepath': 'data/content'}), '')
+
+    def test_rows_are_columnar(self):
+        bagit = make_bagit(csv_string_v_1_2)
+        self.assertEqual(bagit.row_count, 2)
+        self.assertEqual(bagit.columns['FileType'], ['File', 'Folder'])
+        self.assertEqual(bagit.csv_data, list(csv.DictReader(io.StringIO(csv_string_v_1_2))))
+
+    def test_identifiers_are_memoised(self):
+        bagit = make_bagit(csv_string_v_1_1)
+        identifiers = bagit.identifiers(dri_config)
+        self.assertIs(bagit.identifiers(dri_config), identifiers)
+        self.assertEqual(identifiers, [bagit.dri_identifier(row, dri_config) for row in bagit.csv_data])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+"""
+Module to test tre-editorial-integration's consignment state document
+(editorial-state.json), using s3_lib's in-memory s3 client.
+
+Run from this folder with: python3 -m unittest test_editorial_state
+"""
+import os
+import sys
+import json
+import unittest
+import unittest.mock
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(HERE, '../../lambda_functions/tre-editorial-integration'))
+sys.path.append(os.path.join(HERE, '../../s3_lib'))
+sys.path.append(os.path.join(HERE, '../../s3_lib/tests'))
+
+for name, value in {
+        'TRE_ENV': 'test',
+        'TRE_PREFIX': 'tre',
+        'TRE_PRESIGNED_URL_EXPIRY': '60',
+        'TRE_VERSION': '1.0.0',
+        'TRE_VERSION_JSON': '{"lambda-functions-version": []}',
+        'S3_BUCKET': 'test-bucket',
+        'S3_OBJECT_ROOT': 'parsed/'}.items():
+    os.environ.setdefault(name, value)
+
+import tre_editorial_integration as ei  # noqa: E402
+from s3_lib import object_lib  # noqa: E402
+from fixtures import InMemoryS3Client  # noqa: E402
+
+BUCKET = os.environ['S3_BUCKET']
+REFERENCE = 'ABC-123'
+TDR_ROOT = f'{os.environ["S3_OBJECT_ROOT"]}judgment/{REFERENCE}/'
+STATE_KEY = TDR_ROOT + ei.STATE_FILE
+
+
+def parser_event(tdr_retry):
+    prefix = f'{TDR_ROOT}{tdr_retry}/'
+    return [
+        {
+            'context': {
+                'number-of-retries': '0',
+                'bag-info-txt': 'bag-info.txt',
+                'judgment-document': 'judgment.docx',
+                'consignment-type': 'judgment'
+            },
+            'parser-inputs': {
+                'consignment-reference': REFERENCE,
+                's3-bucket': BUCKET,
+                'attachment-urls': [],
+                's3-output-prefix': prefix
+            }
+        },
+        [
+            {
+                'parser-outputs': {
+                    'xml': f'{REFERENCE}.xml',
+                    'metadata': 'metadata.json',
+                    'images': ['image-1.png'],
+                    'attachments': [],
+                    'log': 'parser.log',
+                    'error-messages': []
+                }
+            }
+        ]
+    ]
+
+
+def retry_event(number_of_retries):
+    return {
+        'consignment-reference': REFERENCE,
+        'consignment-type': 'judgment',
+        'number-of-retries': number_of_retries
+    }
+
+
+class TestEditorialState(unittest.TestCase):
+    def setUp(self):
+        self.s3_client = InMemoryS3Client()
+        patcher = self.s3_client.patch()
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def put_parser_output(self, tdr_retry):
+        prefix = f'{TDR_ROOT}{tdr_retry}/'
+        for name, content in {
+                f'{REFERENCE}.xml': b'<judgment/>',
+                'metadata.json': b'{"uri": "ewhc/2023/1"}',
+                'image-1.png': b'png',
+                'parser.log': b'log',
+                'judgment.docx': b'docx',
+                'bag-info.txt': b'Consignment-Type: judgment\n'}.items():
+            self.s3_client.objects[(BUCKET, prefix + name)] = content
+
+    def run_parser(self, tdr_retry):
+        self.put_parser_output(tdr_retry)
+        return ei.handler(parser_event(tdr_retry), None)
+
+    def get_state(self):
+        return json.loads(self.s3_client.objects[(BUCKET, STATE_KEY)])
+
+    def put_state(self, tdr_retry, editorial_retry):
+        output_message = {
+            ei.KEY_EDITORIAL_OUTPUT: {'consignment-reference': REFERENCE},
+            ei.KEY_TAR_GZ: {ei.KEY_BUCKET: BUCKET, ei.KEY_KEY: f'{TDR_ROOT}{tdr_retry}/package.tar.gz'}
+        }
+        self.s3_client.put_object(
+            Bucket=BUCKET, Key=STATE_KEY,
+            Body=json.dumps(ei.build_editorial_state(tdr_retry, editorial_retry, output_message)))
+
+    def test_parser_creates_state(self):
+        output_message = self.run_parser(0)
+        state = self.get_state()
+        self.assertEqual(
+            (state[ei.KEY_TDR_RETRY], state[ei.KEY_EDITORIAL_RETRY]), (0, 0))
+        self.assertEqual(state[ei.KEY_OUTPUT_MESSAGE], output_message)
+        self.assertEqual(
+            state[ei.KEY_TAR_GZ][ei.KEY_KEY], f'{TDR_ROOT}0/0/TRE-{REFERENCE}.tar.gz')
+
+    def test_parser_replaces_earlier_tdr_retry(self):
+        self.put_state(0, 2)
+        self.run_parser(1)
+        state = self.get_state()
+        self.assertEqual((state[ei.KEY_TDR_RETRY], state[ei.KEY_EDITORIAL_RETRY]), (1, 0))
+
+    def test_parser_skips_later_tdr_retry(self):
+        self.put_state(2, 0)
+        output_message = self.run_parser(1)
+        self.assertEqual(self.get_state()[ei.KEY_TDR_RETRY], 2)
+        # The run's outputs are still written
+        self.assertIn(
+            (BUCKET, f'{TDR_ROOT}1/0/{ei.OUTPUT_MESSAGE_FILE}'), self.s3_client.objects)
+        self.assertEqual(output_message[ei.KEY_EDITORIAL_OUTPUT][ei.KEY_NUMBER_OF_RETRIES], 0)
+
+    def concurrent_state_write(self, *states):
+        """
+        Patch reading the state so each of `states` ((TDR retry, Editorial
+        retry) pairs) is written by another writer just after it is read.
+        """
+        pending = list(states)
+        get_object_json_and_etag = object_lib.get_object_json_and_etag
+
+        def read_then_write(bucket, key):
+            result = get_object_json_and_etag(bucket, key)
+            if key == STATE_KEY and pending:
+                self.put_state(*pending.pop(0))
+            return result
+
+        return unittest.mock.patch.object(
+            object_lib, 'get_object_json_and_etag', side_effect=read_then_write)
+
+    def test_parser_retries_lost_update(self):
+        # Another writer records an earlier TDR retry first; re-read, retry
+        self.put_state(0, 0)
+        with self.concurrent_state_write((0, 1)):
+            self.run_parser(1)
+        state = self.get_state()
+        self.assertEqual((state[ei.KEY_TDR_RETRY], state[ei.KEY_EDITORIAL_RETRY]), (1, 0))
+
+    def test_parser_keeps_concurrent_claim(self):
+        # An Editorial retry found this run's output message (by listing
+        # folders) and claimed retry 1 before the state was written; that
+        # claim is kept, without an error
+        with self.concurrent_state_write((1, 1)):
+            self.run_parser(1)
+        state = self.get_state()
+        self.assertEqual((state[ei.KEY_TDR_RETRY], state[ei.KEY_EDITORIAL_RETRY]), (1, 1))
+
+    def test_parser_gives_up_after_repeated_conflicts(self):
+        writes = [(0, editorial_retry) for editorial_retry in range(ei.STATE_UPDATE_ATTEMPTS)]
+        with self.concurrent_state_write(*writes):
+            with self.assertRaises(ei.TEEditorialIntegrationError):
+                self.run_parser(1)
+
+    def test_retry_claims_with_conditional_put(self):
+        self.run_parser(0)
+        listings = len(self.s3_client.get_requests('list_objects_v2'))
+        with unittest.mock.patch.object(
+                self.s3_client, 'put_object', wraps=self.s3_client.put_object) as put_object:
+            output_message = ei.handler(retry_event(1), None)
+        state_puts = [
+            call.kwargs for call in put_object.call_args_list if call.kwargs['Key'] == STATE_KEY]
+        self.assertEqual(len(state_puts), 1)
+        self.assertIn('IfMatch', state_puts[0])
+        self.assertEqual(self.get_state()[ei.KEY_EDITORIAL_RETRY], 1)
+        self.assertEqual(output_message[ei.KEY_EDITORIAL_OUTPUT][ei.KEY_NUMBER_OF_RETRIES], 1)
+        saved = json.loads(
+            self.s3_client.objects[(BUCKET, f'{TDR_ROOT}0/1/{ei.OUTPUT_MESSAGE_FILE}')])
+        self.assertEqual(saved, output_message)
+        # Reads the state, not the consignment's folders
+        self.assertEqual(len(self.s3_client.get_requests('list_objects_v2')), listings)
+
+    def test_duplicate_retry_fails(self):
+        self.run_parser(0)
+        with self.concurrent_state_write((0, 1)):
+            with self.assertRaisesRegex(ValueError, 'changed by another writer'):
+                ei.handler(retry_event(1), None)
+        with self.assertRaisesRegex(ei.TEEditorialIntegrationError, 'Expected number-of-retries'):
+            ei.handler(retry_event(1), None)
+
+    def test_retry_without_state_lists_folders(self):
+        self.run_parser(0)
+        self.run_parser(1)
+        del self.s3_client.objects[(BUCKET, STATE_KEY)]
+        output_message = ei.handler(retry_event(1), None)
+        self.assertIn(TDR_ROOT, self.s3_client.get_requests('list_objects_v2'))
+        self.assertEqual(
+            output_message[ei.KEY_TAR_GZ][ei.KEY_KEY], f'{TDR_ROOT}1/0/TRE-{REFERENCE}.tar.gz')
+        state = self.get_state()
+        self.assertEqual((state[ei.KEY_TDR_RETRY], state[ei.KEY_EDITORIAL_RETRY]), (1, 1))
+        self.assertIn((BUCKET, f'{TDR_ROOT}1/1/{ei.OUTPUT_MESSAGE_FILE}'), self.s3_client.objects)
+
+    def test_retry_without_outputs(self):
+        with self.assertRaisesRegex(ei.TEEditorialIntegrationError, 'No TDR output data found'):
+            ei.handler(retry_event(1), None)
+
+
+if __name__ == '__main__':
+    unittest.main()